@@ -55,6 +55,15 @@ __contributors__ = {}
 __url__ = ''
 
 from . import config
+from . import masks
+from . import cidr
+from . import matcher
+from . import storage
+from . import modes
+from . import wheel
+from . import flood
+from . import metrics
+from . import audit
 from . import plugin
 if sys.version_info >= (3, 4):
     from importlib import reload
@@ -62,6 +71,15 @@ else:
     from imp import reload
 # In case we're being reloaded.
 reload(config)
+reload(masks)
+reload(cidr)
+reload(matcher)
+reload(storage)
+reload(modes)
+reload(wheel)
+reload(flood)
+reload(metrics)
+reload(audit)
 reload(plugin)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
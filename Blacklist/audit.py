@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+
+# Events that change the DB when replayed; the others ('set', 'unset',
+# 'lift') only record what happened on IRC.
+ADDS = ('add',)
+REMOVES = ('del', 'expire')
+
+
+class AuditLog(object):
+    """Append-only history of the blacklist, kept in SQLite: one row per
+    event, indexed on (channel, at).
+
+    Events are 'add' and 'del' for DB changes made by commands, imports,
+    reconciliation or manual +b/-b, 'expire' for timed bans reaching their
+    expiry, 'lift' for the IRC-only cleanup of a bot ban, and 'set'/'unset'
+    for manual +b/-b that left the DB as it was. Rows are never updated or
+    deleted.
+
+    Queries use a connection of their own and read rows one at a time, so
+    a long replay neither holds up writers nor loads the whole log."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self):
+        """Connects, creating the log if needed. Returns True if the log is
+        empty, e.g. because it was just created."""
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS audit (
+                id INTEGER PRIMARY KEY,
+                at REAL NOT NULL,
+                channel TEXT NOT NULL,
+                op TEXT NOT NULL,
+                mask TEXT NOT NULL,
+                actor TEXT,
+                reason TEXT,
+                is_bot_cmd INTEGER,
+                expiry_at REAL,
+                ban_id INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS audit_channel_at ON audit (channel, at);
+        """)
+        return self._conn.execute('SELECT 1 FROM audit LIMIT 1').fetchone() is None
+
+    @staticmethod
+    def _row(at, channel, op, mask, entry, actor):
+        if entry is None:
+            return (at, channel, op, mask, actor, None, None, None, None)
+        return (at, channel, op, mask, entry[0] if actor is None else actor,
+                entry[2], int(bool(entry[3])), entry[4], entry[5])
+
+    def _insert(self, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO audit (at, channel, op, mask, actor, reason, '
+                'is_bot_cmd, expiry_at, ban_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows)
+
+    def record(self, at, channel, op, items, actor=None):
+        """Appends an op event at time at for each (mask, entry) in items.
+        entry is the ban's DB entry for adds, whose adder is the actor
+        unless one is given, and may be None otherwise."""
+        self._insert([self._row(at, channel, op, mask, entry, actor)
+                      for (mask, entry) in items])
+
+    def seed(self, db):
+        """Records an 'add' for every ban in db, as {channel: {mask: entry}},
+        at its creation time, so that a new log starts from the bans already
+        in place."""
+        self._insert([self._row(entry[1], channel, 'add', mask, entry, None)
+                      for (channel, masks) in db.items()
+                      for (mask, entry) in masks.items()])
+
+    def _query(self, sql, params):
+        conn = sqlite3.connect(self.path)
+        try:
+            for row in conn.execute(sql, params):
+                yield row
+        finally:
+            conn.close()
+
+    def history(self, channel, mask):
+        """Yields (at, op, actor, reason, expiry_at) for mask's events in
+        channel, oldest first."""
+        return self._query(
+            'SELECT at, op, actor, reason, expiry_at FROM audit '
+            'WHERE channel = ? AND mask = ? ORDER BY at, id', (channel, mask))
+
+    def replay(self, channel, until):
+        """Returns channel's {mask: entry} ban list as it was at time until,
+        rebuilt by replaying its events in order."""
+        bans = {}
+        rows = self._query(
+            'SELECT at, op, mask, actor, reason, is_bot_cmd, expiry_at, ban_id '
+            'FROM audit WHERE channel = ? AND at <= ? ORDER BY at, id',
+            (channel, until))
+        for (at, op, mask, actor, reason, is_bot_cmd, expiry_at, ban_id) in rows:
+            if op in ADDS:
+                bans[mask] = [actor, at, reason, bool(is_bot_cmd), expiry_at, ban_id]
+            elif op in REMOVES:
+                bans.pop(mask, None)
+        return bans
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,252 @@
+"""
+Offline benchmark of the Blacklist plugin.
+
+Builds synthetic ban lists of the given sizes and measures, against a fake
+Irc object (no network, no driver), how long it takes to:
+
+  * check a join storm with doJoin (latency percentiles per join)
+  * add bans one at a time with _internal_add on top of the list
+  * render the numbered list as uploaded by the list command
+  * load the database when the plugin starts
+
+Results are printed as JSON, or written to --output, so they can be compared
+between versions. Run it with the directory holding the plugin as the current
+directory:
+
+    python Blacklist/bench.py --sizes 1000,10000,100000 --output bench.json
+"""
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Share of each kind of mask in the synthetic lists
+MASK_KINDS = (('exact', 40), ('suffix', 20), ('prefix', 15), ('cidr', 10),
+              ('user', 10), ('account', 4), ('fallback', 1))
+
+
+def _openRegistry(directory):
+    """Points supybot's registry at a throwaway directory. Must run before
+    anything imports supybot.conf."""
+    for name in ('conf', 'data', 'logs'):
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+    filename = os.path.join(directory, 'conf', 'bench.conf')
+    with open(filename, 'w') as f:
+        f.write('supybot.directories.backup: /dev/null\n'
+                'supybot.directories.conf: %s\n'
+                'supybot.directories.data: %s\n'
+                'supybot.directories.log: %s\n'
+                'supybot.log.stdout: False\n'
+                'supybot.nick: bench\n' % tuple(os.path.join(directory, name)
+                                               for name in ('conf', 'data', 'logs')))
+    from supybot import registry
+    registry.open_registry(filename)
+
+
+class FakeIrc(object):
+    """Just enough of irclib.Irc for the plugin: state, network, nick and a
+    message sink."""
+
+    def __init__(self, channel, network='bench', nick='bench'):
+        from supybot import irclib
+        self.network = network
+        self.nick = nick
+        self.state = irclib.IrcState()
+        self.state.supported['modes'] = 4
+        self.state.channels[channel] = irclib.ChannelState()
+        self.state.channels[channel].addUser('@' + nick)
+        self.sent = 0
+
+    def queueMsg(self, msg):
+        self.sent += 1
+    sendMsg = queueMsg
+
+    def reply(self, s, *args, **kwargs):
+        self.sent += 1
+
+
+def makeMasks(size, rng):
+    """Returns [(mask, kind)] of size distinct masks, mixed as MASK_KINDS."""
+    kinds = [kind for (kind, weight) in MASK_KINDS for _ in range(weight)]
+    counts = dict.fromkeys(kinds, 0)
+    masks = []
+    for _ in range(size):
+        kind = rng.choice(kinds)
+        n = counts[kind]
+        counts[kind] = n + 1
+        if kind == 'exact':
+            mask = '*!*@h%d.isp%d.example' % (n, n % 97)
+        elif kind == 'suffix':
+            mask = '*!*@*.net%d.example' % n
+        elif kind == 'prefix':
+            mask = '*!*@10.%d.%d.*' % (n // 256 % 256, n % 256)
+        elif kind == 'cidr':
+            # 100.64.0.0/10 has room for 16384 /24 networks
+            mask = '*!*@100.%d.%d.0/%d' % (64 + n // 256 % 64, n % 256,
+                                          24 + n % 7)
+        elif kind == 'user':
+            mask = '*!ident%d@*' % n
+        elif kind == 'account':
+            mask = '$a:acct%d' % n
+        else:
+            mask = '*spam%d*!*@*' % n
+        masks.append((mask, kind))
+    return masks
+
+
+def userFor(mask, kind, i):
+    """Returns (hostmask, account) of a user mask matches."""
+    nick = 'j%d' % i
+    if kind == 'exact':
+        return ('%s!u@%s' % (nick, mask[4:]), None)
+    if kind == 'suffix':
+        return ('%s!u@x%s' % (nick, mask[5:]), None)
+    if kind == 'prefix':
+        return ('%s!u@%s1' % (nick, mask[4:-1]), None)
+    if kind == 'cidr':
+        return ('%s!u@%s1' % (nick, mask[4:].split('/')[0][:-1]), None)
+    if kind == 'user':
+        return ('%s!%s@clean.example' % (nick, mask[2:-2]), None)
+    if kind == 'account':
+        return ('%s!u@clean.example' % nick, mask[3:])
+    return ('x%sx%s!u@clean.example' % (mask[1:-5], nick), None)
+
+
+def makeStorm(masks, joins, hitRate, rng):
+    """Returns [(hostmask, account)] for joins users, a hitRate share of
+    them matching one of masks."""
+    storm = []
+    for i in range(joins):
+        if masks and rng.random() < hitRate:
+            storm.append(userFor(*rng.choice(masks), i=i))
+        else:
+            storm.append(('c%d!u%d@198.51.%d.%d' % (i, i, i // 256 % 256, i % 256), ''))
+    return storm
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99),
+            'max': samples[-1], 'mean': sum(samples) / len(samples)}
+
+
+def benchmark(plugin, backend, size, joins, adds, hitRate, seed, directory):
+    """Runs every measurement for one backend and list size, and returns
+    the results as a dict."""
+    from supybot import conf, ircmsgs
+    channel = '#bench'
+    rng = random.Random(seed)
+    conf.supybot.directories.data.setValue(os.path.join(directory, '%s-%d' % (backend, size)))
+    conf.supybot.plugins.Blacklist.storageBackend.setValue(backend)
+    irc = FakeIrc(channel)
+    cb = plugin.Class(irc)
+    result = {'backend': backend, 'size': size}
+    try:
+        masks = makeMasks(size, rng)
+        started = time.perf_counter()
+        cb._internal_add_many(channel, [(mask, 'bench', 'synthetic', None)
+                                        for (mask, _) in masks])
+        result['bulk_add_s'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(adds):
+            cb._internal_add(channel, '*!*@added%d.example' % i, 'bench', 'synthetic', True)
+        elapsed = time.perf_counter() - started
+        result['internal_add'] = {'count': adds, 'seconds': elapsed,
+                                  'per_second': adds / elapsed if elapsed else None}
+
+        storm = makeStorm(masks, joins, hitRate, rng)
+        latencies = []
+        for (hostmask, account) in storm:
+            msg = ircmsgs.join(channel, prefix=hostmask)
+            if account is not None:
+                irc.state.nicksToAccounts[msg.nick] = account
+            started = time.perf_counter()
+            cb.doJoin(irc, msg)
+            latencies.append((time.perf_counter() - started) * 1e6)
+        result['join_latency_us'] = _percentiles(latencies)
+        result['join_latency_us']['count'] = len(latencies)
+        result['messages_sent'] = irc.sent
+
+        entries = list(cb.db[channel].items())
+        started = time.perf_counter()
+        for line in cb._renderList(channel, entries):
+            pass
+        result['list_render_s'] = time.perf_counter() - started
+    finally:
+        cb.die()
+
+    started = time.perf_counter()
+    cb = plugin.Class(irc)
+    result['db_load_s'] = time.perf_counter() - started
+    result['db_loaded_masks'] = len(cb.db.get(channel, ()))
+    cb.die()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the Blacklist plugin offline.')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma-separated ban list sizes (default: %(default)s)')
+    parser.add_argument('--joins', type=int, default=10000,
+                        help='joins in each storm (default: %(default)s)')
+    parser.add_argument('--adds', type=int, default=200,
+                        help='bans added one at a time on top of each list (default: %(default)s)')
+    parser.add_argument('--hit-rate', type=float, default=0.1,
+                        help='share of joins matching a ban (default: %(default)s)')
+    parser.add_argument('--backend', choices=('journal', 'sqlite', 'both'), default='both')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    options = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='blacklist-bench-')
+    # Registered before supybot's own exit handlers so it runs after them
+    atexit.register(shutil.rmtree, directory, True)
+    _openRegistry(directory)
+    # Import the plugin as a package, not the modules next to this file
+    if sys.path and os.path.abspath(sys.path[0]) == HERE:
+        sys.path[0] = os.path.dirname(HERE)
+    import Blacklist as plugin
+    from supybot import conf
+    config = conf.supybot.plugins.Blacklist
+    config.enabled.setValue(True)
+    config.modeFlushDelay.setValue(0)
+    config.sharedPollInterval.setValue(0)
+
+    backends = ('journal', 'sqlite') if options.backend == 'both' else (options.backend,)
+    runs = []
+    for size in (int(s) for s in options.sizes.split(',') if s):
+        for backend in backends:
+            runs.append(benchmark(plugin, backend, size, options.joins, options.adds,
+                                  options.hit_rate, options.seed, directory))
+            print('%s %d done' % (backend, size), file=sys.stderr)
+
+    report = {'plugin_version': plugin.__version__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'time': time.time(),
+              'options': vars(options),
+              'runs': runs}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,106 @@
+import ipaddress
+
+
+class PrefixTree(object):
+    """Binary trie of IPv4 and IPv6 networks, each holding the masks banning
+    it. lookup() walks one node per bit of the address, so its cost depends
+    on the prefix lengths, not on how many networks are stored.
+
+    Nodes are (zero, one, masks) tuples that are never modified: add() and
+    discard() rebuild the path to the changed node and leave the rest shared,
+    so copy() is O(1) and a copy can be changed while other threads keep
+    looking up in the original."""
+
+    def __init__(self):
+        self._roots = {4: None, 6: None}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def copy(self):
+        new = PrefixTree.__new__(PrefixTree)
+        new._roots = dict(self._roots)
+        new._size = self._size
+        return new
+
+    @staticmethod
+    def _bits(network):
+        width = network.max_prefixlen
+        addr = int(network.network_address)
+        return [(addr >> (width - 1 - depth)) & 1
+                for depth in range(network.prefixlen)]
+
+    @classmethod
+    def _insert(cls, node, bits, mask):
+        (zero, one, masks) = node or (None, None, ())
+        if not bits:
+            return (zero, one, masks + (mask,))
+        if bits[0]:
+            return (zero, cls._insert(one, bits[1:], mask), masks)
+        return (cls._insert(zero, bits[1:], mask), one, masks)
+
+    @classmethod
+    def _remove(cls, node, bits, mask):
+        if node is None:
+            return None
+        (zero, one, masks) = node
+        if not bits:
+            masks = tuple(m for m in masks if m != mask)
+        elif bits[0]:
+            one = cls._remove(one, bits[1:], mask)
+        else:
+            zero = cls._remove(zero, bits[1:], mask)
+        if zero is None and one is None and not masks:
+            return None
+        return (zero, one, masks)
+
+    def add(self, network, mask):
+        version = network.version
+        self._roots[version] = self._insert(self._roots[version],
+                                            self._bits(network), mask)
+        self._size += 1
+
+    def discard(self, network, mask):
+        version = network.version
+        self._roots[version] = self._remove(self._roots[version],
+                                            self._bits(network), mask)
+        self._size -= 1
+
+    def lookup(self, address):
+        """Returns the mask tuples of every stored network containing
+        address, widest network first."""
+        node = self._roots[address.version]
+        width = address.max_prefixlen
+        addr = int(address)
+        found = []
+        depth = 0
+        while node is not None:
+            if node[2]:
+                found.append(node[2])
+            if depth == width:
+                break
+            node = node[(addr >> (width - 1 - depth)) & 1]
+            depth += 1
+        return found
+
+
+def parseNetwork(host):
+    """Returns the ip_network for a CIDR host part such as '1.2.3.0/24' or
+    '2001:db8::/32', or None if host is not one."""
+    if '/' not in host:
+        return None
+    try:
+        return ipaddress.ip_network(host, strict=False)
+    except ValueError:
+        return None
+
+
+def parseAddress(host):
+    """Returns the ip_address for a literal IP host, or None."""
+    try:
+        return ipaddress.ip_address(host)
+    except ValueError:
+        return None
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
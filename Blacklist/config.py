@@ -53,6 +53,9 @@ class CurrencyCommand(registry.Integer):
             raise registry.InvalidRegistryValue(f"Number must be between 0 and {max(plugin.Blacklist.banmasks)}.")
         registry.String.setValue(self, num)
 
+class StorageBackend(registry.OnlySomeStrings):
+    validStrings = ('journal', 'sqlite')
+
 Blacklist = conf.registerPlugin('Blacklist')
 
 conf.registerChannelValue(Blacklist, 'maxInlineEntries',
@@ -76,6 +79,38 @@ conf.registerChannelValue(Blacklist, 'banReason',
 conf.registerChannelValue(Blacklist, 'addManualBans',
         registry.Boolean(True, """Sets whether to watch for channel bans directly added by users (not using the bot) to the database."""))
 
+conf.registerChannelValue(Blacklist, 'groups',
+        registry.SpaceSeparatedListOfStrings([], """Sets the ban groups the channel subscribes to. Joins are
+        checked against the masks of these groups as well as the channel's own, and masks added to a group with
+        groupadd are banned in every subscribed channel where the bot is opped."""))
+
+conf.registerChannelValue(Blacklist, 'reconcileInterval',
+        registry.NonNegativeInteger(0, """Sets the number of minutes between checks of the channel's ban list
+        against the database. The check also runs when the bot joins the channel. 0 disables it."""))
+
+conf.registerChannelValue(Blacklist, 'joinFloodThreshold',
+        registry.NonNegativeInteger(0, """Sets the number of joins within joinFloodWindow seconds that puts the
+        channel in join-flood mode. In that mode joins are collected for joinFloodDelay seconds and checked against
+        the blacklist together, and the matches are banned and kicked in as few lines as the server allows.
+        0 disables it."""))
+
+conf.registerChannelValue(Blacklist, 'joinFloodWindow',
+        registry.PositiveInteger(10, """Sets the number of seconds over which joins are counted for
+        joinFloodThreshold."""))
+
+conf.registerChannelValue(Blacklist, 'joinFloodDelay',
+        registry.PositiveFloat(2.0, """Sets the number of seconds joins are collected in join-flood mode before
+        being checked against the blacklist."""))
+
+conf.registerChannelValue(Blacklist, 'joinFloodLockModes',
+        registry.String('', """Sets the channel modes (e.g. 'i' or 'r') the bot sets when join-flood mode
+        starts, and lifts joinFloodLockDuration seconds after the flood stops. Modes already set are left alone.
+        Empty disables it."""))
+
+conf.registerChannelValue(Blacklist, 'joinFloodLockDuration',
+        registry.PositiveInteger(60, """Sets the number of seconds joinFloodLockModes stay set. The lock is kept
+        while the channel is still flooded."""))
+
 conf.registerChannelValue(Blacklist, 'pastebinUrl',
         registry.String('https://filehost.0bin.xyz/', """URL of the paste service to use when the ban list is too large to display inline.
         Must accept multipart/form-data POST and return a plain URL in the response body.
@@ -85,4 +120,56 @@ conf.registerChannelValue(Blacklist, 'pastebinField',
         registry.String('file', """The form field name expected by the paste service.
         Use 'file' for single_php_filehost and 0x0-style services, 'content' for dpaste.com."""))
 
+conf.registerChannelValue(Blacklist, 'pastebinCacheExpiry',
+        registry.NonNegativeInteger(10, """Sets the number of minutes a pastebin URL for the ban list is reused while
+        the list is unchanged. 0 uploads the list again on every call."""))
+
+conf.registerGlobalValue(Blacklist, 'storageBackend',
+        StorageBackend('journal', """Sets where the ban database is kept: 'journal' for blacklist.json plus an
+        append-only journal, 'sqlite' for blacklist.sqlite3. On first use the sqlite backend imports an existing
+        blacklist.json. Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'sqlitePath',
+        registry.String('', """Sets the path of the database used by the sqlite backend. Bots on the same host
+        pointed at the same file share their ban lists. Empty uses blacklist.sqlite3 in the plugin's data
+        directory. Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'sharedPollInterval',
+        registry.NonNegativeInteger(5, """Sets the number of seconds between checks for bans added or removed by
+        other bots sharing the sqlite database. Only the changed bans are read. 0 disables it. Takes effect when
+        the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'lazyLoad',
+        registry.Boolean(False, """Sets whether a channel's (or group's) bans are read from the sqlite database
+        only when first needed, on a join or a command, instead of all at plugin load. Has no effect with the journal
+        backend. Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'idleChannelExpiry',
+        registry.NonNegativeInteger(60, """Sets the number of minutes after which the bans of a channel that has
+        seen no join or command are dropped from memory, when lazyLoad is on. They are read again when next needed.
+        0 keeps them loaded."""))
+
+conf.registerGlobalValue(Blacklist, 'journalSyncInterval',
+        registry.PositiveInteger(5, """Sets the number of seconds between fsyncs of the ban journal. Changes are
+        always written to the journal immediately; this only bounds how much can be lost on a power failure.
+        Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'journalCompactThreshold',
+        registry.PositiveInteger(1000, """Sets the number of journal records after which the journal is folded back
+        into blacklist.json. Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'expiryTickInterval',
+        registry.PositiveInteger(10, """Sets the number of seconds between checks for expired bans. Bans due within
+        the same interval are lifted together. Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'metricsFlushInterval',
+        registry.PositiveInteger(60, """Sets the number of seconds between writes of the per-mask hit counters to
+        the database and of the metrics dump (metrics.json in the plugin's data directory). Takes effect when the
+        plugin is reloaded."""))
+
+conf.registerGlobalValue(Blacklist, 'modeFlushDelay',
+        registry.Float(0.5, """Sets the number of seconds ban and unban changes are held back so that
+        changes for the same channel can be sent together in MODE +bbbb/-bbbb lines, as many per line as the
+        server's MODES limit allows. 0 sends each change on its own immediately."""))
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
\ No newline at end of file
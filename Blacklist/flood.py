@@ -0,0 +1,51 @@
+import collections
+import threading
+
+
+class JoinFlood(object):
+    """Tracks the JOIN rate of each (network, channel) over a sliding window
+    and holds the JOINs that arrive while a channel is flooded, so they can
+    be checked against the blacklist together instead of one at a time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._joins = {}
+        self._buffers = {}
+        # {key: modes set by the flood lock, still to be lifted}
+        self.locked = {}
+
+    def _count(self, key, now, window):
+        joins = self._joins.get(key)
+        if joins is None:
+            return 0
+        while joins and joins[0] <= now - window:
+            joins.popleft()
+        if not joins:
+            del self._joins[key]
+            return 0
+        return len(joins)
+
+    def hit(self, key, now, window, threshold):
+        """Records a JOIN and returns whether the channel had at least
+        threshold JOINs in the last window seconds."""
+        with self._lock:
+            self._joins.setdefault(key, collections.deque()).append(now)
+            return self._count(key, now, window) >= threshold
+
+    def flooding(self, key, now, window, threshold):
+        with self._lock:
+            return self._count(key, now, window) >= threshold
+
+    def buffer(self, key, item):
+        """Holds item for the next drain(). Returns True if the buffer was
+        empty, i.e. the caller has to schedule that drain."""
+        with self._lock:
+            items = self._buffers.setdefault(key, [])
+            items.append(item)
+            return len(items) == 1
+
+    def drain(self, key):
+        with self._lock:
+            return self._buffers.pop(key, [])
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
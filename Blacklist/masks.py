@@ -0,0 +1,74 @@
+import functools
+import ipaddress
+import re
+
+from supybot import ircutils
+
+_FIELDS = re.compile(r'nick|\*ident|ident|\*\.phost|host')
+
+
+def parentHost(host):
+    """Returns the host part that covers host's network rather than host:
+
+    IPv4:     '1.2.3.*'
+    IPv6:     the /64 network, e.g. '2001:db8:1:2::/64'
+    cloaks:   hosts with a '/' ('user/foo', 'gateway/web/...') stay exact
+    names:    the first label is dropped, 'a.b.isp.net' -> '*.b.isp.net';
+              names of two labels or fewer stay exact
+    """
+    if '/' in host:
+        return host
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        labels = host.split('.')
+        if len(labels) <= 2:
+            return host
+        return '*.' + '.'.join(labels[1:])
+    if address.version == 4:
+        return host.rsplit('.', 1)[0] + '.*'
+    # Pela rede e não pelo texto: '2001:db8::1' comprime zeros dentro do /64
+    return ipaddress.ip_network(host + '/64', strict=False).with_prefixlen
+
+
+def compileTemplate(template):
+    """Turns a banmask template such as 'nick!*ident@*.phost' into a function
+    of (nick, ident, host) returning the mask. '*ident' drops the '~' that
+    marks an unverified ident."""
+    parts = []
+    pos = 0
+    for field in _FIELDS.finditer(template):
+        if field.start() > pos:
+            literal = template[pos:field.start()]
+            parts.append(lambda nick, ident, host, literal=literal: literal)
+        name = field.group()
+        if name == 'nick':
+            parts.append(lambda nick, ident, host: nick)
+        elif name == '*ident':
+            parts.append(lambda nick, ident, host: '*' + ident.lstrip('~'))
+        elif name == 'ident':
+            parts.append(lambda nick, ident, host: ident)
+        elif name == '*.phost':
+            parts.append(lambda nick, ident, host: parentHost(host))
+        else:
+            parts.append(lambda nick, ident, host: host)
+        pos = field.end()
+    if pos < len(template):
+        literal = template[pos:]
+        parts.append(lambda nick, ident, host, literal=literal: literal)
+    return lambda nick, ident, host: ''.join(part(nick, ident, host)
+                                             for part in parts)
+
+
+@functools.lru_cache(maxsize=None)
+def _formatter(template):
+    return compileTemplate(template)
+
+
+@functools.lru_cache(maxsize=4096)
+def banMask(hostmask, template):
+    """Returns the ban mask template gives for hostmask."""
+    (nick, ident, host) = ircutils.splitHostmask(hostmask)
+    return _formatter(template)(nick, ident, host)
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
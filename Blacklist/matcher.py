@@ -0,0 +1,387 @@
+import heapq
+from collections.abc import Mapping
+
+from supybot import ircutils
+
+from .cidr import PrefixTree, parseAddress, parseNetwork
+
+_WILDCARDS = frozenset('*?')
+
+try:
+    _compilePattern = ircutils._compileHostmaskPattern
+except AttributeError:
+    # Private in Limnoria; fall back on the public (and slower) matcher.
+    def _compilePattern(pattern):
+        return lambda s: True if ircutils.hostmaskPatternEqual(pattern, s) \
+            else None
+
+def _isLiteral(s):
+    return not _WILDCARDS.intersection(s)
+
+def _splitMask(mask):
+    """Splits a ban mask or hostmask into (nick, user, host), or returns None
+    if it is not in nick!user@host form."""
+    nick, sep, rest = mask.partition('!')
+    if not sep:
+        return None
+    user, sep, host = rest.rpartition('@')
+    if not sep:
+        return None
+    return (nick, user, host)
+
+def parseExtban(mask):
+    """Returns (negated, type, argument) for an extban such as '$a:name',
+    '$~a' or '$r:*bot*', or None if mask is not one. argument is None when
+    the extban has none."""
+    if not mask.startswith('$') or len(mask) < 2:
+        return None
+    negated = mask[1] == '~'
+    rest = mask[2:] if negated else mask[1:]
+    if not rest:
+        return None
+    (kind, sep, arg) = rest.partition(':')
+    return (negated, kind.lower(), arg if sep else None)
+
+def _compileExtban(negated, kind, arg):
+    """Returns a predicate of (hostmask, account, realname) for an extban.
+    account is '' for users known to be logged out and None when unknown,
+    realname None when unknown; extbans needing unknown data never match,
+    negated or not."""
+    pattern = _compilePattern(arg) if arg else None
+    if kind == 'a':
+        def test(hostmask, account, realname):
+            if account is None:
+                return False
+            matched = bool(account) and (pattern is None or
+                                         pattern(account) is not None)
+            return matched != negated
+    elif kind == 'r' and pattern is not None:
+        def test(hostmask, account, realname):
+            if realname is None:
+                return False
+            return (pattern(realname) is not None) != negated
+    elif kind == 'x' and pattern is not None:
+        def test(hostmask, account, realname):
+            if realname is None:
+                return False
+            full = '%s#%s' % (hostmask, realname)
+            return (pattern(full) is not None) != negated
+    else:
+        # Extbans we can't evaluate here ($j, $c, ...) never match.
+        def test(hostmask, account, realname):
+            return False
+    return test
+
+def _compileCidr(mask):
+    """Returns a predicate of (hostmask, account, realname) for a mask whose
+    host part is a network: the nick and ident are matched as usual, and the
+    host must be a literal address inside the network."""
+    (nick, user, host) = _splitMask(mask)
+    network = parseNetwork(host)
+    pattern = _compilePattern('%s!%s@*' % (nick, user))
+    def test(hostmask, account, realname):
+        if pattern(hostmask) is None:
+            return False
+        address = parseAddress(_splitMask(hostmask)[2])
+        return address is not None and address.version == network.version \
+            and address in network
+    return test
+
+def classify(mask):
+    """Returns the (bucket, key) a mask is indexed under.
+
+    cidr:     the host part is an IPv4 or IPv6 network ('*!*@1.2.3.0/24'),
+              keyed by the ip_network
+    exact:    the host part has no wildcards ('*!*@some.host')
+    suffix:   the host part is '*.' followed by a literal ('*!*@*.isp.net')
+    prefix:   the host part is a literal ending in '.' or ':' followed by '*'
+              ('*!*@1.2.3.*', '*!*@2001:db8:1:2:*')
+    user:     the host part is '*' and the ident is literal ('*!ident@*')
+    account:  an account extban with a literal name ('$a:name')
+    fallback: anything else, tested one compiled pattern at a time
+    """
+    extban = parseExtban(mask)
+    if extban is not None:
+        (negated, kind, arg) = extban
+        if kind == 'a' and not negated and arg and _isLiteral(arg):
+            return ('account', ircutils.toLower(arg))
+        return ('fallback', None)
+    parts = _splitMask(mask)
+    if parts is None:
+        return ('fallback', None)
+    (nick, user, host) = parts
+    network = parseNetwork(host)
+    if network is not None:
+        return ('cidr', network)
+    if host and _isLiteral(host):
+        return ('exact', ircutils.toLower(host))
+    if host.startswith('*.') and _isLiteral(host[1:]):
+        return ('suffix', ircutils.toLower(host[1:]))
+    if host[-2:] in ('.*', ':*') and _isLiteral(host[:-1]):
+        return ('prefix', ircutils.toLower(host[:-1]))
+    if host == '*' and user and _isLiteral(user):
+        return ('user', ircutils.toLower(user))
+    return ('fallback', None)
+
+
+_SHARDS = 64
+_NO_SHARD = {}
+
+class CowDict(Mapping):
+    """Mapping split by key hash into _SHARDS dicts, so that a copy can
+    share the shards it does not change.
+
+    copy() only copies the list of shards, and whichever of the two then
+    changes a shard clones it first: changing one key of a copy costs
+    O(len / _SHARDS) instead of O(len), and the original stays as it was.
+    Like a dict, it iterates in insertion order."""
+
+    def __init__(self, items=()):
+        items = dict(items)
+        shards = [{} for i in range(_SHARDS)]
+        for (n, (key, value)) in enumerate(items.items()):
+            shards[hash(key) % _SHARDS][key] = (n, value)
+        # {key: (insertion number, value)} shards
+        self._shards = [shard or _NO_SHARD for shard in shards]
+        # Shards this instance cloned or created and may change in place
+        self._owned = {i for (i, shard) in enumerate(shards) if shard}
+        self._len = self._next = len(items)
+
+    def copy(self):
+        new = self.__class__.__new__(self.__class__)
+        new._shards = list(self._shards)
+        new._owned = set()
+        new._len = self._len
+        new._next = self._next
+        # Both now share every shard.
+        self._owned = set()
+        return new
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for (key, item) in heapq.merge(*[shard.items()
+                                         for shard in self._shards if shard],
+                                       key=lambda pair: pair[1][0]):
+            yield key
+
+    def __getitem__(self, key):
+        return self._shards[hash(key) % _SHARDS][key][1]
+
+    def __contains__(self, key):
+        return key in self._shards[hash(key) % _SHARDS]
+
+    def get(self, key, default=None):
+        item = self._shards[hash(key) % _SHARDS].get(key)
+        return default if item is None else item[1]
+
+    def _own(self, key):
+        i = hash(key) % _SHARDS
+        if i not in self._owned:
+            self._shards[i] = dict(self._shards[i])
+            self._owned.add(i)
+        return self._shards[i]
+
+    def __setitem__(self, key, value):
+        shard = self._own(key)
+        item = shard.get(key)
+        if item is None:
+            shard[key] = (self._next, value)
+            self._next += 1
+            self._len += 1
+        else:
+            shard[key] = (item[0], value)
+
+    def __delitem__(self, key):
+        del self._own(key)[key]
+        self._len -= 1
+
+    def pop(self, key, default=None):
+        if key not in self:
+            return default
+        value = self._own(key).pop(key)[1]
+        self._len -= 1
+        return value
+
+
+class MaskIndex(object):
+    """Index of a channel's ban masks, bucketed by what they require of the
+    joining host so that a JOIN only runs the patterns that could match it.
+
+    Buckets hold masks in insertion order, so match() returns the same mask
+    a linear scan of the channel's entries would have found first.
+
+    Buckets are tuples that add() and discard() replace rather than modify,
+    held in CowDicts, so a copy shares everything add() and discard() don't
+    touch: it can be changed while other threads keep matching against the
+    original."""
+
+    def __init__(self, masks=()):
+        self._seq = {}
+        self._next = 0
+        self._buckets = {'exact': {}, 'suffix': {}, 'prefix': {},
+                         'user': {}, 'account': {}}
+        self._cidr = PrefixTree()
+        self._fallback = ()
+        self._compiled = {}
+        for mask in masks:
+            self.add(mask)
+        # Filled as plain dicts, which is faster, then made shareable.
+        self._seq = CowDict(self._seq)
+        self._buckets = {name: CowDict(bucket)
+                         for (name, bucket) in self._buckets.items()}
+
+    def copy(self):
+        new = MaskIndex.__new__(MaskIndex)
+        new._seq = self._seq.copy()
+        new._next = self._next
+        new._buckets = {name: bucket.copy()
+                        for (name, bucket) in self._buckets.items()}
+        new._cidr = self._cidr.copy()
+        new._fallback = self._fallback
+        # Compiled patterns are shared by every copy; discard() drops those
+        # of removed masks, and _compile() empties the cache if older copies
+        # still in use filled it with too many of them again.
+        new._compiled = self._compiled
+        return new
+
+    def __len__(self):
+        return len(self._seq)
+
+    def __contains__(self, mask):
+        return mask in self._seq
+
+    def add(self, mask):
+        if mask in self._seq:
+            return
+        self._seq[mask] = self._next
+        self._next += 1
+        (bucket, key) = classify(mask)
+        if bucket == 'fallback':
+            self._fallback += (mask,)
+        elif bucket == 'cidr':
+            self._cidr.add(key, mask)
+        else:
+            bucket = self._buckets[bucket]
+            bucket[key] = bucket.get(key, ()) + (mask,)
+
+    def discard(self, mask):
+        if self._seq.pop(mask, None) is None:
+            return
+        self._compiled.pop(mask, None)
+        (bucket, key) = classify(mask)
+        if bucket == 'fallback':
+            self._fallback = tuple(m for m in self._fallback if m != mask)
+        elif bucket == 'cidr':
+            self._cidr.discard(key, mask)
+        else:
+            bucket = self._buckets[bucket]
+            masks = tuple(m for m in bucket[key] if m != mask)
+            if masks:
+                bucket[key] = masks
+            else:
+                del bucket[key]
+
+    def _compile(self, mask):
+        extban = parseExtban(mask)
+        if extban is not None:
+            matcher = _compileExtban(*extban)
+        elif classify(mask)[0] == 'cidr':
+            matcher = _compileCidr(mask)
+        else:
+            pattern = _compilePattern(mask)
+            matcher = lambda hostmask, account, realname: \
+                pattern(hostmask) is not None
+        if len(self._compiled) > 2 * len(self._seq) + _SHARDS:
+            self._compiled.clear()
+        self._compiled[mask] = matcher
+        return matcher
+
+    def _first(self, masks, hostmask, account, realname, best):
+        """Returns the first mask of the bucket matching the user, unless it
+        was inserted after best."""
+        for mask in masks:
+            if best is not None and self._seq[mask] > self._seq[best]:
+                return best
+            matcher = self._compiled.get(mask) or self._compile(mask)
+            if matcher(hostmask, account, realname):
+                return mask
+        return best
+
+    def match(self, hostmask, account=None, realname=None):
+        """Returns the earliest added mask matching the user, or None.
+
+        account is the user's account name, '' if they are known to be
+        logged out, or None if that is unknown; realname is None if it is
+        unknown. Extbans that depend on unknown data don't match."""
+        best = None
+        candidates = []
+        if account:
+            candidates.append(
+                self._buckets['account'].get(ircutils.toLower(account)))
+        parts = _splitMask(hostmask)
+        if parts is not None:
+            (nick, user, host) = parts
+            host = ircutils.toLower(host)
+            candidates.append(self._buckets['exact'].get(host))
+            candidates.append(self._buckets['user'].get(ircutils.toLower(user)))
+            suffixes = self._buckets['suffix']
+            if suffixes:
+                i = host.find('.')
+                while i != -1:
+                    candidates.append(suffixes.get(host[i:]))
+                    i = host.find('.', i + 1)
+            prefixes = self._buckets['prefix']
+            if prefixes:
+                for (i, c) in enumerate(host):
+                    if c in '.:':
+                        candidates.append(prefixes.get(host[:i + 1]))
+            if self._cidr:
+                address = parseAddress(host)
+                if address is not None:
+                    candidates.extend(self._cidr.lookup(address))
+        for masks in candidates:
+            if masks:
+                best = self._first(masks, hostmask, account, realname, best)
+        return self._first(self._fallback, hostmask, account, realname, best)
+
+
+class BanList(CowDict):
+    """One channel's {mask: entry} blacklist, with its MaskIndex and its
+    ban ID -> mask map.
+
+    A BanList is never modified once published: writers build a changed
+    copy with replace() and swap it in, so readers can keep using whichever
+    BanList they fetched without taking a lock. The copy shares whatever
+    the change leaves alone, so replace() costs about the same whatever the
+    size of the list."""
+
+    def __init__(self, entries=()):
+        entries = dict(entries)
+        super().__init__(entries)
+        self.index = MaskIndex(entries)
+        self.ids = CowDict({entry[5]: mask
+                            for (mask, entry) in entries.items()})
+
+    def replace(self, add=(), remove=()):
+        """Returns a copy with the masks in remove deleted and the
+        (mask, entry) pairs in add set."""
+        new = self.copy()
+        new.index = self.index.copy()
+        new.ids = self.ids.copy()
+        for mask in remove:
+            entry = new.pop(mask, None)
+            if entry is not None:
+                new.index.discard(mask)
+                del new.ids[entry[5]]
+        for (mask, entry) in add:
+            old = new.get(mask)
+            if old is not None:
+                del new.ids[old[5]]
+            new[mask] = entry
+            new.index.add(mask)
+            new.ids[entry[5]] = mask
+        return new
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
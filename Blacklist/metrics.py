@@ -0,0 +1,88 @@
+import bisect
+import threading
+
+# Upper bounds, in microseconds, of the join-evaluation latency buckets; the
+# last bucket takes everything slower.
+LATENCY_BOUNDS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Metrics(object):
+    """Per-mask hit counters and per-channel join-evaluation latency
+    histograms, kept in memory. Hits recorded since the last drainHits()
+    are handed back so the caller can write them to the store in one go."""
+
+    def __init__(self, hits=None):
+        self._lock = threading.Lock()
+        # {channel: {mask: [count, last_hit]}}
+        self.hits = hits or {}
+        self._pending = {}
+        # {channel: [count per bucket]}
+        self.latency = {}
+        # Whether anything was recorded since the owner last cleared it
+        self.changed = False
+
+    def recordHit(self, channel, mask, now):
+        with self._lock:
+            total = self.hits.setdefault(channel, {}).setdefault(mask, [0, None])
+            total[0] += 1
+            total[1] = now
+            pending = self._pending.setdefault((channel, mask), [0, None])
+            pending[0] += 1
+            pending[1] = now
+            self.changed = True
+
+    def recordLatency(self, channel, seconds):
+        bucket = bisect.bisect_left(LATENCY_BOUNDS, seconds * 1e6)
+        with self._lock:
+            counts = self.latency.get(channel)
+            if counts is None:
+                counts = self.latency[channel] = [0] * (len(LATENCY_BOUNDS) + 1)
+            counts[bucket] += 1
+            self.changed = True
+
+    def drainHits(self):
+        """Returns the hits recorded since the last call, as
+        (channel, mask, count, last_hit) rows."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return [(channel, mask, count, last_hit)
+                for ((channel, mask), (count, last_hit)) in pending.items()]
+
+    def forget(self, channel, masks):
+        with self._lock:
+            hits = self.hits.get(channel, {})
+            for mask in masks:
+                hits.pop(mask, None)
+                self._pending.pop((channel, mask), None)
+
+    @staticmethod
+    def percentile(counts, fraction):
+        """Returns the upper bound, in microseconds, of the bucket holding
+        the given fraction of the samples in counts, or None if the sample
+        falls in the last, unbounded bucket."""
+        target = sum(counts) * fraction
+        seen = 0
+        for (bound, count) in zip(LATENCY_BOUNDS, counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+    def dump(self, channels):
+        """Returns {channel: {'hits': ..., 'latency': ...}} for channels,
+        given as {channel: masks}, ready to be written as JSON."""
+        with self._lock:
+            out = {}
+            for (channel, masks) in channels.items():
+                hits = self.hits.get(channel, {})
+                counts = self.latency.get(channel, [0] * (len(LATENCY_BOUNDS) + 1))
+                out[channel] = {
+                    'hits': {mask: {'count': hits[mask][0] if mask in hits else 0,
+                                    'last_hit': hits[mask][1] if mask in hits else None}
+                             for mask in masks},
+                    'latency': {'bounds_us': list(LATENCY_BOUNDS),
+                                'counts': list(counts)},
+                }
+            return out
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from supybot import ircmsgs, ircutils, schedule
+
+# Bytes of "MODE #channel +bbbb" we keep free for the server-added prefix.
+_LINE_BUDGET = 400
+
+
+class ModeBatcher(object):
+    """Coalesces +b/-b changes per (network, channel) for delay() seconds,
+    then sends them packed into as few MODE lines as the server's ISUPPORT
+    MODES= allows. Messages passed as `after` (e.g. KICKs that must follow
+    the ban) are sent once the channel's MODE lines are out."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def queue(self, irc, channel, mode, mask, after=()):
+        key = (irc, ircutils.toLower(channel))
+        delay = self.delay()
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = (channel, [], set(), [])
+                if delay > 0:
+                    schedule.addEvent(self.flush, time.time() + delay,
+                                      args=(key,))
+            (_, changes, seen, followups) = batch
+            if (mode, mask) not in seen:
+                seen.add((mode, mask))
+                changes.append((mode, mask))
+            followups.extend(after)
+        if delay <= 0:
+            self.flush(key)
+
+    def ban(self, irc, channel, mask, after=()):
+        self.queue(irc, channel, '+b', mask, after)
+
+    def unban(self, irc, channel, mask, after=()):
+        self.queue(irc, channel, '-b', mask, after)
+
+    def flush(self, key=None):
+        """Sends the pending changes for key, or for every channel."""
+        with self._lock:
+            if key is None:
+                batches = list(self._pending.items())
+                self._pending.clear()
+            elif key in self._pending:
+                batches = [(key, self._pending.pop(key))]
+            else:
+                batches = []
+        for ((irc, _), (channel, changes, _, followups)) in batches:
+            for msg in self.pack(irc, channel, changes):
+                irc.queueMsg(msg)
+            for msg in followups:
+                irc.queueMsg(msg)
+
+    @staticmethod
+    def modesPerLine(irc):
+        # MODES without a value means no limit; not advertising it means 3.
+        limit = irc.state.supported.get('modes', 3)
+        return limit if limit else None
+
+    @staticmethod
+    def targetsPerCommand(irc, command):
+        # TARGMAX=KICK:4,... ; an empty limit means none. Servers that don't
+        # list the command only promise one target.
+        targmax = irc.state.supported.get('targmax')
+        for item in (targmax or '').split(','):
+            (name, _, limit) = item.partition(':')
+            if name.upper() == command:
+                return int(limit) if limit else None
+        return 1
+
+    @classmethod
+    def kicks(cls, irc, channel, targets):
+        """Returns KICK messages for the (nick, reason) pairs in targets,
+        one per reason with as many nicks as TARGMAX= allows."""
+        limit = cls.targetsPerCommand(irc, 'KICK')
+        by_reason = {}
+        for (nick, reason) in targets:
+            by_reason.setdefault(reason, []).append(nick)
+        msgs = []
+        for (reason, nicks) in by_reason.items():
+            chunk = []
+            size = len(channel) + len(reason)
+            for nick in nicks:
+                if chunk and (len(chunk) == limit or
+                              size + len(nick) + 1 > _LINE_BUDGET):
+                    msgs.append(ircmsgs.kicks(channel, chunk, reason))
+                    chunk = []
+                    size = len(channel) + len(reason)
+                chunk.append(nick)
+                size += len(nick) + 1
+            msgs.append(ircmsgs.kicks(channel, chunk, reason))
+        return msgs
+
+    @classmethod
+    def pack(cls, irc, channel, changes):
+        """Returns MODE messages carrying changes, at most MODES= changes and
+        roughly _LINE_BUDGET bytes each."""
+        limit = cls.modesPerLine(irc)
+        msgs = []
+        chunk = []
+        size = len(channel)
+        for (mode, mask) in changes:
+            if chunk and (len(chunk) == limit or
+                          size + len(mask) + 3 > _LINE_BUDGET):
+                msgs.append(ircmsgs.modes(channel, chunk))
+                chunk = []
+                size = len(channel)
+            chunk.append((mode, mask))
+            size += len(mask) + 3
+        if chunk:
+            msgs.append(ircmsgs.modes(channel, chunk))
+        return msgs
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
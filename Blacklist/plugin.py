@@ -4,10 +4,21 @@ import time
 import threading
 import re
 import logging
+import concurrent.futures
+import datetime
 import urllib.request
 import urllib.parse
 from supybot.commands import *
-from supybot import callbacks, conf, ircmsgs, ircutils, schedule
+from supybot import callbacks, conf, ircmsgs, ircutils, schedule, world
+
+from .audit import AuditLog
+from .flood import JoinFlood
+from .masks import banMask
+from .matcher import BanList, MaskIndex, parseExtban
+from .metrics import Metrics
+from .modes import ModeBatcher
+from .storage import JournalStore, SqliteStore
+from .wheel import TimingWheel
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -17,6 +28,9 @@ except ImportError:
 
 logger = logging.getLogger('supybot.plugins.Blacklist')
 
+# Returned for keys without bans; like every BanList, never modified
+_EMPTY = BanList()
+
 class Blacklist(callbacks.Plugin):
     """Manages channel security with a numbered blacklist and ID-based deletion."""
     
@@ -24,7 +38,7 @@ class Blacklist(callbacks.Plugin):
         0: '*!ident@host', 1: '*!*ident@host', 2: '*!*@host',
         3: '*!*ident@*.phost', 4: '*!*@*.phost', 5: 'nick!ident@host',
         6: 'nick!*ident@host', 7: 'nick!*@host', 8: 'nick!*ident@*.phost',
-        9: 'nick!*@*.phost', 10: '*!ident@*'
+        9: 'nick!*@*.phost', 10: '*!ident@*', 11: '$a:account'
     }
     
     threaded = True
@@ -33,96 +47,692 @@ class Blacklist(callbacks.Plugin):
         super().__init__(irc)
         self.dbfile = os.path.join(str(conf.supybot.directories.data), 'Blacklist', 'blacklist.json')
         self._db_lock = threading.RLock()
+        # {channel: BanList}; a channel's BanList is replaced, never modified
         self.db = {}
+        self._next_ids = {}
+        self._generations = {}
+        self._banlists = {}
+        self._reconciled = {}
+        self._paste_lock = threading.Lock()
+        self._paste_cache = {}
+        self._paste_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        if self.registryValue('storageBackend') == 'sqlite':
+            path = self.registryValue('sqlitePath') or os.path.join(os.path.dirname(self.dbfile),
+                                                                    'blacklist.sqlite3')
+            self._store = SqliteStore(path, importFrom=self.dbfile)
+            self._audit = AuditLog(path)
+        else:
+            self._store = JournalStore(self.dbfile, self.registryValue('journalCompactThreshold'))
+            self._audit = AuditLog(os.path.join(os.path.dirname(self.dbfile), 'audit.sqlite3'))
+        self._wheel = TimingWheel(self.registryValue('expiryTickInterval'), time.time())
+        self._modes = ModeBatcher(self.registryValue('modeFlushDelay', value=False))
+        self._flood = JoinFlood()
+        self._flood_events = set()
+        self._metrics = Metrics()
+        # {key: last use} of the loaded partitions with lazyLoad; None when
+        # the whole DB is loaded
+        self._used = None
+        # Set when the DB could not be read; the files are then never
+        # overwritten
+        self._load_failed = False
         self._initdb()
+        schedule.addPeriodicEvent(self._dbSync, self.registryValue('journalSyncInterval'),
+                                  name='Blacklist_sync', now=False)
+        schedule.addPeriodicEvent(self._expiryTick, self.registryValue('expiryTickInterval'),
+                                  name='Blacklist_expiry', now=False)
+        schedule.addPeriodicEvent(self._reconcileTick, 60, name='Blacklist_reconcile', now=False)
+        schedule.addPeriodicEvent(self._metricsFlush, self.registryValue('metricsFlushInterval'),
+                                  name='Blacklist_metrics', now=False)
+        # Só a store SQLite é partilhada por outros processos
+        if isinstance(self._store, SqliteStore) and self.registryValue('sharedPollInterval'):
+            schedule.addPeriodicEvent(self._pollStore, self.registryValue('sharedPollInterval'),
+                                      name='Blacklist_poll', now=False)
+        if self._used is not None:
+            schedule.addPeriodicEvent(self._evictIdle, 60, name='Blacklist_evict', now=False)
+
+    def die(self):
+        names = {'Blacklist_sync', 'Blacklist_expiry', 'Blacklist_reconcile',
+                 'Blacklist_metrics', 'Blacklist_poll', 'Blacklist_evict'} | self._flood_events
+        for name in names:
+            try:
+                schedule.removeEvent(name)
+            except KeyError:
+                pass
+        self._modes.flush()
+        self._paste_pool.shutdown(wait=False)
+        self._metricsFlush()
+        with self._db_lock:
+            self._dbWrite()
+            self._store.close()
+            self._audit.close()
+        super().die()
 
     def _initdb(self):
         try:
             if not os.path.exists(os.path.dirname(self.dbfile)):
                 os.makedirs(os.path.dirname(self.dbfile))
-            if os.path.exists(self.dbfile):
-                with open(self.dbfile, 'r') as f:
-                    self.db = json.load(f)
+            if self.registryValue('lazyLoad') and isinstance(self._store, SqliteStore):
+                self._store.open()
+                self._used = {}
+                # As expirações têm de correr mesmo em canais ainda não carregados
+                since = time.time() - self.registryValue('banlistExpiry') * 60
+                for c_lower, mask, entry in self._store.pending(since):
+                    self._scheduleExpiry(c_lower, mask, entry)
             else:
+                self._setDb(self._store.load())
+            self._metrics = Metrics(self._store.loadHits())
+            if self._audit.open():
+                # Um registo novo começa com os bans que já existem
+                self._audit.seed(self.db if self._used is None else self._store.load())
+            if self._store.needsCompaction():
                 self._dbWrite()
         except Exception as e:
-            logger.error(f"Error loading DB: {e}")
+            self._load_failed = True
+            logger.error(f"Error loading DB, it will not be written: {e}")
+
+    def _setDb(self, db):
+        """Publishes db, as {channel: {mask: entry}}, in place of the whole
+        DB and schedules its expiries."""
+        for c_lower, banlist in self.db.items():
+            for mask in banlist:
+                if mask not in db.get(c_lower, {}):
+                    self._wheel.cancel((c_lower, mask))
+        for c_lower, masks in db.items():
+            self._assignIds(c_lower, masks)
+            for mask, entry in masks.items():
+                self._scheduleExpiry(c_lower, mask, entry)
+            self._generations[c_lower] = self._generations.get(c_lower, 0) + 1
+        self.db = {c_lower: BanList(masks) for c_lower, masks in db.items()}
+
+    def _pollStore(self):
+        """Periodic event: applies the changes other bot processes sharing
+        the store have made. Only the changed masks are fetched; the whole
+        DB is loaded again only if changes were pruned before being seen."""
+        with self._db_lock:
+            try:
+                changes = self._store.poll()
+                if changes is None:
+                    logger.warning("Missed changes made by other processes, reloading the DB")
+                    if self._used is None:
+                        self._setDb(self._store.load())
+                    else:
+                        self._evict(list(self.db))
+                    return
+            except Exception as e:
+                logger.error(f"Error polling DB: {e}")
+                return
+            # Só conta a última alteração de cada máscara
+            by_channel = {}
+            for op, c_lower, mask, entry in changes:
+                by_channel.setdefault(c_lower, {})[mask] = entry
+            for c_lower, masks in by_channel.items():
+                if self._used is not None and c_lower not in self.db:
+                    # Será lido já atualizado quando for preciso
+                    continue
+                add = [(mask, entry) for mask, entry in masks.items() if entry is not None]
+                remove = [mask for mask, entry in masks.items() if entry is None]
+                self._publish(c_lower, add=add, remove=remove)
+                for mask in remove:
+                    self._wheel.cancel((c_lower, mask))
+                self._metrics.forget(c_lower, remove)
+                for mask, entry in add:
+                    self._scheduleExpiry(c_lower, mask, entry)
+                    if entry[5]:
+                        self._next_ids[c_lower] = max(self._next_ids.get(c_lower, 1), entry[5] + 1)
+
+    def _assignIds(self, c_lower, masks):
+        """Sets the channel's next ban ID. Entries stored before IDs existed
+        are numbered after the highest known ID, in list order (so a DB that
+        had none keeps the numbers list used to show), and saved."""
+        next_id = max((entry[5] for entry in masks.values() if len(entry) > 5 and entry[5]),
+                      default=0) + 1
+        for mask, entry in masks.items():
+            if not (len(entry) > 5 and entry[5]):
+                entry[len(entry):] = [False, None, None][len(entry) - 3:]
+                entry[5] = next_id
+                # A store SQLite pode dar outro, se um processo já usou este
+                entry[5] = self._dbAppend('add', c_lower, mask, entry) or next_id
+                next_id = max(next_id, entry[5]) + 1
+        self._next_ids[c_lower] = next_id
+
+    def _partition(self, key):
+        """Returns the BanList of a DB key (a channel or '@group'), empty if
+        it has no bans. With lazyLoad, the key's bans are read from the store
+        the first time they are needed, and the use is noted for _evictIdle."""
+        if self._used is None:
+            return self.db.get(key) or _EMPTY
+        self._used[key] = time.time()
+        # Sem lock: uma partição carregada está sempre em self.db, mesmo vazia
+        banlist = self.db.get(key)
+        if banlist is None:
+            with self._db_lock:
+                banlist = self.db.get(key)
+                if banlist is None:
+                    try:
+                        masks = self._store.loadChannel(key)
+                    except Exception as e:
+                        logger.error(f"Error loading bans of {key}: {e}")
+                        return _EMPTY
+                    self._assignIds(key, masks)
+                    for mask, entry in masks.items():
+                        self._scheduleExpiry(key, mask, entry)
+                    banlist = self.db[key] = BanList(masks)
+                    self._generations[key] = self._generations.get(key, 0) + 1
+        return banlist
+
+    def _evict(self, keys):
+        """Drops the keys' partitions from memory. Their expiries stay on the
+        wheel and load them again when they fall due. Needs _db_lock."""
+        for key in keys:
+            self.db.pop(key, None)
+            self._used.pop(key, None)
+            self._next_ids.pop(key, None)
+
+    def _evictIdle(self):
+        """Periodic event: drops the partitions unused for idleChannelExpiry
+        minutes."""
+        expiry = self.registryValue('idleChannelExpiry')
+        if not expiry:
+            return
+        cutoff = time.time() - expiry * 60
+        with self._db_lock:
+            idle = [key for key, used in list(self._used.items()) if used < cutoff]
+            self._evict(idle)
+        if idle:
+            logger.debug(f"Dropped {len(idle)} idle ban lists from memory")
 
     def _dbWrite(self):
+        """Writes a full snapshot of the DB and empties the journal."""
+        if self._load_failed:
+            return
         with self._db_lock:
             try:
-                with open(self.dbfile, 'w') as f:
-                    json.dump(self.db, f, indent=2)
+                self._store.compact(self.db)
             except Exception as e:
                 logger.error(f"Error writing DB: {e}")
 
+    def _dbSync(self):
+        """Periodic event: fsyncs the journal, compacting it once it grows past
+        journalCompactThreshold records."""
+        with self._db_lock:
+            try:
+                if self._store.needsCompaction() and not self._load_failed:
+                    self._store.compact(self.db)
+                else:
+                    self._store.sync()
+            except Exception as e:
+                logger.error(f"Error syncing DB: {e}")
+
+    def _metricsFlush(self):
+        """Periodic event: adds the hits counted since the last flush to the
+        store and rewrites the metrics dump file if anything changed."""
+        rows = self._metrics.drainHits()
+        if rows:
+            with self._db_lock:
+                try:
+                    self._store.addHits(rows)
+                except Exception as e:
+                    logger.error(f"Error writing hit counters: {e}")
+        if not self._metrics.changed:
+            return
+        self._metrics.changed = False
+        dump = self._metrics.dump({c_lower: [*masks] for c_lower, masks in self.db.items()})
+        path = os.path.join(os.path.dirname(self.dbfile), 'metrics.json')
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'time': time.time(), 'channels': dump}, f)
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            logger.error(f"Error writing metrics dump: {e}")
+
+    def _lookupLists(self, irc, channel):
+        """Returns the (key, BanList) pairs a join to channel is checked
+        against: the channel's own, then those of the groups it subscribes to."""
+        keys = [channel.lower()]
+        keys.extend('@' + group.lower() for group in self.registryValue('groups', channel, irc.network))
+        banlists = [(key, self._partition(key)) for key in keys]
+        return [(key, bans) for key, bans in banlists if bans]
+
+    @staticmethod
+    def _accountOf(irc, nick):
+        """Returns nick's services account, '' if they are known to be logged
+        out, or None if we don't know (no extended-join, account-notify,
+        account-tag or WHOX data)."""
+        if nick not in irc.state.nicksToAccounts:
+            return None
+        return irc.state.nicksToAccounts[nick] or ''
+
+    def _match(self, c_lower, banlists, hostmask, account=None, realname=None):
+        """Returns the (mask, entry) of the first ban in banlists matching
+        the user, or None, counting the hit and the time the lookup took."""
+        started = time.perf_counter()
+        found = None
+        for key, bans in banlists:
+            mask = bans.index.match(hostmask, account, realname)
+            if mask is not None:
+                found = (key, mask, bans[mask])
+                break
+        self._metrics.recordLatency(c_lower, time.perf_counter() - started)
+        if found is None:
+            return None
+        (key, mask, entry) = found
+        # Os acertos de um grupo contam para o grupo
+        self._metrics.recordHit(key, mask, time.time())
+        return (mask, entry)
+
+    def _targets(self, key):
+        """Yields the (irc, channel) pairs a DB key's bans apply to: the
+        channel itself on every network the bot is in it, or for a group
+        ('@name'), every channel subscribing to it."""
+        for irc in world.ircs:
+            if not key.startswith('@'):
+                if key in irc.state.channels:
+                    yield (irc, key)
+                continue
+            for channel in irc.state.channels:
+                groups = self.registryValue('groups', channel, irc.network)
+                if key[1:] in (group.lower() for group in groups):
+                    yield (irc, channel)
+
+    def _record(self, op, c_lower, items, actor=None):
+        """Appends op events for the (mask, entry) items to the audit log."""
+        try:
+            self._audit.record(time.time(), c_lower, op, items, actor)
+        except Exception as e:
+            logger.error(f"Error writing audit log: {e}")
+
+    def _dbAppend(self, op, channel, mask, entry=None):
+        """Records a single add/del in the journal. For an add, returns the
+        ban ID the store kept, or None if it could not be written."""
+        try:
+            if op == 'add':
+                return self._store.add(channel, mask, entry)
+            else:
+                self._store.delete(channel, mask)
+        except Exception as e:
+            logger.error(f"Error writing DB: {e}")
+
+    def _reconcileTick(self):
+        """Periodic event: requests the ban list of every channel whose
+        reconcileInterval has elapsed since it was last reconciled."""
+        now = time.time()
+        for irc in world.ircs:
+            for channel in list(irc.state.channels):
+                interval = self.registryValue('reconcileInterval', channel, irc.network)
+                key = (irc.network, ircutils.toLower(channel))
+                if interval > 0 and now - self._reconciled.get(key, 0) >= interval * 60:
+                    self._requestBanlist(irc, channel)
+
+    def _requestBanlist(self, irc, channel, replyIrc=None, send=True):
+        """Starts collecting RPL_BANLIST for channel; _reconcile runs when
+        RPL_ENDOFBANLIST arrives. With send=False, waits for a list that was
+        already requested (the one the bot asks for when joining)."""
+        key = (irc.network, ircutils.toLower(channel))
+        self._banlists[key] = ([], replyIrc)
+        self._reconciled[key] = time.time()
+        if send:
+            irc.queueMsg(ircmsgs.mode(channel, '+b'))
+
+    def do367(self, irc, msg):
+        pending = self._banlists.get((irc.network, ircutils.toLower(msg.args[1])))
+        if pending is not None:
+            setter = msg.args[3] if len(msg.args) > 3 else ''
+            pending[0].append((msg.args[2], ircutils.nickFromHostmask(setter) if '!' in setter else setter))
+
+    def do368(self, irc, msg):
+        pending = self._banlists.pop((irc.network, ircutils.toLower(msg.args[1])), None)
+        if pending is not None:
+            (bans, replyIrc) = pending
+            summary = self._reconcile(irc, msg.args[1], bans)
+            if replyIrc is not None:
+                replyIrc.reply(summary)
+
+    def _reconcile(self, irc, channel, server_bans):
+        """Brings the DB and the channel's +b list back in line, as doMode would
+        have if the bot had seen every change:
+        - bans on the server but not in the DB are added as manual bans
+          (if addManualBans is on);
+        - manual bans in the DB but gone from the server are removed;
+        - bot bans that should still be set (timed, or within banlistExpiry)
+          are set again;
+        - bot bans whose IRC cleanup was missed are lifted.
+        Returns a one-line summary."""
+        c_lower = channel.lower()
+        entries = self._partition(c_lower)
+        with self._db_lock:
+            pending_cleanup = {mask for mask in entries if (c_lower, mask) in self._wheel}
+        on_server = {ircutils.toLower(mask): (mask, setter) for mask, setter in server_bans}
+        in_db = {ircutils.toLower(mask): mask for mask in entries}
+
+        # Os bans dos grupos subscritos não são bans manuais do canal
+        in_groups = {ircutils.toLower(mask) for key, bans in self._lookupLists(irc, channel)
+                     if key != c_lower for mask in bans}
+        unknown = [on_server[m] for m in on_server.keys() - in_db.keys() - in_groups]
+        reban, forget, lift = [], [], []
+        for lower, mask in in_db.items():
+            entry = entries[mask]
+            is_bot_cmd = entry[3] if len(entry) > 3 else False
+            expected = not is_bot_cmd or mask in pending_cleanup
+            if expected and lower not in on_server:
+                (reban if is_bot_cmd else forget).append(mask)
+            elif not expected and lower in on_server:
+                lift.append(on_server[lower][0])
+
+        added = {}
+        if unknown and self.registryValue('addManualBans', channel, irc.network):
+            expiry = self.registryValue('banlistExpiry', channel, irc.network)
+            expiry_at = time.time() + (expiry * 60) if expiry > 0 else None
+            added = self._internal_add_many(channel, [(mask, setter, "*manual ban", expiry_at)
+                                                      for mask, setter in unknown], is_bot_cmd=False)
+        self._internal_del_many(channel, forget, actor='*reconcile')
+
+        state = irc.state.channels.get(channel)
+        if state is not None and state.isHalfopPlus(irc.nick):
+            for mask in reban:
+                self._modes.ban(irc, channel, mask)
+            for mask in lift:
+                self._modes.unban(irc, channel, mask)
+            if lift:
+                self._record('lift', c_lower, [(mask, None) for mask in lift], '*reconcile')
+        else:
+            reban, lift = [], []
+
+        summary = (f"Reconciled {channel}: {len(added)} manual bans added, {len(forget)} removed, "
+                   f"{len(reban)} bans set again, {len(lift)} lifted.")
+        logger.info(summary)
+        return summary
+
+    def _listPath(self, filename):
+        """Returns the path of filename in the plugin's lists directory, or
+        None if it is not a plain file name."""
+        if not filename or os.path.basename(filename) != filename or filename.startswith('.'):
+            return None
+        directory = os.path.join(os.path.dirname(self.dbfile), 'lists')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return os.path.join(directory, filename)
+
+    def _enforce(self, irc, channel, entries, banAll=False):
+        """Bans and kicks the users present in channel matching any of the
+        {mask: entry} entries. With banAll, every mask is set, even those
+        nobody present matches."""
+        if channel not in irc.state.channels:
+            return
+        index = MaskIndex(entries)
+        kicks = {}
+        for nick in list(irc.state.channels[channel].users):
+            if ircutils.strEqual(nick, irc.nick):
+                continue
+            try:
+                hostmask = irc.state.nickToHostmask(nick)
+            except KeyError:
+                continue
+            mask = index.match(hostmask, self._accountOf(irc, nick))
+            if mask is not None:
+                reason = entries[mask][2] or self.registryValue('banReason', channel)
+                kicks.setdefault(mask, []).append(ircmsgs.kick(channel, nick, reason))
+        for mask in (entries if banAll else kicks):
+            self._modes.ban(irc, channel, mask, after=kicks.get(mask, ()))
+
     def _createMask(self, irc, target, num):
-        if ircutils.isUserHostmask(target): return target
+        if ircutils.isUserHostmask(target) or parseExtban(target): return target
         try:
             hostmask = irc.state.nickToHostmask(target)
-            nick, ident, host = ircutils.splitHostmask(hostmask)
-            template = self.banmasks.get(num, self.banmasks[2])
-            return template.replace("nick", nick).replace("ident", ident).replace("host", host)
-        except: return None
+        except KeyError:
+            return None
+        template = self.banmasks.get(num, self.banmasks[2])
+        if template == '$a:account':
+            # Sem conta conhecida, cai para o tipo 2
+            account = self._accountOf(irc, target)
+            if account:
+                return '$a:' + account
+            template = self.banmasks[2]
+        return banMask(hostmask, template)
 
-    def _createPastebin(self, channel, content):
-        """Uploads content to the configured paste service."""
+    def _createPastebin(self, channel, lines):
+        """Uploads the text made of the strings lines() yields to the
+        configured paste service. The request body is encoded and sent as it
+        is generated, so the text is never held whole in memory: lines() is
+        called twice, first to count the bytes for Content-Length."""
         try:
             api_url = self.registryValue('pastebinUrl', channel)
             field = self.registryValue('pastebinField', channel)
             boundary = '----SupybotBlacklist'
-            body = (
-                f'--{boundary}\r\n'
-                f'Content-Disposition: form-data; name="{field}"; filename="banlist.txt"\r\n'
-                f'Content-Type: text/plain\r\n\r\n'
-                + content +
-                f'\r\n--{boundary}--\r\n'
-            ).encode('utf-8')
-            req = urllib.request.Request(api_url, data=body, method='POST')
+            head = (f'--{boundary}\r\n'
+                    f'Content-Disposition: form-data; name="{field}"; filename="banlist.txt"\r\n'
+                    f'Content-Type: text/plain\r\n\r\n').encode('utf-8')
+            tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+            length = len(head) + sum(len(line.encode('utf-8')) for line in lines()) + len(tail)
+
+            def body():
+                yield head
+                # Em blocos, para não fazer um send() por linha
+                chunk, size = [], 0
+                for line in lines():
+                    chunk.append(line.encode('utf-8'))
+                    size += len(chunk[-1])
+                    if size >= 65536:
+                        yield b''.join(chunk)
+                        chunk, size = [], 0
+                yield b''.join(chunk) + tail
+
+            req = urllib.request.Request(api_url, data=body(), method='POST')
             req.add_header('Content-Type', f'multipart/form-data; boundary={boundary}')
+            req.add_header('Content-Length', str(length))
             with urllib.request.urlopen(req, timeout=10) as response:
                 return response.read().decode('utf-8').strip()
         except Exception as e:
             logger.error(f"Pastebin upload failed: {e}")
             return "Error: Pastebin service unavailable."
     
+    def _pastebinList(self, channel, entries, generation):
+        """Returns a future for the pastebin URL of the rendered ban list.
+        Uploads run on a small worker pool; the URL is reused while the
+        channel's DB generation is unchanged and pastebinCacheExpiry allows."""
+        c_lower = channel.lower()
+        ttl = self.registryValue('pastebinCacheExpiry', channel) * 60
+        with self._paste_lock:
+            cached = self._paste_cache.get(c_lower)
+            if cached and cached[0] == generation and time.time() - cached[2] < ttl:
+                return cached[1]
+            future = self._paste_pool.submit(self._uploadList, channel, entries)
+            self._paste_cache[c_lower] = (generation, future, time.time())
+
+        def forget_failure(f):
+            if f.exception() is not None or f.result().startswith("Error:"):
+                with self._paste_lock:
+                    if self._paste_cache.get(c_lower, (None, None))[1] is f:
+                        del self._paste_cache[c_lower]
+        future.add_done_callback(forget_failure)
+        return future
+
+    def _uploadList(self, channel, entries, at=None):
+        at = at or time.time()
+        return self._createPastebin(channel, lambda: self._renderList(channel, entries, at))
+
+    def _renderList(self, channel, entries, at=None):
+        """Yields the lines of the numbered ban list as of at (the current
+        time by default). Entries show absolute times rather than ages, so
+        that a paste reused by _pastebinList doesn't go out of date."""
+        at = at or time.time()
+        yield (f"Numbered Ban List for {channel} ({len(entries)} entries) "
+               f"as of {self._formatTime(at)}:\n" + "="*45 + "\n")
+        for m, data in entries:
+            yield self._formatEntry(m, data, at, absolute=True) + "\n"
+
+    @staticmethod
+    def _formatTime(t):
+        return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
+
+    def _formatEntry(self, m, data, now, absolute=False):
+        """Formats a ban for list. Times are given relative to now ("5m
+        ago", "[10m left]"), or as dates with absolute."""
+        ban_id = data[5]
+        adder = data[0]
+        created_at = data[1]
+        reason = data[2]
+        expiry_at = data[4] if len(data) > 4 else None
+
+        remaining_str = ""
+        if absolute:
+            added_str = f"added {self._formatTime(created_at)}"
+            if expiry_at:
+                remaining_str = f" [until {self._formatTime(expiry_at)}]"
+        else:
+            added_str = f"{int(now - created_at) // 60}m ago"
+            if expiry_at:
+                rem = int(expiry_at - now) // 60
+                if rem > 0:
+                    remaining_str = f" [{rem}m left]"
+                else:
+                    remaining_str = " [expiring...]"
+
+        # Lógica de exibição da razão:
+        # Oculta se for vazia, "Temporary ban" ou "*manual ban"
+        reason_display = ""
+        if reason and reason not in ["Temporary ban", "*manual ban", ""]:
+            reason_display = f": {reason}"
+        elif reason == "*manual ban":
+            reason_display = " [manual]"
+
+        return f"[{ban_id}] {m} ({added_str} by {adder}){remaining_str}{reason_display}"
+
+    def _publish(self, c_lower, add=(), remove=()):
+        """Swaps in a new BanList for the channel with the changes applied.
+        Readers holding the previous one are unaffected. Needs _db_lock."""
+        banlist = self._partition(c_lower).replace(add, remove)
+        if banlist or self._used is not None:
+            self.db[c_lower] = banlist
+        else:
+            self.db.pop(c_lower, None)
+        self._generations[c_lower] = self._generations.get(c_lower, 0) + 1
+
     def _internal_add(self, channel, mask, adder, reason, is_bot_cmd=False, expiry_at=None):
         """Grava na DB com a flag is_bot_cmd e o timestamp de expiração."""
         c_lower = channel.lower()
         with self._db_lock:
-            if c_lower not in self.db: self.db[c_lower] = {}
-            # Agora guardamos 5 elementos: adder, created_at, reason, is_bot_cmd, expiry_at
-            self.db[c_lower][mask] = [adder, time.time(), reason, is_bot_cmd, expiry_at]
-            self._dbWrite()
+            # Apanha os IDs dados por outros processos antes de atribuir um
+            self._pollStore()
+            # Uma máscara que já existe mantém o seu ID
+            old = self._partition(c_lower).get(mask)
+            if old is not None:
+                ban_id = old[5]
+            else:
+                ban_id = self._next_ids.get(c_lower, 1)
+            # Agora guardamos 6 elementos: adder, created_at, reason, is_bot_cmd, expiry_at, ban_id
+            entry = [adder, time.time(), reason, is_bot_cmd, expiry_at, ban_id]
+            # A store SQLite dá o ID na transação que grava o ban
+            entry[5] = self._dbAppend('add', c_lower, mask, entry) or ban_id
+            self._next_ids[c_lower] = max(self._next_ids.get(c_lower, 1), entry[5] + 1)
+            self._publish(c_lower, add=[(mask, entry)])
+            self._scheduleExpiry(c_lower, mask, entry)
+            self._record('add', c_lower, [(mask, entry)])
+
+    def _internal_add_many(self, channel, items, is_bot_cmd=True):
+        """Adds every (mask, adder, reason, expiry_at) in items that is not
+        already listed, with a single DB write. Returns the added entries as
+        {mask: entry}."""
+        c_lower = channel.lower()
+        now = time.time()
+        added = {}
+        with self._db_lock:
+            self._pollStore()
+            masks = self._partition(c_lower)
+            ban_id = self._next_ids.get(c_lower, 1)
+            for mask, adder, reason, expiry_at in items:
+                if mask in masks or mask in added:
+                    continue
+                added[mask] = [adder, now, reason, is_bot_cmd, expiry_at, ban_id]
+                ban_id += 1
+            if added:
+                try:
+                    ids = self._store.addMany(c_lower, list(added.items()))
+                    for entry, stored_id in zip(added.values(), ids):
+                        entry[5] = stored_id
+                        ban_id = max(ban_id, stored_id + 1)
+                except Exception as e:
+                    logger.error(f"Error writing DB: {e}")
+                self._publish(c_lower, add=added.items())
+                for mask, entry in added.items():
+                    self._scheduleExpiry(c_lower, mask, entry)
+                self._record('add', c_lower, list(added.items()))
+            self._next_ids[c_lower] = ban_id
+        return added
 
-    def _internal_del(self, channel, mask):
+    def _internal_del(self, channel, mask, actor=None):
         """Remove da DB com segurança."""
+        return bool(self._internal_del_many(channel, [mask], actor))
+
+    def _internal_del_many(self, channel, masks, actor=None, op='del'):
+        """Removes the listed masks with a single DB write. Returns the
+        masks that were actually in the DB. actor and op ('del' or 'expire')
+        go to the audit log."""
         c_lower = channel.lower()
+        if not masks:
+            return []
         with self._db_lock:
-            if c_lower in self.db and mask in self.db[c_lower]:
-                del self.db[c_lower][mask]
-                if not self.db[c_lower]:
-                    del self.db[c_lower]
-                self._dbWrite()
-                return True
-        return False
-        
-    def _timer_expire(self, irc, channel, mask, remove_from_db=True):
-        """Remove o ban do IRC. Remove da DB apenas se remove_from_db for True."""
-        if remove_from_db:
-            if self._internal_del(channel, mask):
-                logger.info(f"Full expiry: {mask} removed from IRC and DB in {channel}")
+            banlist = self._partition(c_lower)
+            removed = [mask for mask in dict.fromkeys(masks) if mask in banlist]
+            if removed:
+                self._publish(c_lower, remove=removed)
+                for mask in removed:
+                    self._wheel.cancel((c_lower, mask))
+                self._metrics.forget(c_lower, removed)
+                try:
+                    self._store.deleteMany(c_lower, removed)
+                except Exception as e:
+                    logger.error(f"Error writing DB: {e}")
+                self._record(op, c_lower, [(mask, None) for mask in removed], actor)
+        return removed
+
+    def _scheduleExpiry(self, c_lower, mask, entry):
+        """Puts the entry's pending expiry on the wheel: a full expiry (IRC and
+        DB) at expiry_at, or for bot bans without one, removal of the +b only
+        once banlistExpiry has passed since it was set."""
+        key = (c_lower, mask)
+        expiry_at = entry[4] if len(entry) > 4 else None
+        is_bot_cmd = entry[3] if len(entry) > 3 else False
+        if expiry_at:
+            self._wheel.schedule(key, expiry_at, True)
+            return
+        # Para um grupo ('@nome') vale o valor global
+        expiry = self.registryValue('banlistExpiry', c_lower)
+        cleanup_at = entry[1] + expiry * 60
+        if is_bot_cmd and expiry > 0 and cleanup_at > time.time():
+            self._wheel.schedule(key, cleanup_at, False)
         else:
-            logger.info(f"IRC cleanup: {mask} removed from IRC list but KEPT in bot DB for {channel}")
-        
-        irc.queueMsg(ircmsgs.unban(channel, mask))
+            self._wheel.cancel(key)
+
+    def _expiryTick(self):
+        """Periodic event: removes every ban whose deadline has passed. Bans
+        with remove_from_db set are deleted from the DB too; the others are
+        only lifted on IRC and KEPT in the bot DB."""
+        expired = {}
+        with self._db_lock:
+            for (c_lower, mask), remove_from_db in self._wheel.advance(time.time()):
+                expired.setdefault(c_lower, []).append((mask, remove_from_db))
+            for c_lower, items in expired.items():
+                self._internal_del_many(c_lower, [mask for mask, remove_from_db in items
+                                                  if remove_from_db], op='expire')
+                lifted = [(mask, None) for mask, remove_from_db in items if not remove_from_db]
+                if lifted:
+                    self._record('lift', c_lower, lifted)
+        for c_lower, items in expired.items():
+            removed = sum(1 for mask, remove_from_db in items if remove_from_db)
+            logger.info(f"Expiry: {len(items)} bans lifted in {c_lower}, {removed} of them removed from DB")
+            for irc, channel in self._targets(c_lower):
+                bans = irc.state.channels[channel].bans
+                for mask, remove_from_db in items:
+                    # Uma limpeza só-IRC de um +b que já não está na lista não faz nada
+                    if remove_from_db or mask in bans:
+                        self._modes.unban(irc, channel, mask)
 
     def bantype(self, irc, msg, args):
         """Lists available mask types."""
         m = [f"({k}) {v}" for k, v in self.banmasks.items()]
         irc.reply(" | ".join(m[0:4]))
         irc.reply(" | ".join(m[4:8]))
-        irc.reply(" | ".join(m[8:11]))
+        irc.reply(" | ".join(m[8:12]))
     bantype = wrap(bantype, ['admin'])
 
     def add(self, irc, msg, args, channel, target, reason):
@@ -141,49 +751,33 @@ class Blacklist(callbacks.Plugin):
         
         # Grava na DB como bot_cmd=True
         self._internal_add(channel, mask, msg.nick, reason, is_bot_cmd=True)
-        irc.queueMsg(ircmsgs.ban(channel, mask))
-        
+        kicks = []
         if not ircutils.isUserHostmask(target) and target in irc.state.channels[channel].users:
-            irc.queueMsg(ircmsgs.kick(channel, target, reason))
+            kicks.append(ircmsgs.kick(channel, target, reason))
+        self._modes.ban(irc, channel, mask, after=kicks)
 
-        # Agenda a limpeza do +b no IRC (usa expiry, e False para manter na DB)
-        expiry = self.registryValue('banlistExpiry', channel)
-        if expiry > 0:
-            schedule.addEvent(self._timer_expire, time.time() + (expiry * 60), 
-                             name=f"irc_cleanup_{channel}_{mask}", 
-                             args=(irc, channel, mask, False)) 
-            
+        # A limpeza do +b no IRC (após banlistExpiry) é agendada por _internal_add
         irc.replySuccess()
     add = wrap(add, [('checkChannelCapability', 'op'), 'channel', 'somethingWithoutSpaces', optional('text')])
 
     def delete(self, irc, msg, args, channel, target):
         """[<channel>] <mask|ID>
-        Removes a mask by its string or its ID number from the list.
+        Removes a mask by its string or by the ID shown in the list. IDs do not
+        change when other entries are removed.
         """
         c_lower = channel.lower()
         mask_to_del = None
 
         if target.isdigit():
-            idx = int(target)
-            with self._db_lock:
-                if c_lower in self.db:
-                    masks = list(self.db[c_lower].keys())
-                    if 1 <= idx <= len(masks):
-                        mask_to_del = masks[idx-1]
-                    else:
-                        irc.error(f"Invalid ID. Range is 1 to {len(masks)}.")
-                        return
+            mask_to_del = self._partition(c_lower).ids.get(int(target))
+            if mask_to_del is None:
+                irc.error(f"No ban with ID {target}.")
+                return
         else:
             mask_to_del = target
 
-        if mask_to_del and self._internal_del(channel, mask_to_del):
-            irc.queueMsg(ircmsgs.unban(channel, mask_to_del))
-            # Tenta remover TODOS os tipos de agendamento possíveis
-            for prefix in ['auto_unban', 'irc_cleanup', 'expire']:
-                try:
-                    schedule.removeEvent(f"{prefix}_{channel}_{mask_to_del}")
-                except KeyError:
-                    pass
+        if mask_to_del and self._internal_del(channel, mask_to_del, msg.nick):
+            self._modes.unban(irc, channel, mask_to_del)
             irc.replySuccess()
         else:
             irc.error(f"Ban not found for: {target}")
@@ -213,78 +807,267 @@ class Blacklist(callbacks.Plugin):
         
         # is_bot_cmd=True para o timer
         self._internal_add(channel, mask, msg.nick, db_reason, is_bot_cmd=True, expiry_at=expiry_at)
-        irc.queueMsg(ircmsgs.ban(channel, mask))
-        
-        # Kick imediato com a razão (vê "Temporary ban" se não escreveres nada)
+
+        # Kick logo a seguir ao +b, com a razão (vê "Temporary ban" se não escreveres nada)
+        kicks = []
         if not ircutils.isUserHostmask(target) and target in irc.state.channels[channel].users:
-            irc.queueMsg(ircmsgs.kick(channel, target, kick_reason))
-            
-        # Agenda a remoção TOTAL (IRC + DB)
-        schedule.addEvent(self._timer_expire, expiry_at, 
-                         name=f"auto_unban_{channel}_{mask}", 
-                         args=(irc, channel, mask, True)) # True = Apaga tudo no fim
-        
+            kicks.append(ircmsgs.kick(channel, target, kick_reason))
+        self._modes.ban(irc, channel, mask, after=kicks)
+
+        # A remoção TOTAL (IRC + DB) em expiry_at é agendada por _internal_add
         irc.replySuccess()
 
     timer = wrap(timer, [('checkChannelCapability', 'op'), 'channel', 'somethingWithoutSpaces', optional('positiveInt'), optional('text')])
         
+    def banimport(self, irc, msg, args, channel, filename):
+        """[<channel>] <file>
+        Adds the bans listed in <file>, in the plugin's lists directory, one per
+        line as <mask> TAB <adder> TAB <reason> TAB <expiry timestamp> (only the
+        mask is required). Masks already listed are skipped; users in the channel
+        matching an imported mask are banned and kicked.
+        """
+        path = self._listPath(filename)
+        if path is None:
+            irc.errorInvalid('file name', filename)
+            return
+        if not os.path.exists(path):
+            irc.error(f"No such file: {filename}")
+            return
+
+        items = []
+        bad = expired = 0
+        now = time.time()
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.split('\t') + ['', '', '']
+                mask, adder, reason, expiry = (s.strip() for s in fields[:4])
+                try:
+                    expiry_at = float(expiry) if expiry else None
+                except ValueError:
+                    bad += 1
+                    continue
+                if not mask or ' ' in mask:
+                    bad += 1
+                elif expiry_at is not None and expiry_at <= now:
+                    expired += 1
+                else:
+                    items.append((mask, adder or msg.nick, reason, expiry_at))
+
+        added = self._internal_add_many(channel, items)
+        self._enforce(irc, channel, added)
+        irc.reply(f"Imported {len(added)} bans into {channel} ({len(items) - len(added)} already listed, "
+                  f"{expired} expired, {bad} invalid lines).")
+    banimport = wrap(banimport, [('checkChannelCapability', 'op'), 'channel', 'somethingWithoutSpaces'])
+
+    def banexport(self, irc, msg, args, channel, filename):
+        """[<channel>] [<file>]
+        Writes the channel's blacklist to <file> in the plugin's lists directory,
+        in the format banimport reads. <file> defaults to <channel>.bans.
+        """
+        filename = filename or channel.lstrip('#&+!').replace('/', '_') + '.bans'
+        path = self._listPath(filename)
+        if path is None:
+            irc.errorInvalid('file name', filename)
+            return
+        entries = self._partition(channel.lower()).items()
+
+        def clean(s):
+            return str(s or '').replace('\t', ' ').replace('\n', ' ').replace('\r', ' ')
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write("# mask\tadder\treason\texpiry\n")
+            for mask, data in entries:
+                expiry_at = data[4] if len(data) > 4 else None
+                f.write('\t'.join((mask, clean(data[0]), clean(data[2]),
+                                   '%d' % expiry_at if expiry_at else '')) + '\n')
+        os.replace(tmp, path)
+        irc.reply(f"Exported {len(entries)} bans from {channel} to {path}.")
+    banexport = wrap(banexport, [('checkChannelCapability', 'op'), 'channel', optional('somethingWithoutSpaces')])
+
+    def reconcile(self, irc, msg, args, channel):
+        """[<channel>]
+        Fetches the channel's ban list from the server and brings the blacklist
+        and the +b list back in line with each other.
+        """
+        if channel not in irc.state.channels:
+            irc.error(f"I'm not in {channel}.")
+            return
+        self._requestBanlist(irc, channel, replyIrc=irc)
+    reconcile = wrap(reconcile, [('checkChannelCapability', 'op'), 'channel'])
+
     def stats(self, irc, msg, args, channel):
         """[<channel>]"""
         c_lower = channel.lower()
-        count = len(self.db.get(c_lower, {}))
+        count = len(self._partition(c_lower))
         irc.reply(f"Channel {channel} has {count} bans in the blacklist.")
     stats = wrap(stats, [('checkChannelCapability', 'op'), 'channel'])
 
+    def blstats(self, irc, msg, args, channel):
+        """[<channel>]
+        Shows how long checking a join against the blacklist takes, the masks
+        that matched most often and how many have never matched.
+        """
+        c_lower = channel.lower()
+        masks = self._partition(c_lower)
+        metrics = self._metrics.dump({c_lower: [*masks]})[c_lower]
+
+        counts = metrics['latency']['counts']
+        joins = sum(counts)
+        def bound(fraction):
+            us = Metrics.percentile(counts, fraction)
+            return f"<={us}µs" if us is not None else f">{metrics['latency']['bounds_us'][-1]}µs"
+        latency = f"{joins} joins checked" + (f", p50 {bound(0.5)}, p99 {bound(0.99)}" if joins else "")
+
+        hits = sorted(((hit['count'], mask) for mask, hit in metrics['hits'].items() if hit['count']),
+                      reverse=True)
+        top = ", ".join(f"{mask} ({count})" for count, mask in hits[:5]) or "none"
+        irc.reply(f"{channel}: {latency}. Top masks: {top}. "
+                  f"{len(masks) - len(hits)} of {len(masks)} masks never matched.")
+    blstats = wrap(blstats, [('checkChannelCapability', 'op'), 'channel'])
+
     def list(self, irc, msg, args, channel):
         """[<channel>]
         Lists all blacklisted masks with elapsed and remaining time.
         """
+        self._replyList(irc, channel)
+    list = wrap(list, [('checkChannelCapability', 'op'), 'channel'])
+
+    def _replyList(self, irc, channel):
+        """Replies with the ban list of channel (or group) inline, or as a
+        pastebin link once it has more than maxInlineEntries entries."""
         c_lower = channel.lower()
-        if c_lower not in self.db or not self.db[c_lower]:
+        # A geração é lida antes da lista: no pior caso a lista é mais nova
+        generation = self._generations.get(c_lower, 0)
+        entries = list(self._partition(c_lower).items())
+        if not entries:
             irc.reply("List is empty.")
             return
 
-        ban_count = len(self.db[c_lower])
+        ban_count = len(entries)
         max_inline = self.registryValue('maxInlineEntries', channel) or 5
-        output_list = []
-        full_text = f"Numbered Ban List for {channel} ({ban_count} entries):\n" + "="*45 + "\n"
-        now = time.time()
-        
-        for i, (m, data) in enumerate(self.db[c_lower].items(), 1):
-            adder = data[0]
-            created_at = data[1]
-            reason = data[2]
-            expiry_at = data[4] if len(data) > 4 else None
-            
-            elapsed = int(now - created_at) // 60
-            remaining_str = ""
-            
-            if expiry_at:
-                rem = int(expiry_at - now) // 60
-                if rem > 0:
-                    remaining_str = f" [{rem}m left]"
-                else:
-                    remaining_str = " [expiring...]"
-            
-            # Lógica de exibição da razão: 
-            # Oculta se for vazia, "Temporary ban" ou "*manual ban"
-            reason_display = ""
-            if reason and reason not in ["Temporary ban", "*manual ban", ""]:
-                reason_display = f": {reason}"
-            elif reason == "*manual ban":
-                reason_display = " [manual]"
-            
-            entry = f"[{i}] {m} ({elapsed}m ago by {adder}){remaining_str}{reason_display}"
-            output_list.append(entry)
-            full_text += entry + "\n"
 
         if ban_count > max_inline:
-            url = self._createPastebin(channel, full_text)
-            irc.reply(f"Ban list too large ({ban_count} entries). View here: {url}")
+            future = self._pastebinList(channel, entries, generation)
+            future.add_done_callback(lambda f: irc.reply(
+                f"Ban list too large ({ban_count} entries). View here: {f.result()}"))
         else:
-            irc.reply(" | ".join(output_list))
-            
-    list = wrap(list, [('checkChannelCapability', 'op'), 'channel'])
+            now = time.time()
+            irc.reply(" | ".join(self._formatEntry(m, data, now) for m, data in entries))
+
+    def banhistory(self, irc, msg, args, channel, mask):
+        """[<channel>] <mask>
+        Shows who added and removed <mask> in the blacklist, and when, from
+        the audit log.
+        """
+        events = []
+        for at, op, actor, reason, expiry_at in self._audit.history(channel.lower(), mask):
+            when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(at))
+            event = f"{when} {op} by {actor or irc.nick}"
+            if expiry_at:
+                event += time.strftime(' until %Y-%m-%d %H:%M', time.localtime(expiry_at))
+            if reason:
+                event += f": {reason}"
+            events.append(event)
+        if not events:
+            irc.reply(f"No history for {mask} in {channel}.")
+            return
+        irc.reply(" | ".join(events))
+    banhistory = wrap(banhistory, [('checkChannelCapability', 'op'), 'channel', 'somethingWithoutSpaces'])
+
+    @staticmethod
+    def _parseTime(s):
+        """Returns the unix time for a timestamp given either as a number or
+        as an ISO date and time (local time unless an offset is given), or
+        None."""
+        try:
+            return float(s)
+        except ValueError:
+            pass
+        try:
+            return datetime.datetime.fromisoformat(s.strip()).timestamp()
+        except ValueError:
+            return None
+
+    def banlistat(self, irc, msg, args, channel, when):
+        """[<channel>] <time>
+        Shows the blacklist as it was at <time>, rebuilt from the audit log.
+        <time> is a unix timestamp or a date such as 2024-05-01 or
+        "2024-05-01 18:30".
+        """
+        at = self._parseTime(when)
+        if at is None:
+            irc.errorInvalid('time', when)
+            return
+        entries = list(self._audit.replay(channel.lower(), at).items())
+        if not entries:
+            irc.reply("List was empty.")
+            return
+        max_inline = self.registryValue('maxInlineEntries', channel) or 5
+        if len(entries) > max_inline:
+            future = self._paste_pool.submit(self._uploadList, channel, entries, at)
+            future.add_done_callback(lambda f: irc.reply(
+                f"Ban list had {len(entries)} entries. View here: {f.result()}"))
+        else:
+            irc.reply(" | ".join(self._formatEntry(m, data, at) for m, data in entries))
+    banlistat = wrap(banlistat, [('checkChannelCapability', 'op'), 'channel', 'text'])
+
+    def _groupKey(self, irc, group):
+        name = group.lstrip('@').lower()
+        if not name:
+            irc.errorInvalid('group name', group, Raise=True)
+        return '@' + name
+
+    def groupadd(self, irc, msg, args, group, target, reason):
+        """<group> <nick|mask> [<reason>]
+        Adds a mask to a ban group. Every channel listing the group in its
+        'groups' setting where I am opped bans it right away.
+        """
+        key = self._groupKey(irc, group)
+        mask = self._createMask(irc, target, self.registryValue('maskNumber'))
+        if not mask:
+            irc.error("Could not create hostmask.")
+            return
+        reason = reason or self.registryValue('banReason')
+        self._internal_add(key, mask, msg.nick, reason, is_bot_cmd=True)
+        entries = {mask: self._partition(key)[mask]}
+        channels = 0
+        for target_irc, channel in self._targets(key):
+            if target_irc.state.channels[channel].isHalfopPlus(target_irc.nick):
+                self._enforce(target_irc, channel, entries, banAll=True)
+                channels += 1
+        irc.reply(f"Added {mask} to {key} and banned it in {channels} channels.")
+    groupadd = wrap(groupadd, ['admin', 'somethingWithoutSpaces', 'somethingWithoutSpaces', optional('text')])
+
+    def groupdel(self, irc, msg, args, group, target):
+        """<group> <mask|ID>
+        Removes a mask from a ban group and lifts it in the channels using
+        the group.
+        """
+        key = self._groupKey(irc, group)
+        mask = target
+        if target.isdigit():
+            mask = self._partition(key).ids.get(int(target))
+            if mask is None:
+                irc.error(f"No ban with ID {target} in {key}.")
+                return
+        if not self._internal_del(key, mask, msg.nick):
+            irc.error(f"Ban not found for: {target}")
+            return
+        for target_irc, channel in self._targets(key):
+            if mask in target_irc.state.channels[channel].bans:
+                self._modes.unban(target_irc, channel, mask)
+        irc.replySuccess()
+    groupdel = wrap(groupdel, ['admin', 'somethingWithoutSpaces', 'somethingWithoutSpaces'])
+
+    def grouplist(self, irc, msg, args, group):
+        """<group>
+        Lists the masks of a ban group.
+        """
+        self._replyList(irc, self._groupKey(irc, group))
+    grouplist = wrap(grouplist, ['admin', 'somethingWithoutSpaces'])
     
     def kick(self, irc, msg, args, channel, nick, reason):
         """[<channel>] <nick> [<reason>]"""
@@ -307,52 +1090,148 @@ class Blacklist(callbacks.Plugin):
         if mode_change == '+b':
             if not self.registryValue('addManualBans', channel):
                 return
-            with self._db_lock:
-                exists = c_lower in self.db and mask in self.db[c_lower]
-            
-            if not exists:
+            if not any(mask in bans for key, bans in self._lookupLists(irc, channel)):
                 expiry = self.registryValue('banlistExpiry', channel)
                 expiry_at = time.time() + (expiry * 60) if expiry > 0 else None
                 
                 self._internal_add(channel, mask, msg.nick, "*manual ban", is_bot_cmd=False, expiry_at=expiry_at)
-                if expiry > 0:
-                    schedule.addEvent(self._timer_expire, expiry_at, 
-                                     name=f"expire_{channel}_{mask}", 
-                                     args=(irc, channel, mask, True))
+            else:
+                # Já está na lista; fica só o registo de quem o pôs
+                self._record('set', c_lower, [(mask, None)], msg.nick)
         
         elif mode_change == '-b':
-            with self._db_lock:
-                entry = self.db.get(c_lower, {}).get(mask)
-                
+            entry = self._partition(c_lower).get(mask)
             if entry:
                 # Verificamos se foi um comando do bot (índice 3 na lista)
                 # Se for bot_cmd=True, NÃO apagamos da DB, apenas paramos os timers
                 is_bot_cmd = entry[3] if len(entry) > 3 else False
                 
                 if not is_bot_cmd:
-                    self._internal_del(channel, mask)
+                    self._internal_del(channel, mask, msg.nick)
                     logger.info(f"Manual unban: {mask} removed from DB (was manual ban)")
                 else:
                     logger.info(f"Manual unban: {mask} kept in DB (is bot blacklist entry)")
+                    self._record('unset', c_lower, [(mask, None)], msg.nick)
+                    # O +b já saiu do IRC; só a expiração total (expiry_at) continua agendada
+                    with self._db_lock:
+                        if not (len(entry) > 4 and entry[4]):
+                            self._wheel.cancel((c_lower, mask))
 
-            # Limpamos os timers de qualquer forma para não dar erro depois
-            for prefix in ['auto_unban', 'irc_cleanup', 'expire']:
-                try:
-                    schedule.removeEvent(f"{prefix}_{channel}_{mask}")
-                except KeyError:
-                    pass
+    def _floodJoin(self, irc, channel, msg):
+        """Counts the JOIN towards the channel's join rate. Once the rate
+        reaches joinFloodThreshold, JOINs are buffered for joinFloodDelay
+        seconds and checked together by _floodDrain. Returns whether msg
+        was buffered."""
+        threshold = self.registryValue('joinFloodThreshold', channel, irc.network)
+        if not threshold:
+            return False
+        key = (irc.network, channel.lower())
+        window = self.registryValue('joinFloodWindow', channel, irc.network)
+        if not self._flood.hit(key, time.time(), window, threshold):
+            return False
+        realname = msg.args[2] if len(msg.args) > 2 else None
+        if self._flood.buffer(key, (msg.nick, msg.prefix, self._accountOf(irc, msg.nick), realname)):
+            name = f'Blacklist_flood_{irc.network}_{channel.lower()}'
+            self._flood_events.add(name)
+            delay = self.registryValue('joinFloodDelay', channel, irc.network)
+            schedule.addEvent(self._floodDrain, time.time() + delay, name=name, args=(irc, channel))
+            self._floodLock(irc, channel)
+        return True
+
+    def _floodDrain(self, irc, channel):
+        """Checks the buffered JOINs against the blacklist and sends the
+        bans in packed MODE lines, followed by multi-target KICKs."""
+        key = (irc.network, channel.lower())
+        self._flood_events.discard(f'Blacklist_flood_{irc.network}_{channel.lower()}')
+        joins = self._flood.drain(key)
+        banlists = self._lookupLists(irc, channel)
+        state = irc.state.channels.get(channel)
+        if not joins or not banlists or state is None:
+            return
+        masks = {}
+        targets = []
+        matched = 0
+        for nick, prefix, account, realname in joins:
+            found = self._match(channel.lower(), banlists, prefix, account, realname)
+            if found is not None:
+                (mask, entry) = found
+                matched += 1
+                # Quem já saiu (join/part) é banido na mesma; só não é kickado
+                masks[mask] = None
+                if nick in state.users:
+                    targets.append((nick, entry[2]))
+        if not masks:
+            return
+        logger.info(f"Join flood in {channel}: {matched} of {len(joins)} buffered joins blacklisted")
+        kicks = ModeBatcher.kicks(irc, channel, targets)
+        masks = [mask for mask in masks if mask not in state.bans]
+        if not masks:
+            for kick in kicks:
+                irc.queueMsg(kick)
+            return
+        for mask in masks[:-1]:
+            self._modes.ban(irc, channel, mask)
+        self._modes.ban(irc, channel, masks[-1], after=kicks)
+
+    def _floodLock(self, irc, channel):
+        """Sets the channel's joinFloodLockModes that are not set yet, and
+        schedules lifting them."""
+        modes = self.registryValue('joinFloodLockModes', channel, irc.network)
+        key = (irc.network, channel.lower())
+        state = irc.state.channels.get(channel)
+        if not modes or key in self._flood.locked or state is None or not state.isHalfopPlus(irc.nick):
+            return
+        modes = ''.join(m for m in dict.fromkeys(modes) if m.isalpha() and m not in state.modes)
+        if not modes:
+            return
+        self._flood.locked[key] = modes
+        irc.queueMsg(ircmsgs.modes(channel, [('+' + m, None) for m in modes]))
+        logger.info(f"Join flood in {channel}: set +{modes}")
+        self._scheduleUnlock(irc, channel)
+
+    def _scheduleUnlock(self, irc, channel):
+        name = f'Blacklist_unlock_{irc.network}_{channel.lower()}'
+        self._flood_events.add(name)
+        duration = self.registryValue('joinFloodLockDuration', channel, irc.network)
+        schedule.addEvent(self._floodUnlock, time.time() + duration, name=name, args=(irc, channel))
+
+    def _floodUnlock(self, irc, channel):
+        """Lifts the flood lock, or keeps it for another joinFloodLockDuration
+        if the channel is still flooded."""
+        key = (irc.network, channel.lower())
+        self._flood_events.discard(f'Blacklist_unlock_{irc.network}_{channel.lower()}')
+        window = self.registryValue('joinFloodWindow', channel, irc.network)
+        threshold = self.registryValue('joinFloodThreshold', channel, irc.network)
+        if threshold and self._flood.flooding(key, time.time(), window, threshold):
+            self._scheduleUnlock(irc, channel)
+            return
+        modes = self._flood.locked.pop(key, None)
+        state = irc.state.channels.get(channel)
+        if modes and state is not None:
+            modes = ''.join(m for m in modes if m in state.modes)
+            if modes:
+                irc.queueMsg(ircmsgs.modes(channel, [('-' + m, None) for m in modes]))
 
     def doJoin(self, irc, msg):
-        if ircutils.strEqual(msg.nick, irc.nick): return
         channel = msg.args[0]
+        if ircutils.strEqual(msg.nick, irc.nick):
+            # O Limnoria pede a lista de bans ao entrar; aproveitamos a resposta
+            if self.registryValue('reconcileInterval', channel, irc.network) > 0:
+                self._requestBanlist(irc, channel, send=False)
+            return
         c_lower = channel.lower()
-        enabled = self.registryValue('enabled', channel)
-        if enabled and c_lower in self.db:
-            for mask in self.db[c_lower]:
-                if ircutils.hostmaskPatternEqual(mask, msg.prefix):
-                    reason = self.db[c_lower][mask][2]
-                    irc.queueMsg(ircmsgs.ban(channel, mask))
-                    irc.queueMsg(ircmsgs.kick(channel, msg.nick, reason))
-                    break
+        if not self.registryValue('enabled', channel):
+            return
+        if self._floodJoin(irc, channel, msg):
+            return
+        # Sem lock: a BanList publicada nunca é alterada
+        banlists = self._lookupLists(irc, channel)
+        if banlists:
+            # Com extended-join a conta e o realname vêm no próprio JOIN
+            realname = msg.args[2] if len(msg.args) > 2 else None
+            found = self._match(c_lower, banlists, msg.prefix, self._accountOf(irc, msg.nick), realname)
+            if found is not None:
+                (mask, entry) = found
+                self._modes.ban(irc, channel, mask, after=[ircmsgs.kick(channel, msg.nick, entry[2])])
 
 Class = Blacklist
\ No newline at end of file
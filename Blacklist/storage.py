@@ -0,0 +1,450 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+
+class JournalStore(object):
+    """Keeps the ban database as a JSON snapshot plus an append-only journal
+    of the changes made since that snapshot was written.
+
+    Each add/del appends one line to the journal and flushes it to the OS;
+    fsync is left to sync(), which the plugin calls periodically. compact()
+    folds the journal back into the snapshot. Replaying a journal over the
+    snapshot it was written against is idempotent, so a crash between
+    writing the snapshot and truncating the journal loses nothing."""
+
+    def __init__(self, path, compactAfter=1000):
+        self.path = path
+        self.journal = os.path.splitext(path)[0] + '.journal'
+        self.hitsPath = os.path.splitext(path)[0] + '.hits.json'
+        self.compactAfter = compactAfter
+        self._fd = None
+        self._dirty = False
+        self._records = 0
+        self._hits = {}
+
+    def load(self):
+        """Returns the {channel: {mask: entry}} database from the snapshot
+        (an existing blacklist.json is read as-is) and the journal."""
+        db = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    db = json.load(f)
+            except ValueError as e:
+                raise ValueError(f"{self.path} is unreadable ({e}), moved to "
+                                 f"{self._moveAside()}")
+        self._records = 0
+        if os.path.exists(self.journal):
+            valid = 0
+            with open(self.journal, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash; nothing after it is valid.
+                        break
+                    self._apply(db, record)
+                    self._records += 1
+                    valid += len(line)
+            if valid < os.path.getsize(self.journal):
+                os.truncate(self.journal, valid)
+        self._fd = open(self.journal, 'a')
+        return db
+
+    def _moveAside(self):
+        """Renames the snapshot, and its journal, to <name>.corrupt-<time>
+        so that nothing written afterwards can overwrite them. Returns the
+        snapshot's new name."""
+        suffix = '.corrupt-%d' % time.time()
+        os.replace(self.path, self.path + suffix)
+        if os.path.exists(self.journal):
+            os.replace(self.journal, self.journal + suffix)
+        return self.path + suffix
+
+    @staticmethod
+    def _apply(db, record):
+        op, channel, mask = record[:3]
+        if op == 'add':
+            db.setdefault(channel, {})[mask] = record[3]
+        elif op == 'del' and mask in db.get(channel, {}):
+            del db[channel][mask]
+            if not db[channel]:
+                del db[channel]
+
+    def _append(self, record):
+        self._fd.write(json.dumps(record) + '\n')
+        self._fd.flush()
+        self._dirty = True
+        self._records += 1
+
+    def add(self, channel, mask, entry):
+        """Appends an add record and returns the entry's ban ID; the journal
+        belongs to a single process, which gives out the IDs itself."""
+        self._append(['add', channel, mask, entry])
+        return entry[5]
+
+    def addMany(self, channel, items):
+        """Appends an add record for each (mask, entry) in one write and
+        fsyncs it. Returns the entries' ban IDs."""
+        self._fd.write(''.join(json.dumps(['add', channel, mask, entry]) + '\n'
+                               for (mask, entry) in items))
+        self._fd.flush()
+        self._records += len(items)
+        self._dirty = True
+        self.sync()
+        return [entry[5] for (mask, entry) in items]
+
+    def delete(self, channel, mask):
+        self._append(['del', channel, mask])
+
+    def deleteMany(self, channel, masks):
+        """Appends a del record for each mask in one write."""
+        self._fd.write(''.join(json.dumps(['del', channel, mask]) + '\n'
+                               for mask in masks))
+        self._fd.flush()
+        self._records += len(masks)
+        self._dirty = True
+
+    def loadHits(self):
+        """Returns the {channel: {mask: [count, last_hit]}} hit counters."""
+        if os.path.exists(self.hitsPath):
+            with open(self.hitsPath, 'r') as f:
+                self._hits = json.load(f)
+        return {channel: {mask: list(hit) for (mask, hit) in hits.items()}
+                for (channel, hits) in self._hits.items()}
+
+    def addHits(self, rows):
+        """Adds the (channel, mask, count, last_hit) rows to the hit
+        counters and rewrites the hits file."""
+        for (channel, mask, count, last_hit) in rows:
+            hit = self._hits.setdefault(channel, {}).setdefault(mask, [0, None])
+            hit[0] += count
+            hit[1] = last_hit
+        tmp = self.hitsPath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._hits, f)
+        os.replace(tmp, self.hitsPath)
+
+    def needsCompaction(self):
+        return self._records >= self.compactAfter or not os.path.exists(self.path)
+
+    def sync(self):
+        if self._dirty and self._fd is not None:
+            os.fsync(self._fd.fileno())
+            self._dirty = False
+
+    def compact(self, db):
+        """Writes db, as {channel: {mask: entry}} with any mappings as
+        values, as the new snapshot and empties the journal."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({channel: dict(masks) for (channel, masks) in db.items()},
+                      f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        # Counters of masks that are gone go with them.
+        self._hits = {channel: {mask: hit for (mask, hit) in hits.items()
+                                if mask in db.get(channel, {})}
+                      for (channel, hits) in self._hits.items() if channel in db}
+        if self._fd is not None:
+            self._fd.close()
+        self._fd = open(self.journal, 'w')
+        self._dirty = False
+        self._records = 0
+
+    def poll(self):
+        # The journal belongs to a single process.
+        return []
+
+    def close(self):
+        if self._fd is not None:
+            self.sync()
+            self._fd.close()
+            self._fd = None
+
+
+class SqliteStore(object):
+    """Keeps the ban database in SQLite, one row per (channel, mask).
+
+    Each row carries the ban's per-channel ID, and there are indexes on
+    (channel, mask), (channel, ban_id) and (channel, expiry_at). On first use, the contents of
+    an existing blacklist.json (and its journal) are imported once.
+
+    Several bot processes can share the database. Every write also appends
+    to the changes table, tagged with the writing store's origin, and
+    poll() returns the changes other processes made since the last call.
+    Changes older than keepChanges seconds are pruned by sync(). Ban IDs are
+    given out by add() and addMany() in the transaction that inserts the
+    ban, so two processes can't hand out the same one."""
+
+    def __init__(self, path, importFrom=None, keepChanges=86400):
+        self.path = path
+        self.importFrom = importFrom
+        self.keepChanges = keepChanges
+        self.origin = uuid.uuid4().hex
+        self._conn = None
+        self._seq = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS bans (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                mask TEXT NOT NULL,
+                adder TEXT,
+                created_at REAL,
+                reason TEXT,
+                is_bot_cmd INTEGER,
+                expiry_at REAL,
+                ban_id INTEGER,
+                UNIQUE (channel, mask)
+            );
+            CREATE INDEX IF NOT EXISTS bans_expiry ON bans (channel, expiry_at);
+            CREATE TABLE IF NOT EXISTS hits (
+                channel TEXT NOT NULL,
+                mask TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                last_hit REAL,
+                PRIMARY KEY (channel, mask)
+            );
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                op TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                mask TEXT NOT NULL,
+                origin TEXT NOT NULL,
+                at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(bans)')]
+        if 'ban_id' not in columns:
+            conn.execute('ALTER TABLE bans ADD COLUMN ban_id INTEGER')
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' "
+                        "AND name = 'bans_ban_id'").fetchone() is None:
+            with conn:
+                # IDs used to be given out by each process, so two of them
+                # may have handed out the same one. The later ban loses it
+                # and gets a new one when its channel is loaded.
+                conn.execute(
+                    'UPDATE bans SET ban_id = NULL WHERE ban_id IS NOT NULL '
+                    'AND id NOT IN (SELECT MIN(id) FROM bans '
+                    'WHERE ban_id IS NOT NULL GROUP BY channel, ban_id)')
+                conn.execute('CREATE UNIQUE INDEX bans_ban_id '
+                             'ON bans (channel, ban_id)')
+        return conn
+
+    def open(self):
+        """Connects and, the first time, imports blacklist.json. Changes made
+        by other processes from this point on are returned by poll()."""
+        if self._conn is None:
+            self._conn = self._connect()
+        row = self._conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        self._seq = row[0] if row else 0
+        if self.importFrom and os.path.exists(self.importFrom):
+            imported = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'imported_json'").fetchone()
+            if imported is None:
+                self.importJson(self.importFrom)
+
+    def _select(self, where='', params=()):
+        rows = self._conn.execute(
+            'SELECT channel, mask, adder, created_at, reason, is_bot_cmd, '
+            'expiry_at, ban_id FROM bans ' + where + ' ORDER BY id', params)
+        for (channel, mask, adder, created_at, reason, is_bot_cmd,
+             expiry_at, ban_id) in rows:
+            yield (channel, mask, [adder, created_at, reason,
+                                   bool(is_bot_cmd), expiry_at, ban_id])
+
+    def load(self):
+        # Anything changed before this point is in what load() returns.
+        self.open()
+        db = {}
+        for (channel, mask, entry) in self._select():
+            db.setdefault(channel, {})[mask] = entry
+        return db
+
+    def loadChannel(self, channel):
+        """Returns one channel's (or group's) {mask: entry} bans."""
+        return {mask: entry for (_, mask, entry)
+                in self._select('WHERE channel = ?', (channel,))}
+
+    def pending(self, since):
+        """Returns (channel, mask, entry) for the bans that may still have
+        an expiry to run: timed bans, and bot bans set after since."""
+        return list(self._select(
+            'WHERE expiry_at IS NOT NULL OR (is_bot_cmd AND created_at > ?)',
+            (since,)))
+
+    def importJson(self, path):
+        """Copies a blacklist.json database (and its journal) into this one.
+        Masks already present are left alone."""
+        db = JournalStore(path).load()
+        with self._conn:
+            for channel, masks in db.items():
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO bans (channel, mask, adder, '
+                    'created_at, reason, is_bot_cmd, expiry_at, ban_id) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(channel, mask) + self._row(entry)
+                     for mask, entry in masks.items()])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('imported_json', ?)",
+                (path,))
+
+    @staticmethod
+    def _row(entry):
+        # Entries written by older versions may lack is_bot_cmd, expiry_at
+        # and ban_id.
+        entry = list(entry) + [False, None, None][len(entry) - 3:]
+        adder, created_at, reason, is_bot_cmd, expiry_at, ban_id = entry[:6]
+        return (adder, created_at, reason, int(bool(is_bot_cmd)), expiry_at,
+                ban_id)
+
+    def _logChanges(self, op, channel, masks):
+        now = time.time()
+        self._conn.executemany(
+            'INSERT INTO changes (op, channel, mask, origin, at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(op, channel, mask, self.origin, now) for mask in masks])
+
+    def _banIds(self, channel, items):
+        """Returns the ban ID of each (mask, entry): the one the mask's row
+        already has, or else the entry's own if no row has it or a higher
+        one, or else the channel's next free one. Must run in a BEGIN
+        IMMEDIATE transaction, which keeps other processes from writing
+        until the bans are inserted."""
+        (next_id,) = self._conn.execute(
+            'SELECT COALESCE(MAX(ban_id), 0) + 1 FROM bans WHERE channel = ?',
+            (channel,)).fetchone()
+        ids = []
+        for (mask, entry) in items:
+            row = self._conn.execute(
+                'SELECT ban_id FROM bans WHERE channel = ? AND mask = ?',
+                (channel, mask)).fetchone()
+            if row is not None and row[0] is not None:
+                ids.append(row[0])
+            else:
+                next_id = max(next_id, self._row(entry)[-1] or 0)
+                ids.append(next_id)
+                next_id += 1
+        return ids
+
+    def add(self, channel, mask, entry):
+        """Inserts or updates the ban and returns its ban ID, as given by
+        _banIds(): the entry's own only if no other process took it."""
+        with self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            (ban_id,) = self._banIds(channel, [(mask, entry)])
+            self._logChanges('add', channel, [mask])
+            self._conn.execute(
+                'INSERT INTO bans (channel, mask, adder, created_at, reason, '
+                'is_bot_cmd, expiry_at, ban_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (channel, mask) DO UPDATE SET '
+                'adder = excluded.adder, created_at = excluded.created_at, '
+                'reason = excluded.reason, is_bot_cmd = excluded.is_bot_cmd, '
+                'expiry_at = excluded.expiry_at, ban_id = excluded.ban_id',
+                (channel, mask) + self._row(entry)[:-1] + (ban_id,))
+        return ban_id
+
+    def addMany(self, channel, items):
+        """Inserts every (mask, entry) in a single transaction. Returns
+        their ban IDs, given as in add()."""
+        with self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            ids = self._banIds(channel, items)
+            self._logChanges('add', channel, [mask for (mask, entry) in items])
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO bans (channel, mask, adder, '
+                'created_at, reason, is_bot_cmd, expiry_at, ban_id) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(channel, mask) + self._row(entry)[:-1] + (ban_id,)
+                 for ((mask, entry), ban_id) in zip(items, ids)])
+        return ids
+
+    def delete(self, channel, mask):
+        self.deleteMany(channel, [mask])
+
+    def deleteMany(self, channel, masks):
+        rows = [(channel, mask) for mask in masks]
+        with self._conn:
+            self._logChanges('del', channel, masks)
+            self._conn.executemany(
+                'DELETE FROM bans WHERE channel = ? AND mask = ?', rows)
+            self._conn.executemany(
+                'DELETE FROM hits WHERE channel = ? AND mask = ?', rows)
+
+    def loadHits(self):
+        hits = {}
+        for (channel, mask, count, last_hit) in self._conn.execute(
+                'SELECT channel, mask, count, last_hit FROM hits'):
+            hits.setdefault(channel, {})[mask] = [count, last_hit]
+        return hits
+
+    def addHits(self, rows):
+        with self._conn:
+            self._conn.executemany(
+                'INSERT INTO hits (channel, mask, count, last_hit) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (channel, mask) DO UPDATE SET '
+                'count = count + excluded.count, last_hit = excluded.last_hit',
+                rows)
+
+    def poll(self):
+        """Returns the changes other processes made since the last call as
+        ('add', channel, mask, entry) and ('del', channel, mask, None)
+        tuples, in order, or None if some were pruned before this process
+        saw them and the database has to be loaded again."""
+        first = self._conn.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+        if first is not None and first > self._seq + 1:
+            return None
+        rows = self._conn.execute(
+            'SELECT c.seq, c.op, c.channel, c.mask, c.origin, b.adder, '
+            'b.created_at, b.reason, b.is_bot_cmd, b.expiry_at, b.ban_id '
+            'FROM changes c LEFT JOIN bans b '
+            'ON b.channel = c.channel AND b.mask = c.mask '
+            'WHERE c.seq > ? ORDER BY c.seq', (self._seq,)).fetchall()
+        changes = []
+        for (seq, op, channel, mask, origin, adder, created_at, reason,
+             is_bot_cmd, expiry_at, ban_id) in rows:
+            self._seq = seq
+            if origin == self.origin:
+                continue
+            if op == 'del':
+                changes.append(('del', channel, mask, None))
+            elif created_at is not None:
+                # Without a row the mask is gone again; its del follows.
+                changes.append(('add', channel, mask,
+                                [adder, created_at, reason, bool(is_bot_cmd),
+                                 expiry_at, ban_id]))
+        return changes
+
+    def needsCompaction(self):
+        return False
+
+    def sync(self):
+        with self._conn:
+            self._conn.execute('DELETE FROM changes WHERE at < ?',
+                               (time.time() - self.keepChanges,))
+
+    def compact(self, db):
+        pass
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,512 @@
+import json
+import os
+import http.server
+import random
+import threading
+import time
+
+from supybot.test import *
+from supybot import schedule
+
+from .bench import makeMasks, userFor
+from .matcher import BanList, MaskIndex
+
+class BlacklistTestCase(ChannelPluginTestCase):
+    plugins = ('Blacklist',)
+    config = {'supybot.plugins.Blacklist.enabled': True,
+              'supybot.plugins.Blacklist.modeFlushDelay': 0}
+
+    def _drain(self):
+        while self.irc.takeMsg():
+            pass
+
+    def _reload(self):
+        cb = self.irc.getCallback('Blacklist')
+        self.irc.removeCallback('Blacklist')
+        cb.die()
+        cb = cb.__class__(self.irc)
+        self.irc.addCallback(cb)
+        return cb
+
+    def testAddListDelete(self):
+        self.assertNotError('blacklist add *!*@bad.example.com spam')
+        self._drain()
+        self.assertRegexp('blacklist list', r'\*!\*@bad.example.com')
+        self.assertResponse('blacklist stats', 'Channel #test has 1 bans in the blacklist.')
+        self.assertNotError('blacklist delete 1')
+        self._drain()
+        self.assertResponse('blacklist list', 'List is empty.')
+
+    def testJoinEnforced(self):
+        self.assertNotError('blacklist add *!*@*.evil.net bye')
+        while self.irc.takeMsg(): pass
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='bad!u@x.evil.net'))
+        m = self.irc.takeMsg()
+        self.assertEqual(m.command, 'MODE')
+        m = self.irc.takeMsg()
+        self.assertEqual(m.command, 'KICK')
+
+    def testJoinFlood(self):
+        cb = self.irc.getCallback('Blacklist')
+        self.irc.state.supported['modes'] = 4
+        self.irc.state.supported['targmax'] = 'PRIVMSG:4,KICK:3'
+        self.irc.feedMsg(ircmsgs.op(self.channel, self.nick))
+        cb._internal_add(self.channel, '*!*@*.botnet.example', 'op', 'bots', is_bot_cmd=True)
+        self._drain()
+        with conf.supybot.plugins.Blacklist.joinFloodThreshold.context(3), \
+                conf.supybot.plugins.Blacklist.joinFloodLockModes.context('r'):
+            for i in range(7):
+                host = 'ok.example' if i == 3 else 'h%d.botnet.example' % i
+                self.irc.feedMsg(ircmsgs.join(self.channel, prefix='b%d!u@%s' % (i, host)))
+            # first two joins are below the threshold and handled one by one
+            msgs = []
+            while True:
+                m = self.irc.takeMsg()
+                if m is None:
+                    break
+                msgs.append(m)
+            self.assertEqual([m.command for m in msgs], ['MODE', 'KICK', 'MODE', 'KICK', 'MODE'])
+            self.assertEqual(msgs[-1].args[1:], ('+r',))
+            cb._floodDrain(self.irc, self.channel)
+            schedule.removeEvent('Blacklist_flood_test_#test')
+            # the mask is already set, so only the KICKs go out
+            m = self.irc.takeMsg()
+            self.assertEqual(m.command, 'KICK')
+            self.assertEqual(m.args[1], 'b2,b4,b5')
+            m = self.irc.takeMsg()
+            self.assertEqual(m.args[1], 'b6')
+            self.irc.feedMsg(ircmsgs.IrcMsg(prefix=self.prefix, command='MODE', args=(self.channel, '+r')))
+            cb._flood._joins.clear()
+            cb._floodUnlock(self.irc, self.channel)
+            m = self.irc.takeMsg()
+            self.assertEqual(m.args[1:], ('-r',))
+
+    def testJoinFloodPartedBanned(self):
+        cb = self.irc.getCallback('Blacklist')
+        self.irc.state.supported['modes'] = 4
+        self.irc.feedMsg(ircmsgs.op(self.channel, self.nick))
+        cb._internal_add(self.channel, '*!*@*.botnet.example', 'op', 'bots', is_bot_cmd=True)
+        cb._internal_add(self.channel, '*!*@*.other.example', 'op', 'bots', is_bot_cmd=True)
+        self._drain()
+        with conf.supybot.plugins.Blacklist.joinFloodThreshold.context(1):
+            self.irc.feedMsg(ircmsgs.join(self.channel, prefix='ok!u@ok.example'))
+            for prefix in ('b1!u@h1.botnet.example', 'b2!u@h2.other.example'):
+                self.irc.feedMsg(ircmsgs.join(self.channel, prefix=prefix))
+                self.irc.feedMsg(ircmsgs.part(self.channel, prefix=prefix))
+            self._drain()
+            cb._floodDrain(self.irc, self.channel)
+            schedule.removeEvent('Blacklist_flood_test_#test')
+        # b1 and b2 joined and left before the drain: banned, not kicked
+        msgs = [self.irc.takeMsg() for _ in range(3)]
+        self.assertEqual([m.args[1:] if m else None for m in msgs],
+                         [('+b', '*!*@*.botnet.example'),
+                          ('+b', '*!*@*.other.example'), None])
+
+    def testCreateMask(self):
+        cb = self.irc.getCallback('Blacklist')
+        self.irc.state.nicksToHostmasks['phost'] = 'phost!~host@a.b.isp.net'
+        self.assertEqual(cb._createMask(self.irc, 'phost', 3), '*!*host@*.b.isp.net')
+        self.assertEqual(cb._createMask(self.irc, 'phost', 7), 'phost!*@a.b.isp.net')
+        self.irc.state.nicksToHostmasks['v4'] = 'v4!u@10.1.2.3'
+        self.assertEqual(cb._createMask(self.irc, 'v4', 4), '*!*@10.1.2.*')
+        self.irc.state.nicksToHostmasks['v6'] = 'v6!u@2001:db8::1'
+        self.assertEqual(cb._createMask(self.irc, 'v6', 4), '*!*@2001:db8::/64')
+        index = MaskIndex(['*!*@2001:db8::/64'])
+        self.assertTrue(index.match('x!u@2001:db8::ffff:1'))
+        self.assertIsNone(index.match('x!u@2001:db8::5:0:0:0:1'))
+        self.irc.state.nicksToHostmasks['v6'] = 'v6!u@2001:db8:1:2:3:4:5:6'
+        self.assertEqual(cb._createMask(self.irc, 'v6', 4), '*!*@2001:db8:1:2::/64')
+        self.assertIsNone(cb._createMask(self.irc, 'nobody', 2))
+
+    def testMetrics(self):
+        cb = self.irc.getCallback('Blacklist')
+        cb._internal_add(self.channel, '*!*@*.hit.example', 'op', 'x', is_bot_cmd=True)
+        cb._internal_add(self.channel, '*!*@dead.example', 'op', 'x', is_bot_cmd=True)
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='a!u@a.hit.example'))
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='b!u@clean.example'))
+        self._drain()
+        self.assertRegexp('blacklist blstats', r'2 joins checked, p50 .*'
+                          r'Top masks: \*!\*@\*\.hit\.example \(1\)\. 1 of 2 masks never matched')
+        cb._metricsFlush()
+        self.assertEqual(cb._store.loadHits()['#test']['*!*@*.hit.example'][0], 1)
+        path = os.path.join(os.path.dirname(cb.dbfile), 'metrics.json')
+        with open(path) as f:
+            dump = json.load(f)
+        self.assertEqual(sum(dump['channels']['#test']['latency']['counts']), 2)
+
+    def testGroups(self):
+        cb = self.irc.getCallback('Blacklist')
+        self.irc.feedMsg(ircmsgs.op(self.channel, self.nick))
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='g!u@g.spam.example'))
+        self._drain()
+        with conf.supybot.plugins.Blacklist.groups.context(['spam']):
+            msgs = [self.getMsg('blacklist groupadd spam *!*@*.spam.example botnet'),
+                    self.irc.takeMsg(), self.irc.takeMsg()]
+            self.assertEqual(msgs[0].args[1:], ('+b', '*!*@*.spam.example'))
+            self.assertEqual((msgs[1].command, msgs[1].args[1]), ('KICK', 'g'))
+            self.assertEqual(msgs[2].args[1], 'test: '
+                             'Added *!*@*.spam.example to @spam and banned it in 1 channels.')
+            self._drain()
+            self.assertNotIn('#test', cb.db)
+            self.irc.feedMsg(ircmsgs.join(self.channel, prefix='h!u@h.spam.example'))
+            m = self.irc.takeMsg()
+            self.assertEqual(m.command, 'MODE')
+            self._drain()
+            self.assertRegexp('blacklist grouplist spam', r'\*!\*@\*\.spam\.example')
+            self.irc.feedMsg(ircmsgs.IrcMsg(prefix=self.prefix, command='MODE',
+                                            args=(self.channel, '+b', '*!*@*.spam.example')))
+            m = self.getMsg('blacklist groupdel spam 1')
+            self.assertEqual(m.args[1:], ('-b', '*!*@*.spam.example'))
+            self._drain()
+        self.assertResponse('blacklist grouplist spam', 'List is empty.')
+
+    def testSharedStore(self):
+        cb = self.irc.getCallback('Blacklist')
+        if not hasattr(cb._store, 'origin'):
+            self.skipTest('the journal store belongs to a single process')
+        from Blacklist.storage import SqliteStore
+        other = SqliteStore(cb._store.path)
+        other.load()
+        cb._internal_add(self.channel, '*!*@mine.example', 'op', 'x', is_bot_cmd=True)
+        other.add('#test', '*!*@theirs.example', ['op', time.time(), 'y', True, None, 2])
+        other.add('#other', '*!*@far.example', ['op', time.time(), 'z', True, None, 1])
+        cb._pollStore()
+        self.assertIn('*!*@theirs.example', cb.db['#test'])
+        self.assertEqual(cb.db['#test'].ids[2], '*!*@theirs.example')
+        self.assertIn('#other', cb.db)
+        self.assertEqual(other.poll(), [('add', '#test', '*!*@mine.example', cb.db['#test']['*!*@mine.example'])])
+        other.delete('#test', '*!*@theirs.example')
+        cb._pollStore()
+        self.assertNotIn('*!*@theirs.example', cb.db['#test'])
+        cb._internal_add(self.channel, '*!*@next.example', 'op', 'x', is_bot_cmd=True)
+        self.assertEqual(cb.db['#test']['*!*@next.example'][5], 3)
+        other.close()
+
+    def testExtbans(self):
+        cb = self.irc.getCallback('Blacklist')
+        self.irc.state.capabilities_ack.add('extended-join')
+        cb._internal_add(self.channel, '$a:Spammer', 'op', 'acct', is_bot_cmd=True)
+        cb._internal_add(self.channel, '$r:*free coins*', 'op', 'gecos', is_bot_cmd=True)
+        self._drain()
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='a!u@clean.example', command='JOIN',
+                                        args=(self.channel, 'spammer', 'hi')))
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args[1:], ('+b', '$a:Spammer'))
+        self._drain()
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='b!u@clean.example', command='JOIN',
+                                        args=(self.channel, '*', 'get FREE COINS now')))
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args[1:], ('+b', '$r:*free coins*'))
+        self._drain()
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='c!u@clean.example', command='JOIN',
+                                        args=(self.channel, 'someone', 'hello')))
+        self.assertIsNone(self.irc.takeMsg())
+        self.assertEqual(cb._createMask(self.irc, 'c', 11), '$a:someone')
+        self.assertEqual(cb._createMask(self.irc, 'b', 11), '*!*@clean.example')
+
+    def testCidrBans(self):
+        cb = self.irc.getCallback('Blacklist')
+        cb._internal_add(self.channel, '*!*@192.0.2.0/24', 'op', 'net', is_bot_cmd=True)
+        cb._internal_add(self.channel, '*!*@2001:db8::/32', 'op', 'net6', is_bot_cmd=True)
+        self._drain()
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='a!u@192.0.2.77'))
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args[1:], ('+b', '*!*@192.0.2.0/24'))
+        self._drain()
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='b!u@2001:DB8:0:1::9'))
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args[1:], ('+b', '*!*@2001:db8::/32'))
+        self._drain()
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='c!u@192.0.3.1'))
+        self.assertIsNone(self.irc.takeMsg())
+
+    def testAuditLog(self):
+        self.assertNotError('blacklist add *!*@old.example spam')
+        self._drain()
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='op!u@h', command='MODE',
+                                        args=(self.channel, '-b', '*!*@old.example')))
+        before = time.time()
+        self.assertNotError('blacklist delete *!*@old.example')
+        self._drain()
+        self.assertRegexp('blacklist banhistory *!*@old.example',
+                          r'add by \S+: spam \| .* unset by op \| .* del by \S+$')
+        self.assertRegexp('blacklist banlistat %f' % before, r'\[1\] \*!\*@old.example')
+        self.assertResponse('blacklist banlistat %f' % time.time(), 'List was empty.')
+        self.assertError('blacklist banlistat yesterday')
+        self.assertResponse('blacklist banhistory *!*@never.example',
+                            'No history for *!*@never.example in #test.')
+
+    def testTimerExpires(self):
+        self.assertNotError('blacklist timer *!*@t.example.com 1')
+        while self.irc.takeMsg(): pass
+        cb = self.irc.getCallback('Blacklist')
+        self.assertIn(('#test', '*!*@t.example.com'), cb._wheel)
+        cb._wheel.schedule(('#test', '*!*@t.example.com'), time.time() - 60, True)
+        cb._expiryTick()
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args[1:], ('-b', '*!*@t.example.com'))
+        self.assertResponse('blacklist stats', 'Channel #test has 0 bans in the blacklist.')
+        self.assertRegexp('blacklist banhistory *!*@t.example.com', r'add by .* \| .* expire by')
+
+    def testPollScheduled(self):
+        cb = self.irc.getCallback('Blacklist')
+        from Blacklist.storage import SqliteStore
+        self.assertEqual('Blacklist_poll' in schedule.schedule.events,
+                         isinstance(cb._store, SqliteStore))
+
+    def testModesPacked(self):
+        cb = self.irc.getCallback('Blacklist')
+        self.irc.state.supported['modes'] = 4
+        with conf.supybot.plugins.Blacklist.modeFlushDelay.context(10):
+            for i in range(6):
+                cb._modes.ban(self.irc, self.channel, '*!*@h%d' % i)
+            cb._modes.unban(self.irc, self.channel, '*!*@x', after=[ircmsgs.kick(self.channel, 'foo', 'r')])
+            cb._modes.flush()
+        m1, m2, m3 = self.irc.takeMsg(), self.irc.takeMsg(), self.irc.takeMsg()
+        self.assertEqual(m1.args, ('#test', '+bbbb', '*!*@h0', '*!*@h1', '*!*@h2', '*!*@h3'))
+        self.assertEqual(m2.args, ('#test', '+bb-b', '*!*@h4', '*!*@h5', '*!*@x'))
+        self.assertEqual(m3.command, 'KICK')
+
+    def testPastebinCached(self):
+        cb = self.irc.getCallback('Blacklist')
+        calls = []
+        cb._createPastebin = lambda channel, lines: calls.append(''.join(lines())) or 'https://paste/%d' % len(calls)
+        with conf.supybot.plugins.Blacklist.maxInlineEntries.context(1):
+            cb._internal_add(self.channel, '*!*@a.example.com', 'op', '')
+            cb._internal_add(self.channel, '*!*@b.example.com', 'op', '')
+            self.assertRegexp('blacklist list', 'https://paste/1')
+            self.assertRegexp('blacklist list', 'https://paste/1')
+            cb._internal_add(self.channel, '*!*@c.example.com', 'op', '')
+            self.assertRegexp('blacklist list', 'https://paste/2')
+        self.assertEqual(len(calls), 2)
+        self.assertIn('[3] *!*@c.example.com', calls[1])
+
+    def testPastebinStreamed(self):
+        cb = self.irc.getCallback('Blacklist')
+        received = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                received.append((self.headers, self.rfile.read(length)))
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b'https://paste/1\n')
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        self.addCleanup(server.server_close)
+        at = time.time()
+        entries = [('*!*@h%d.example' % i, ['op', at - 600, 'r%d' % i, False,
+                                            at + 600 if i % 2 else None, i + 1])
+                   for i in range(5000)]
+        url = 'http://127.0.0.1:%d/' % server.server_port
+        with conf.supybot.plugins.Blacklist.pastebinUrl.context(url):
+            self.assertEqual(cb._uploadList(self.channel, entries, at), 'https://paste/1')
+        thread.join()
+        (headers, body) = received[0]
+        self.assertNotIn('Transfer-Encoding', headers)
+        text = body.decode('utf-8')
+        self.assertEqual(text.count('\n['), 5000)
+        self.assertIn('[4999] *!*@h4998.example (added %s by op): r4998\n'
+                      % cb._formatTime(at - 600), text)
+        self.assertIn('[2] *!*@h1.example (added %s by op) [until %s]'
+                      % (cb._formatTime(at - 600), cb._formatTime(at + 600)), text)
+        # Times are absolute, so a cached paste doesn't go stale
+        self.assertNotIn('m ago', text)
+
+    def testStableIds(self):
+        cb = self.irc.getCallback('Blacklist')
+        for h in 'abc':
+            cb._internal_add(self.channel, '*!*@%s.example.com' % h, 'op', '')
+        self.assertNotError('blacklist delete 2')
+        self._drain()
+        self.assertRegexp('blacklist list', r'\[1\] \*!\*@a.*\| \[3\] \*!\*@c')
+        self.assertError('blacklist delete 2')
+        cb._internal_add(self.channel, '*!*@d.example.com', 'op', '')
+        self.assertRegexp('blacklist list', r'\[4\] \*!\*@d')
+
+    def testImportExport(self):
+        cb = self.irc.getCallback('Blacklist')
+        cb._internal_add(self.channel, '*!*@a.example.com', 'op', '')
+        path = cb._listPath('in.bans')
+        with open(path, 'w') as f:
+            f.write('# comment\n*!*@a.example.com\tx\n*!*@b.example.com\tx\tspam\n')
+            f.write('*!*@c.example.com\t\t\t%d\n*!*@d.example.com\t\t\t1\nbad mask\n' % (time.time() + 3600))
+        self.assertResponse('blacklist banimport in.bans',
+                            'Imported 2 bans into #test (1 already listed, 1 expired, 1 invalid lines).')
+        self.assertRegexp('blacklist banexport', 'Exported 3 bans')
+        with open(cb._listPath('test.bans')) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[2], '*!*@b.example.com\tx\tspam\t')
+        self.assertError('blacklist banexport ../evil')
+
+    def testImportEnforces(self):
+        cb = self.irc.getCallback('Blacklist')
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='evil!u@e.example.com'))
+        with open(cb._listPath('e.bans'), 'w') as f:
+            f.write('*!*@e.example.com\top\tgo away\n')
+        m = self.getMsg('blacklist banimport e.bans')
+        self.assertEqual(m.args, ('#test', '+b', '*!*@e.example.com'))
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args, ('#test', 'evil', 'go away'))
+
+    def testReconcile(self):
+        cb = self.irc.getCallback('Blacklist')
+        self.irc.feedMsg(ircmsgs.op(self.channel, self.nick))
+        cb._internal_add(self.channel, '*!*@manual.gone', 'op', '*manual ban', is_bot_cmd=False)
+        cb._internal_add(self.channel, '*!*@timed.gone', 'op', '', is_bot_cmd=True, expiry_at=time.time() + 600)
+        cb._internal_add(self.channel, '*!*@kept', 'op', '', is_bot_cmd=True)
+        self._drain()
+        m = self.getMsg('blacklist reconcile')
+        self.assertEqual(m.args, ('#test', '+b'))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='server', command='367',
+            args=(self.nick, '#test', '*!*@new.one', 'someop!u@h', '0')))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='server', command='367',
+            args=(self.nick, '#test', '*!*@KEPT', 'someop!u@h', '0')))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='server', command='368',
+            args=(self.nick, '#test', 'End of list')))
+        msgs = []
+        m = self.irc.takeMsg()
+        while m:
+            msgs.append(m); m = self.irc.takeMsg()
+        self.assertIn(('#test', '+b', '*!*@timed.gone'), [m.args for m in msgs])
+        self.assertIn('1 manual bans added, 1 removed, 1 bans set again, 0 lifted', msgs[-1].args[1])
+        self.assertEqual(sorted(cb.db['#test']), ['*!*@kept', '*!*@new.one', '*!*@timed.gone'])
+        self.assertEqual(cb.db['#test']['*!*@new.one'][0], 'someop')
+
+    def testCorruptDbKept(self):
+        cb = self.irc.getCallback('Blacklist')
+        if cb.registryValue('storageBackend') != 'journal':
+            self.skipTest('only the journal backend reads blacklist.json')
+        cb._internal_add(self.channel, '*!*@a.example.com', 'op', '')
+        self.irc.removeCallback('Blacklist')
+        cb.die()
+        with open(cb.dbfile) as f:
+            content = f.read()
+        with open(cb.dbfile, 'w') as f:
+            f.write(content[:len(content) // 2])
+        cb = cb.__class__(self.irc)
+        self.irc.addCallback(cb)
+        self.assertTrue(cb._load_failed)
+        directory = os.path.dirname(cb.dbfile)
+        aside = [name for name in os.listdir(directory)
+                 if name.startswith('blacklist.json.corrupt-')]
+        self.assertEqual(len(aside), 1)
+        cb._internal_add(self.channel, '*!*@b.example.com', 'op', '')
+        cb._dbSync()
+        self.irc.removeCallback('Blacklist')
+        cb.die()
+        self.assertFalse(os.path.exists(cb.dbfile))
+        cb = cb.__class__(self.irc)
+        self.irc.addCallback(cb)
+        with open(os.path.join(directory, aside[0])) as f:
+            self.assertEqual(f.read(), content[:len(content) // 2])
+        os.remove(os.path.join(directory, aside[0]))
+
+    def testBenchUsersMatch(self):
+        # The benchmark's "matching" joins must really match their mask
+        masks = makeMasks(500, random.Random(1))
+        index = MaskIndex(mask for (mask, _) in masks)
+        for (i, (mask, kind)) in enumerate(masks):
+            (hostmask, account) = userFor(mask, kind, i)
+            self.assertEqual(index.match(hostmask, account, None), mask)
+
+    def testBanListReplace(self):
+        masks = [mask for (mask, _) in makeMasks(500, random.Random(1))]
+        bans = BanList((mask, ['op', 0, '', False, None, i + 1])
+                       for (i, mask) in enumerate(masks))
+        (hostmask, account) = userFor(masks[0], 'exact', 0)
+        self.assertEqual(bans.index.match(hostmask, account), masks[0])
+        new = bans.replace(add=[('*!*@new.example', ['op', 0, '', False, None,
+                                                     501])],
+                           remove=[masks[0]])
+        # Removed masks don't keep their compiled pattern
+        self.assertNotIn(masks[0], new.index._compiled)
+        # The original is untouched...
+        self.assertEqual(list(bans), masks)
+        self.assertEqual(bans.ids[1], masks[0])
+        self.assertEqual(bans.index.match(hostmask, account), masks[0])
+        # ...and the copy keeps the insertion order
+        self.assertEqual(list(new), masks[1:] + ['*!*@new.example'])
+        self.assertNotIn(1, new.ids)
+        self.assertEqual(new.ids[501], '*!*@new.example')
+        self.assertIsNone(new.index.match(hostmask, account))
+        self.assertEqual(new.index.match('n!u@new.example'),
+                         '*!*@new.example')
+        # Shards the change didn't touch are shared, not copied
+        shared = sum(a is b for (a, b) in zip(bans._shards, new._shards))
+        touched = {hash(mask) % len(bans._shards)
+                   for mask in (masks[0], '*!*@new.example')}
+        self.assertEqual(shared, len(bans._shards) - len(touched))
+
+
+class BlacklistSqliteTestCase(BlacklistTestCase):
+    config = dict(BlacklistTestCase.config,
+                  **{'supybot.plugins.Blacklist.storageBackend': 'sqlite'})
+
+    def setUp(self):
+        super().setUp()
+        # config is only applied once the plugin is loaded; load it again
+        self._reload()
+
+    def testLazyLoad(self):
+        cb = self.irc.getCallback('Blacklist')
+        cb._internal_add(self.channel, '*!*@lazy.example', 'op', 'x', is_bot_cmd=True)
+        cb._internal_add('#elsewhere', '*!*@far.example', 'op', 'x',
+                         is_bot_cmd=True, expiry_at=time.time() + 600)
+        with conf.supybot.plugins.Blacklist.lazyLoad.context(True):
+            cb = self._reload()
+        self.assertEqual(cb.db, {})
+        # timed bans of channels not loaded yet still expire
+        self.assertIn(('#elsewhere', '*!*@far.example'), cb._wheel)
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='a!u@lazy.example'))
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args[1:], ('+b', '*!*@lazy.example'))
+        self._drain()
+        self.assertEqual(list(cb.db), ['#test'])
+        cb._used['#test'] -= 2 * 3600
+        cb._evictIdle()
+        self.assertEqual(cb.db, {})
+        self.assertResponse('blacklist stats', 'Channel #test has 1 bans in the blacklist.')
+        cb._internal_add(self.channel, '*!*@next.example', 'op', 'x', is_bot_cmd=True)
+        self.assertEqual(cb.db['#test']['*!*@next.example'][5], 2)
+
+    def testBanIdsUnique(self):
+        cb = self.irc.getCallback('Blacklist')
+        from Blacklist.storage import SqliteStore
+        other = SqliteStore(cb._store.path)
+        other.load()
+        # The other process adds behind our back, with the ID we'd give next
+        other.add('#test', '*!*@theirs.example', ['op', time.time(), 'y', True, None, 1])
+        self.assertEqual(other.addMany('#test', [
+            ('*!*@theirs.example', ['op', time.time(), 'y', True, None, 7]),
+            ('*!*@more.example', ['op', time.time(), 'y', True, None, 1])]), [1, 2])
+        # We haven't seen those yet and propose 1 too: the store gives us 3
+        cb._internal_add(self.channel, '*!*@mine.example', 'op', 'x', is_bot_cmd=True)
+        self.assertEqual(cb.db['#test']['*!*@mine.example'][5], 3)
+        cb._pollStore()
+        # Both processes' bans are here, each with its own ID
+        self.assertEqual(sorted(cb.db['#test'].ids.items()),
+                         [(1, '*!*@theirs.example'), (2, '*!*@more.example'),
+                          (3, '*!*@mine.example')])
+        self.assertEqual(len(cb.db['#test']), 3)
+        cb._internal_add(self.channel, '*!*@next.example', 'op', 'x', is_bot_cmd=True)
+        self.assertEqual(cb.db['#test']['*!*@next.example'][5], 4)
+        # Duplicates left by older versions are renumbered on the next start
+        conn = other._conn
+        with conn:
+            conn.execute('DROP INDEX bans_ban_id')
+            conn.execute("UPDATE bans SET ban_id = 1 WHERE mask = '*!*@next.example'")
+        other.close()
+        cb = self._reload()
+        self.assertEqual(cb.db['#test']['*!*@theirs.example'][5], 1)
+        self.assertEqual(cb.db['#test']['*!*@next.example'][5], 4)
+        self.assertEqual(len(cb.db['#test'].ids), 4)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
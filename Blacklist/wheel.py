@@ -0,0 +1,88 @@
+import math
+
+
+class TimingWheel(object):
+    """Hierarchical timing wheel holding one deadline per key.
+
+    Level 0 has one slot per tick of `resolution` seconds; each level above
+    covers `slots` times the span of the one below and is cascaded down as
+    the clock reaches it, so scheduling and cancelling are O(1) and advance()
+    only touches the timers that are due. Only the timer registered last for
+    a key is live; stale slot entries are skipped when they come up."""
+
+    def __init__(self, resolution, now, slots=64, levels=4):
+        self.resolution = resolution
+        self.slots = slots
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._tick = int(now // resolution)
+        self._timers = {}
+        self._overdue = []
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def schedule(self, key, when, payload=None):
+        """Fires key, with payload, on the first tick at or after `when`,
+        replacing any timer already registered for it."""
+        tick = int(math.ceil(when / self.resolution))
+        self._timers[key] = (tick, payload)
+        if tick <= self._tick:
+            self._overdue.append((key, tick))
+        else:
+            self._place(key, tick)
+
+    def cancel(self, key):
+        return self._timers.pop(key, None) is not None
+
+    def _place(self, key, tick):
+        delta = tick - self._tick
+        if delta < 0:
+            self._overdue.append((key, tick))
+            return
+        span = 1
+        for level, wheel in enumerate(self._wheels):
+            if delta < span * self.slots or level == len(self._wheels) - 1:
+                wheel[(tick // span) % self.slots].append((key, tick))
+                return
+            span *= self.slots
+
+    def _collect(self, key, tick, due):
+        timer = self._timers.get(key)
+        if timer is not None and timer[0] == tick:
+            del self._timers[key]
+            due.append((key, timer[1]))
+
+    def advance(self, now):
+        """Moves the clock to `now` and returns the (key, payload) pairs that
+        became due, in deadline order."""
+        target = int(now // self.resolution)
+        due = []
+        overdue, self._overdue = self._overdue, []
+        for (key, tick) in sorted(overdue, key=lambda t: t[1]):
+            self._collect(key, tick, due)
+        if not self._timers:
+            self._tick = max(self._tick, target)
+            return due
+        while self._tick < target:
+            self._tick += 1
+            span = self.slots
+            for wheel in self._wheels[1:]:
+                if self._tick % span:
+                    break
+                slot = (self._tick // span) % self.slots
+                bucket, wheel[slot] = wheel[slot], []
+                for (key, tick) in bucket:
+                    timer = self._timers.get(key)
+                    if timer is not None and timer[0] == tick:
+                        self._place(key, tick)
+                span *= self.slots
+            slot = self._tick % self.slots
+            bucket, self._wheels[0][slot] = self._wheels[0][slot], []
+            for (key, tick) in bucket:
+                self._collect(key, tick, due)
+        return due
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,88 @@
+###
+# Copyright (c) 2025, PeGaSuS <https://github.com/TehPeGaSuS/supy-plugins>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+from collections.abc import MutableMapping
+
+from sortedcontainers import SortedList
+
+
+class Leaderboard(MutableMapping):
+    """
+    A {nick: value} dict that also keeps its players in rank order, so that
+    the top-k list costs O(k) and a player's rank O(log n) instead of a sort
+    of the whole channel every time.
+
+    Ranks go from the lowest value up (times), or from the highest down
+    (scores) if reverse is true. Players with equal values are ordered by
+    nick.
+    """
+
+    def __init__(self, values=(), reverse=False):
+        self._sign = -1 if reverse else 1
+        self._values = dict(values)
+        self._order = SortedList(
+            (self._sign * value, nick) for nick, value in self._values.items()
+        )
+
+    def __getitem__(self, nick):
+        return self._values[nick]
+
+    def __setitem__(self, nick, value):
+        if nick in self._values:
+            self._order.remove((self._sign * self._values[nick], nick))
+        self._values[nick] = value
+        self._order.add((self._sign * value, nick))
+
+    def __delitem__(self, nick):
+        value = self._values.pop(nick)
+        self._order.remove((self._sign * value, nick))
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def top(self, k):
+        """
+        Returns [(nick, value)] for the k best players, best first
+        """
+        return [(nick, self._sign * key) for key, nick in self._order.islice(0, k)]
+
+    def rank(self, nick):
+        """
+        Returns nick's rank (1 is the best; players with equal values share
+        a rank), or None if nick is not on the board
+        """
+        if nick not in self._values:
+            return None
+        return self._order.bisect_left((self._sign * self._values[nick],)) + 1
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -37,7 +37,62 @@ import supybot.log as log
 import supybot.conf as conf
 from operator import itemgetter
 
-import threading, random, pickle, os, time, datetime
+import threading, random, os, time, datetime, heapq
+
+from .leaderboard import Leaderboard
+from .store import ScoreStore
+
+
+class HuntState(object):
+    """
+    The state of the hunt in one channel of one network
+    """
+
+    __slots__ = (
+        "started",  # Has the hunt started?
+        "zombie",  # Is there currently a zombie to shoot?
+        "shoots",  # Number of successfull shoots in a hunt
+        "scores",  # Scores for the current hunt
+        "times",  # When the current zombie was launched
+        "toptimes",  # Times for the current hunt
+        "worsttimes",  # Worst times for the current hunt
+        "averagetime",  # Average shooting time for the current hunt
+        "fridayMode",  # Are we on friday mode? (automatic)
+        "manualFriday",  # Are we on friday mode? (manual)
+        "missprobability",  # Probability to miss a zombie when shooting
+        "reloading",  # Who is currently reloading?
+        "reloadtime",  # Time to reload after shooting (in seconds)
+        "reloadcount",  # Number of shots fired while reloading
+        # Does a zombie needs to be launched?
+        "lastSpoke",
+        "minthrottle",
+        "maxthrottle",
+        "throttle",
+        "deadline",  # When the next zombie is scheduled
+        "launchirc",  # (irc, channel) to launch it with
+    )
+
+    def __init__(self):
+        self.started = False
+        self.zombie = False
+        self.shoots = 0
+        self.scores = {}
+        self.times = False
+        self.toptimes = {}
+        self.worsttimes = {}
+        self.averagetime = 0
+        self.fridayMode = False
+        self.manualFriday = False
+        self.missprobability = 0.2
+        self.reloading = {}
+        self.reloadtime = 5
+        self.reloadcount = {}
+        self.lastSpoke = 0
+        self.minthrottle = 30
+        self.maxthrottle = 300
+        self.throttle = 0
+        self.deadline = None
+        self.launchirc = None
 
 
 class ZombieHunt(callbacks.Plugin):
@@ -48,37 +103,10 @@ class ZombieHunt(callbacks.Plugin):
     when there is no zombie launched costs a point.
     """
 
-    # Those parameters are per-channel parameters
-    started = {}  # Has the hunt started?
-    zombie = {}  # Is there currently a zombie to shoot?
-    shoots = {}  # Number of successfull shoots in a hunt
-    scores = {}  # Scores for the current hunt
-    times = {}  # Elapsed time since the last zombie was launched
-    channelscores = {}  # Saved scores for the channel
-    toptimes = {}  # Times for the current hunt
-    channeltimes = {}  # Saved times for the channel
-    worsttimes = {}  # Worst times for the current hunt
-    channelworsttimes = {}  # Saved worst times for the channel
-    averagetime = {}  # Average shooting time for the current hunt
-    fridayMode = {}  # Are we on friday mode? (automatic)
-    manualFriday = {}  # Are we on friday mode? (manual)
-    missprobability = {}  # Probability to miss a zombie when shooting
-    week = {}  # Scores for the week
-    channelweek = {}  # Saved scores for the week
-    leader = {}  # Who is the leader for the week?
-    reloading = {}  # Who is currently reloading?
-    reloadtime = {}  # Time to reload after shooting (in seconds)
-    reloadcount = {}  # Number of shots fired while reloading
-
-    # Does a zombie needs to be launched?
-    lastSpoke = {}
-    minthrottle = {}
-    maxthrottle = {}
-    throttle = {}
-
     # Where to save scores?
     fileprefix = "ZombieHunt_"
     path = conf.supybot.directories.data
+    dbname = "ZombieHunt.sqlite3"
 
     # Enable the 'dbg' command, which launch a zombie, if true
     debug = 0
@@ -101,14 +129,14 @@ class ZombieHunt(callbacks.Plugin):
         "Sunday",
     ]
 
-    def _calc_scores(self, channel):
+    def _calc_scores(self, channel, hunt):
         """
         Adds new scores and times to the already saved ones
         """
 
         # scores
         # Adding current scores to the channel scores
-        for player, value in self.scores[channel].items():
+        for player, value in hunt.scores.items():
             if not player in self.channelscores[channel]:
                 # It's a new player
                 self.channelscores[channel][player] = value
@@ -118,30 +146,34 @@ class ZombieHunt(callbacks.Plugin):
 
         # times
         # Adding times scores to the channel scores
-        for player, value in self.toptimes[channel].items():
+        for player, value in hunt.toptimes.items():
             if not player in self.channeltimes[channel]:
                 # It's a new player
                 self.channeltimes[channel][player] = value
             else:
                 # It's a player that already has a saved score
                 # And we save the time of the current hunt if it's better than it's previous time
-                if self.toptimes[channel][player] < self.channeltimes[channel][player]:
-                    self.channeltimes[channel][player] = self.toptimes[channel][player]
+                if hunt.toptimes[player] < self.channeltimes[channel][player]:
+                    self.channeltimes[channel][player] = hunt.toptimes[player]
 
         # worst times
         # Adding worst times scores to the channel scores
-        for player, value in self.worsttimes[channel].items():
+        for player, value in hunt.worsttimes.items():
             if not player in self.channelworsttimes[channel]:
                 # It's a new player
                 self.channelworsttimes[channel][player] = value
             else:
                 # It's a player that already has a saved score
                 # And we save the time of the current hunt if it's worst than it's previous time
-                if self.worsttimes[channel][player] > value:
+                if hunt.worsttimes[player] > value:
                     self.channelworsttimes[channel][player] = value
 
         # week scores
-        for player, value in self.scores[channel].items():
+        totals = self._week_totals(channel, self.woy)
+        for player, value in hunt.scores.items():
+            # Running total for the week
+            totals[player] = totals.get(player, 0) + value
+
             # Ensure that the channel exists
             if channel not in self.channelweek:
                 self.channelweek[channel] = {}
@@ -162,68 +194,164 @@ class ZombieHunt(callbacks.Plugin):
                 # It's a player that already has a saved score
                 self.channelweek[channel][self.woy][self.dow][player] += value
 
+    def __init__(self, irc):
+        self.__parent = super(ZombieHunt, self)
+        self.__parent.__init__(irc)
+        self.store = ScoreStore(self.path.dirize(self.dbname))
+
+        # The hunts, by (network, channel)
+        self.hunts = {}
+
+        # Saved scores and times, by channel (as in the store): a channel name
+        # shares them, and the lead of the week, on every network
+        self.channelscores = {}  # Saved scores for the channel (Leaderboard)
+        self.channeltimes = {}  # Saved times for the channel (Leaderboard)
+        self.channelworsttimes = {}  # Saved worst times for the channel (Leaderboard)
+        self.channelweek = {}  # Saved scores for the week
+        self.weektotals = {}  # Total scores of each week for the channel (Leaderboard)
+        self.leaders = {}  # Who has the lead of the week totals of the channel
+        self.loaded = set()  # Channels whose saved scores were read from the store
+
+        # Next zombie launch of every hunt: one event, scheduled for the
+        # earliest of the (deadline, (network, channel)) entries of the heap
+        self.deadlines = []
+        self.armed = None  # When the launcher event is scheduled for
+        if self.store.open():
+            # New database: bring in the scores of the old pickle files
+            imported, failed = self.store.importPickles(
+                self.path(), self.fileprefix
+            )
+            if imported:
+                self.log.info("ZombieHunt: imported %s", ", ".join(imported))
+            for filename in failed:
+                self.log.warning("ZombieHunt: could not import %s", filename)
+
+    def die(self):
+        try:
+            schedule.removeEvent("ZombieHunt_launcher")
+        except KeyError:
+            pass
+        self.store.close()
+        self.__parent.die()
+
     def _write_scores(self, channel):
         """
-        Write scores and times to the disk
+        Write scores and times to the disk (after they have been edited)
         """
-
-        # scores
-        outputfile = open(self.path.dirize(self.fileprefix + channel + ".scores"), "wb")
-        pickle.dump(self.channelscores[channel], outputfile)
-        outputfile.close()
-
-        # times
-        outputfile = open(self.path.dirize(self.fileprefix + channel + ".times"), "wb")
-        pickle.dump(self.channeltimes[channel], outputfile)
-        outputfile.close()
-
-        # worst times
-        outputfile = open(
-            self.path.dirize(self.fileprefix + channel + ".worsttimes"), "wb"
+        self.store.save(
+            channel,
+            self.year,
+            self.channelscores.get(channel, {}),
+            self.channeltimes.get(channel, {}),
+            self.channelworsttimes.get(channel, {}),
+            self.channelweek.get(channel, {}),
         )
-        pickle.dump(self.channelworsttimes[channel], outputfile)
-        outputfile.close()
 
-        # week scores
-        outputfile = open(
-            self.path.dirize(self.fileprefix + channel + self.year + ".weekscores"),
-            "wb",
+    def _hunt(self, irc, channel):
+        """
+        Returns the HuntState of <channel> on the network of <irc>
+        """
+        key = (irc.network, channel)
+        hunt = self.hunts.get(key)
+        if hunt is None:
+            hunt = self.hunts[key] = HuntState()
+        return hunt
+
+    def _record_hunt(self, channel, hunt):
+        """
+        Write the results of the hunt that just ended, and the new totals of
+        its players, to the disk
+        """
+        players = hunt.scores
+        results = [
+            (
+                player,
+                value,
+                hunt.toptimes.get(player),
+                hunt.worsttimes.get(player),
+            )
+            for player, value in players.items()
+        ]
+        totals = [
+            (
+                player,
+                self.channelscores[channel].get(player),
+                self.channeltimes[channel].get(player),
+                self.channelworsttimes[channel].get(player),
+            )
+            for player in players
+        ]
+        day = self.channelweek[channel][self.woy][self.dow]
+        self.store.recordHunt(
+            channel,
+            time.time(),
+            self.year,
+            self.woy,
+            self.dow,
+            results,
+            totals,
+            {player: day[player] for player in players},
         )
-        pickle.dump(self.channelweek[channel], outputfile)
-        outputfile.close()
 
     def _read_scores(self, channel):
         """
-        Reads scores and times from disk
+        Reads scores and times from the store, the first time they are needed
+        for <channel>
         """
-        filename = self.path.dirize(self.fileprefix + channel)
+        # Checked on its own: a channel may well have no times or week
+        # scores yet, and must not be read again on every command for that
+        if channel in self.loaded:
+            return
+        scores, times, worsttimes, week = self.store.load(channel, self.year)
+
         # scores
         if not self.channelscores.get(channel):
-            if os.path.isfile(filename + ".scores"):
-                inputfile = open(filename + ".scores", "rb")
-                self.channelscores[channel] = pickle.load(inputfile)
-                inputfile.close()
+            self.channelscores[channel] = Leaderboard(scores, reverse=True)
 
         # times
         if not self.channeltimes.get(channel):
-            if os.path.isfile(filename + ".times"):
-                inputfile = open(filename + ".times", "rb")
-                self.channeltimes[channel] = pickle.load(inputfile)
-                inputfile.close()
+            self.channeltimes[channel] = Leaderboard(times)
 
         # worst times
         if not self.channelworsttimes.get(channel):
-            if os.path.isfile(filename + ".worsttimes"):
-                inputfile = open(filename + ".worsttimes", "rb")
-                self.channelworsttimes[channel] = pickle.load(inputfile)
-                inputfile.close()
+            self.channelworsttimes[channel] = Leaderboard(worsttimes, reverse=True)
 
         # week scores
         if not self.channelweek.get(channel):
-            if os.path.isfile(filename + self.year + ".weekscores"):
-                inputfile = open(filename + self.year + ".weekscores", "rb")
-                self.channelweek[channel] = pickle.load(inputfile)
-                inputfile.close()
+            self.channelweek[channel] = week
+            self.weektotals.pop(channel, None)
+
+        self.loaded.add(channel)
+
+    def _week_totals(self, channel, week):
+        """
+        Returns the total scores of <week> for <channel>, as a Leaderboard.
+        They are added up from the day scores the first time they are needed,
+        and kept up to date when scores are added or merged afterwards
+        """
+        weeks = self.weektotals.setdefault(channel, {})
+        if week not in weeks:
+            totals = {}
+            for players in self.channelweek.get(channel, {}).get(week, {}).values():
+                for player, value in players.items():
+                    totals[player] = totals.get(player, 0) + value
+            weeks[week] = Leaderboard(totals, reverse=True)
+        return weeks[week]
+
+    def _retotal_week(self, channel, week, player):
+        """
+        Adds up <player>'s total for <week> again from the day scores
+        """
+        totals = self._week_totals(channel, week)
+        days = [
+            players[player]
+            for players in self.channelweek[channel][week].values()
+            if player in players
+        ]
+        if days:
+            totals[player] = sum(days)
+        elif player in totals:
+            del totals[player]
 
     def _initdayweekyear(self, channel):
         self.dow = int(time.strftime("%u"))  # Day of week
@@ -247,60 +375,50 @@ class ZombieHunt(callbacks.Plugin):
     def _initthrottle(self, irc, msg, args, channel):
 
         self._initdayweekyear(channel)
-
-        if not self.leader.get(channel):
-            self.leader[channel] = None
+        hunt = self._hunt(irc, channel)
 
         # autoFriday?
-        if not self.fridayMode.get(channel):
-            self.fridayMode[channel] = False
-
-        if not self.manualFriday.get(channel):
-            self.manualFriday[channel] = False
-
         if self.registryValue("autoFriday", channel) == True:
             if (
                 int(time.strftime("%w")) == 5
                 and int(time.strftime("%H")) > 8
                 and int(time.strftime("%H")) < 17
             ):
-                self.fridayMode[channel] = True
+                hunt.fridayMode = True
             else:
-                self.fridayMode[channel] = False
+                hunt.fridayMode = False
 
         # Miss probability
         if self.registryValue("missProbability", channel):
-            self.missprobability[channel] = self.registryValue(
+            hunt.missprobability = self.registryValue(
                 "missProbability", channel
             )
         else:
-            self.missprobability[channel] = 0.2
+            hunt.missprobability = 0.2
 
         # Reload time
         if self.registryValue("reloadTime", channel):
-            self.reloadtime[channel] = self.registryValue("reloadTime", channel)
+            hunt.reloadtime = self.registryValue("reloadTime", channel)
         else:
-            self.reloadtime[channel] = 5
+            hunt.reloadtime = 5
 
-        if self.fridayMode[channel] == False and self.manualFriday[channel] == False:
+        if hunt.fridayMode == False and hunt.manualFriday == False:
             # Init min throttle[currentChannel] and max throttle[currentChannel]
             if self.registryValue("minthrottle", channel):
-                self.minthrottle[channel] = self.registryValue("minthrottle", channel)
+                hunt.minthrottle = self.registryValue("minthrottle", channel)
             else:
-                self.minthrottle[channel] = 30
+                hunt.minthrottle = 30
 
             if self.registryValue("maxthrottle", channel):
-                self.maxthrottle[channel] = self.registryValue("maxthrottle", channel)
+                hunt.maxthrottle = self.registryValue("maxthrottle", channel)
             else:
-                self.maxthrottle[channel] = 300
+                hunt.maxthrottle = 300
 
         else:
-            self.minthrottle[channel] = 3
-            self.maxthrottle[channel] = 60
+            hunt.minthrottle = 3
+            hunt.maxthrottle = 60
 
-        self.throttle[channel] = random.randint(
-            self.minthrottle[channel], self.maxthrottle[channel]
-        )
+        hunt.throttle = random.randint(hunt.minthrottle, hunt.maxthrottle)
 
     def starthunt(self, irc, msg, args):
         """
@@ -309,8 +427,9 @@ class ZombieHunt(callbacks.Plugin):
 
         currentChannel = msg.args[0]
         if irc.isChannel(currentChannel):
+            hunt = self._hunt(irc, currentChannel)
 
-            if self.started.get(currentChannel) == True:
+            if hunt.started == True:
                 irc.reply("There is already a hunt right now!")
             else:
 
@@ -323,70 +442,54 @@ class ZombieHunt(callbacks.Plugin):
                 try:
                     self.channelscores[currentChannel]
                 except:
-                    self.channelscores[currentChannel] = {}
+                    self.channelscores[currentChannel] = Leaderboard(reverse=True)
 
                 # Init saved times
                 try:
                     self.channeltimes[currentChannel]
                 except:
-                    self.channeltimes[currentChannel] = {}
+                    self.channeltimes[currentChannel] = Leaderboard()
 
                 # Init saved times
                 try:
                     self.channelworsttimes[currentChannel]
                 except:
-                    self.channelworsttimes[currentChannel] = {}
+                    self.channelworsttimes[currentChannel] = Leaderboard(reverse=True)
 
                 # Init times
-                self.toptimes[currentChannel] = {}
-                self.worsttimes[currentChannel] = {}
+                hunt.toptimes = {}
+                hunt.worsttimes = {}
 
                 # Init bangdelay
-                self.times[currentChannel] = False
+                hunt.times = False
 
                 # Init lastSpoke
-                self.lastSpoke[currentChannel] = time.time()
+                hunt.lastSpoke = time.time()
 
                 # Reinit current hunt scores
-                if self.scores.get(currentChannel):
-                    self.scores[currentChannel] = {}
+                if hunt.scores:
+                    hunt.scores = {}
 
                 # Reinit reloading
-                self.reloading[currentChannel] = {}
+                hunt.reloading = {}
 
                 # Reinit reloadcount
-                self.reloadcount[currentChannel] = {}
+                hunt.reloadcount = {}
 
                 # No zombie launched
-                self.zombie[currentChannel] = False
+                hunt.zombie = False
 
                 # Hunt started
-                self.started[currentChannel] = True
+                hunt.started = True
 
                 # Init shoots
-                self.shoots[currentChannel] = 0
+                hunt.shoots = 0
 
                 # Init averagetime
-                self.averagetime[currentChannel] = 0
-
-                # Init schedule
-
-                # First of all, stop the scheduler if it was still running
-                try:
-                    schedule.removeEvent("ZombieHunt_" + currentChannel)
-                except KeyError:
-                    pass
+                hunt.averagetime = 0
 
-                # Then restart it
-                def myEventCaller():
-                    self._launchEvent(irc, msg)
-
-                try:
-                    schedule.addPeriodicEvent(
-                        myEventCaller, 5, "ZombieHunt_" + currentChannel, False
-                    )
-                except AssertionError:
-                    pass
+                # Schedule the first zombie
+                self._schedule_launch(irc, currentChannel, hunt)
 
                 irc.reply("The zombie hunt starts now!", prefixNick=False)
         else:
@@ -394,17 +497,58 @@ class ZombieHunt(callbacks.Plugin):
 
     starthunt = wrap(starthunt)
 
-    def _launchEvent(self, irc, msg):
-        currentChannel = msg.args[0]
+    def _schedule_launch(self, irc, channel, hunt):
+        """
+        (Re)schedules the next zombie of <hunt>, the hunt of <channel>,
+        throttle seconds after lastSpoke. An earlier deadline of the hunt
+        becomes stale and is skipped by the launcher
+        """
+        hunt.deadline = hunt.lastSpoke + hunt.throttle
+        hunt.launchirc = (irc, channel)
+        heapq.heappush(self.deadlines, (hunt.deadline, (irc.network, channel)))
+        self._arm()
+
+    def _arm(self):
+        """
+        Schedules the launcher for the earliest deadline, if it isn't already
+        """
+        when = self.deadlines[0][0] if self.deadlines else None
+        if when == self.armed:
+            return
+        try:
+            schedule.removeEvent("ZombieHunt_launcher")
+        except KeyError:
+            pass
+        self.armed = when
+        if when is not None:
+            schedule.addEvent(self._launcher, when, "ZombieHunt_launcher")
+
+    def _launcher(self):
+        """
+        Launches the zombies of every channel whose deadline has passed
+        """
+        self.armed = None
         now = time.time()
-        if irc.isChannel(currentChannel):
-            if self.started.get(currentChannel) == True:
-                if self.zombie[currentChannel] == False:
-                    if (
-                        now
-                        > self.lastSpoke[currentChannel] + self.throttle[currentChannel]
-                    ):
-                        self._launch(irc, msg, "")
+        try:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, key = heapq.heappop(self.deadlines)
+                hunt = self.hunts.get(key)
+                if hunt is None or hunt.deadline != deadline:
+                    # Rescheduled since, or the hunt was stopped
+                    continue
+                irc, channel = hunt.launchirc
+                hunt.deadline = hunt.launchirc = None
+                if hunt.started == True and hunt.zombie == False:
+                    try:
+                        self._launch(irc, channel)
+                    except Exception:
+                        # The other channels still get their zombies
+                        self.log.exception(
+                            "ZombieHunt: could not launch a zombie on %s %s", *key
+                        )
+        finally:
+            # Whatever happened, the remaining deadlines keep an event
+            self._arm()
 
     def stophunt(self, irc, msg, args):
         """
@@ -413,16 +557,14 @@ class ZombieHunt(callbacks.Plugin):
 
         currentChannel = msg.args[0]
         if irc.isChannel(currentChannel):
-            if self.started.get(currentChannel) == True:
+            hunt = self._hunt(irc, currentChannel)
+            if hunt.started == True:
                 self._end(irc, msg, args)
             else:
                 irc.reply("Nothing to stop: there's no hunt right now.")
             # If someone uses the stop command,
-            # we stop the scheduler, even if autoRestart is enabled
-            try:
-                schedule.removeEvent("ZombieHunt_" + currentChannel)
-            except:
-                pass
+            # we cancel the next zombie, even if autoRestart is enabled
+            hunt.deadline = hunt.launchirc = None
         else:
             irc.error("You have to be on a channel")
 
@@ -434,34 +576,35 @@ class ZombieHunt(callbacks.Plugin):
         Enable/disable friday mode! (there are lots of zombies on friday :))
         """
         if irc.isChannel(channel):
+            hunt = self._hunt(irc, channel)
 
             if status == "status":
                 irc.reply(
                     "Manual friday mode for "
                     + channel
                     + " is "
-                    + str(self.manualFriday.get(channel))
+                    + str(hunt.manualFriday)
                 )
                 irc.reply(
                     "Auto friday mode for "
                     + channel
                     + " is "
-                    + str(self.fridayMode.get(channel))
+                    + str(hunt.fridayMode)
                 )
             else:
-                if (
-                    self.manualFriday.get(channel) == None
-                    or self.manualFriday[channel] == False
-                ):
-                    self.manualFriday[channel] = True
+                if hunt.manualFriday == False:
+                    hunt.manualFriday = True
                     irc.reply(
                         "Friday mode is now enabled! Shoot alllllllllllll the zombies!"
                     )
                 else:
-                    self.manualFriday[channel] = False
+                    hunt.manualFriday = False
                     irc.reply("Friday mode is now disabled.")
 
             self._initthrottle(irc, msg, args, channel)
+            if hunt.started == True and hunt.zombie == False:
+                # <channel>, not msg.args[0]: this may come in a private message
+                self._schedule_launch(irc, channel, hunt)
         else:
             irc.error("You have to be on a channel")
 
@@ -474,8 +617,9 @@ class ZombieHunt(callbacks.Plugin):
 
         currentChannel = msg.args[0]
         if irc.isChannel(currentChannel):
-            if self.started.get(currentChannel) == True:
-                if self.zombie[currentChannel] == True:
+            hunt = self._hunt(irc, currentChannel)
+            if hunt.started == True:
+                if hunt.zombie == True:
                     irc.reply(
                         "There is currently a zombie! You can shoot it with the 'bang'"
                         " command"
@@ -506,7 +650,7 @@ class ZombieHunt(callbacks.Plugin):
             try:
                 self.channelscores[currentChannel]
             except:
-                self.channelscores[currentChannel] = {}
+                self.channelscores[currentChannel] = Leaderboard(reverse=True)
 
             try:
                 irc.reply(self.channelscores[currentChannel][nick])
@@ -517,6 +661,39 @@ class ZombieHunt(callbacks.Plugin):
 
     score = wrap(score, ["nick"])
 
+    def rank(self, irc, msg, args, channel, nick):
+        """
+        [<channel>] <nick>
+
+        Shows where <nick> stands in the score and fastest time lists of <channel>
+        """
+        if irc.isChannel(channel):
+            self._read_scores(channel)
+            scores = self.channelscores[channel]
+            times = self.channeltimes[channel]
+
+            msgstring = ""
+            if nick in scores:
+                msgstring += "score: %i (#%i of %i) " % (
+                    scores[nick],
+                    scores.rank(nick),
+                    len(scores),
+                )
+            if nick in times:
+                msgstring += "fastest time: %s (#%i of %i) " % (
+                    str(round(times[nick], 2)),
+                    times.rank(nick),
+                    len(times),
+                )
+            if msgstring != "":
+                irc.reply("x%sx on %s: %s" % (nick, channel, msgstring.strip()))
+            else:
+                irc.reply("There is no score for %s on %s" % (nick, channel))
+        else:
+            irc.reply("Are you sure this is a channel?")
+
+    rank = wrap(rank, ["channel", "nick"])
+
     def mergescores(self, irc, msg, args, channel, nickto, nickfrom):
         """
         [<channel>] <nickto> <nickfrom>
@@ -553,6 +730,8 @@ class ZombieHunt(callbacks.Plugin):
                     ][week][day][nickfrom]
 
                 del self.channelweek[channel][week][day][nickfrom]
+                self._retotal_week(channel, week, nickto)
+                self._retotal_week(channel, week, nickfrom)
                 self._write_scores(channel)
                 irc.reply("Day scores merged")
 
@@ -692,7 +871,6 @@ class ZombieHunt(callbacks.Plugin):
         if irc.isChannel(channel):
 
             self._read_scores(channel)
-            weekscores = {}
 
             if not week:
                 week = self.woy
@@ -714,20 +892,13 @@ class ZombieHunt(callbacks.Plugin):
                                     self.dayname[i - 1], winnernick, str(winnerscore)
                                 )
 
-                        # Getting all scores, to get the winner of the week
-                        for i, players in self.channelweek[channel][week].items():
-                            for player, value in players.items():
-                                weekscores.setdefault(player, 0)
-                                weekscores[player] += value
-
                         if msgstring != "":
                             irc.reply("Scores for week " + str(week) + ":")
                             irc.reply(msgstring)
                             # Who's the winner at this point?
-                            winnernick, winnerscore = max(
-                                iter(weekscores.items()),
-                                key=lambda k_v1: (k_v1[1], k_v1[0]),
-                            )
+                            [(winnernick, winnerscore)] = self._week_totals(
+                                channel, week
+                            ).top(1)
                             irc.reply(
                                 "Leader: x%sx with %i points."
                                 % (winnernick, winnerscore)
@@ -738,7 +909,7 @@ class ZombieHunt(callbacks.Plugin):
                     else:
                         # Showing the scores of <nick>
                         msgstring = ""
-                        total = 0
+                        total = self._week_totals(channel, week).get(nick, 0)
                         for i in (1, 2, 3, 4, 5, 6, 7):
                             if self.channelweek[channel][week].get(i):
                                 if self.channelweek[channel][week][i].get(nick):
@@ -748,9 +919,6 @@ class ZombieHunt(callbacks.Plugin):
                                             self.channelweek[channel][week][i].get(nick)
                                         ),
                                     )
-                                    total += self.channelweek[channel][week][i].get(
-                                        nick
-                                    )
 
                         if msgstring != "":
                             irc.reply(nick + " scores for week " + str(self.woy) + ":")
@@ -778,7 +946,7 @@ class ZombieHunt(callbacks.Plugin):
             try:
                 self.channelscores[channel]
             except:
-                self.channelscores[channel] = {}
+                self.channelscores[channel] = Leaderboard(reverse=True)
 
             self._read_scores(channel)
 
@@ -788,13 +956,8 @@ class ZombieHunt(callbacks.Plugin):
             else:
                 listsize = size
 
-            # Sort the scores (reversed: the higher the better)
-            scores = sorted(
-                iter(self.channelscores[channel].items()),
-                key=itemgetter(1),
-                reverse=True,
-            )
-            del scores[listsize:]
+            # The scores are kept sorted (the higher the better)
+            scores = self.channelscores[channel].top(listsize)
 
             msgstring = ""
             for item in scores:
@@ -850,12 +1013,12 @@ class ZombieHunt(callbacks.Plugin):
             try:
                 self.channeltimes[channel]
             except:
-                self.channeltimes[channel] = {}
+                self.channeltimes[channel] = Leaderboard()
 
             try:
                 self.channelworsttimes[channel]
             except:
-                self.channelworsttimes[channel] = {}
+                self.channelworsttimes[channel] = Leaderboard(reverse=True)
 
             # How many results do we display?
             if not size:
@@ -863,13 +1026,8 @@ class ZombieHunt(callbacks.Plugin):
             else:
                 listsize = size
 
-            # Sort the times (not reversed: the lower the better)
-            times = sorted(
-                iter(self.channeltimes[channel].items()),
-                key=itemgetter(1),
-                reverse=False,
-            )
-            del times[listsize:]
+            # The times are kept sorted (the lower the better)
+            times = self.channeltimes[channel].top(listsize)
 
             msgstring = ""
             for item in times:
@@ -888,12 +1046,7 @@ class ZombieHunt(callbacks.Plugin):
             else:
                 irc.reply("There aren't any best times for this channel yet.")
 
-            times = sorted(
-                iter(self.channelworsttimes[channel].items()),
-                key=itemgetter(1),
-                reverse=True,
-            )
-            del times[listsize:]
+            times = self.channelworsttimes[channel].top(listsize)
 
             msgstring = ""
             for item in times:
@@ -926,7 +1079,7 @@ class ZombieHunt(callbacks.Plugin):
         currentChannel = msg.args[0]
         if self.debug:
             if irc.isChannel(currentChannel):
-                self._launch(irc, msg, "")
+                self._launch(irc, currentChannel)
 
     dbg = wrap(dbg)
 
@@ -937,41 +1090,35 @@ class ZombieHunt(callbacks.Plugin):
         currentChannel = msg.args[0]
 
         if irc.isChannel(currentChannel):
-            if self.started.get(currentChannel) == True:
+            hunt = self._hunt(irc, currentChannel)
+            if hunt.started == True:
 
                 # bangdelay: how much time between the zombie was launched and this shot?
-                if self.times[currentChannel]:
-                    bangdelay = time.time() - self.times[currentChannel]
+                if hunt.times:
+                    bangdelay = time.time() - hunt.times
                 else:
                     bangdelay = False
 
                 # Is the player reloading?
                 if (
-                    self.reloading[currentChannel].get(msg.nick)
-                    and time.time() - self.reloading[currentChannel][msg.nick]
-                    < self.reloadtime[currentChannel]
-                    and self.reloadcount[currentChannel][msg.nick] < 1
+                    hunt.reloading.get(msg.nick)
+                    and time.time() - hunt.reloading[msg.nick]
+                    < hunt.reloadtime
+                    and hunt.reloadcount[msg.nick] < 1
                 ):
                     irc.reply(
                         "You are reloading... (Reloading takes %i seconds)"
-                        % (self.reloadtime[currentChannel])
+                        % (hunt.reloadtime)
                     )
-                    self.reloadcount[currentChannel][msg.nick] += 1
+                    hunt.reloadcount[msg.nick] += 1
                     return 0
                 if (
-                    self.reloading[currentChannel].get(msg.nick)
-                    and time.time() - self.reloading[currentChannel][msg.nick]
-                    < self.reloadtime[currentChannel]
-                    and self.reloadcount[currentChannel][msg.nick] > 0
+                    hunt.reloading.get(msg.nick)
+                    and time.time() - hunt.reloading[msg.nick]
+                    < hunt.reloadtime
+                    and hunt.reloadcount[msg.nick] > 0
                 ):
-                    try:
-                        self.scores[currentChannel][msg.nick] -= 1
-                    except:
-                        try:
-                            self.scores[currentChannel][msg.nick] = -1
-                        except:
-                            self.scores[currentChannel] = {}
-                            self.scores[currentChannel][msg.nick] = -1
+                    hunt.scores[msg.nick] = hunt.scores.get(msg.nick, 0) - 1
 
                     # Base message
                     message = "You shot yourself while trying to reload!"
@@ -983,13 +1130,13 @@ class ZombieHunt(callbacks.Plugin):
                     ):
                         message += (
                             " Reloading takes %s seconds."
-                            % self.reloadtime[currentChannel]
+                            % hunt.reloadtime
                         )
 
                     # Adding nick and score
                     message += " %s: %i" % (
                         msg.nick,
-                        self.scores[currentChannel][msg.nick],
+                        hunt.scores[msg.nick],
                     )
 
                     # If we were able to have a bangdelay (ie: a zombie was launched before someone did bang)
@@ -1009,54 +1156,47 @@ class ZombieHunt(callbacks.Plugin):
                     return 0
 
                 # This player is now reloading
-                self.reloading[currentChannel][msg.nick] = time.time()
-                self.reloadcount[currentChannel][msg.nick] = 0
+                hunt.reloading[msg.nick] = time.time()
+                hunt.reloadcount[msg.nick] = 0
 
                 # There was a zombie
-                if self.zombie[currentChannel] == True:
+                if hunt.zombie == True:
 
                     # Did the player missed it?
-                    if random.random() < self.missprobability[currentChannel]:
+                    if random.random() < hunt.missprobability:
                         irc.reply("You missed the zombie!")
                     else:
 
                         # Adds one point for the nick that shot the zombie
-                        try:
-                            self.scores[currentChannel][msg.nick] += 1
-                        except:
-                            try:
-                                self.scores[currentChannel][msg.nick] = 1
-                            except:
-                                self.scores[currentChannel] = {}
-                                self.scores[currentChannel][msg.nick] = 1
+                        hunt.scores[msg.nick] = hunt.scores.get(msg.nick, 0) + 1
 
                         irc.reply(
                             "[X.x] *thud* | Score: %i (%.2f seconds)"
-                            % (self.scores[currentChannel][msg.nick], bangdelay)
+                            % (hunt.scores[msg.nick], bangdelay)
                         )
 
-                        self.averagetime[currentChannel] += bangdelay
+                        hunt.averagetime += bangdelay
 
                         # Now save the bang delay for the player (if it's quicker than it's previous bangdelay)
                         try:
-                            previoustime = self.toptimes[currentChannel][msg.nick]
+                            previoustime = hunt.toptimes[msg.nick]
                             if bangdelay < previoustime:
-                                self.toptimes[currentChannel][msg.nick] = bangdelay
+                                hunt.toptimes[msg.nick] = bangdelay
                         except:
-                            self.toptimes[currentChannel][msg.nick] = bangdelay
+                            hunt.toptimes[msg.nick] = bangdelay
 
                         # Now save the bang delay for the player (if it's worst than it's previous bangdelay)
                         try:
-                            previoustime = self.worsttimes[currentChannel][msg.nick]
+                            previoustime = hunt.worsttimes[msg.nick]
                             if bangdelay > previoustime:
-                                self.worsttimes[currentChannel][msg.nick] = bangdelay
+                                hunt.worsttimes[msg.nick] = bangdelay
                         except:
-                            self.worsttimes[currentChannel][msg.nick] = bangdelay
+                            hunt.worsttimes[msg.nick] = bangdelay
 
-                        self.zombie[currentChannel] = False
+                        hunt.zombie = False
 
                         # Reset the basetime for the waiting time before the next zombie
-                        self.lastSpoke[currentChannel] = time.time()
+                        hunt.lastSpoke = time.time()
 
                         if self.registryValue("zombies", currentChannel):
                             maxShoots = self.registryValue("zombies", currentChannel)
@@ -1064,33 +1204,30 @@ class ZombieHunt(callbacks.Plugin):
                             maxShoots = 10
 
                         # End of Hunt
-                        if self.shoots[currentChannel] == maxShoots:
+                        if hunt.shoots == maxShoots:
                             self._end(irc, msg, args)
 
                             # If autorestart is enabled, we restart a hunt automatically!
                             if self.registryValue("autoRestart", currentChannel):
                                 # This code shouldn't be here
-                                self.started[currentChannel] = True
+                                hunt.started = True
                                 self._initthrottle(irc, msg, args, currentChannel)
-                                if self.scores.get(currentChannel):
-                                    self.scores[currentChannel] = {}
-                                if self.reloading.get(currentChannel):
-                                    self.reloading[currentChannel] = {}
+                                if hunt.scores:
+                                    hunt.scores = {}
+                                if hunt.reloading:
+                                    hunt.reloading = {}
 
-                                self.averagetime[currentChannel] = 0
+                                hunt.averagetime = 0
+
+                        # Schedule the next zombie
+                        if hunt.started == True:
+                            self._schedule_launch(irc, currentChannel, hunt)
 
                 # There was no zombie or the zombie has already been shot
                 else:
 
                     # Removes one point for the nick that shot
-                    try:
-                        self.scores[currentChannel][msg.nick] -= 1
-                    except:
-                        try:
-                            self.scores[currentChannel][msg.nick] = -1
-                        except:
-                            self.scores[currentChannel] = {}
-                            self.scores[currentChannel][msg.nick] = -1
+                    hunt.scores[msg.nick] = hunt.scores.get(msg.nick, 0) - 1
 
                     # Base message
                     message = "There was no zombie!"
@@ -1105,7 +1242,7 @@ class ZombieHunt(callbacks.Plugin):
                     # Adding nick and score
                     message += " %s: %i" % (
                         msg.nick,
-                        self.scores[currentChannel][msg.nick],
+                        hunt.scores[msg.nick],
                     )
 
                     # If we were able to have a bangdelay (ie: a zombie was launched before someone did bang)
@@ -1154,24 +1291,25 @@ class ZombieHunt(callbacks.Plugin):
         """
 
         currentChannel = msg.args[0]
+        hunt = self._hunt(irc, currentChannel)
 
         # End the hunt
-        self.started[currentChannel] = False
+        hunt.started = False
 
         try:
             self.channelscores[currentChannel]
         except:
-            self.channelscores[currentChannel] = {}
+            self.channelscores[currentChannel] = Leaderboard(reverse=True)
 
         if not self.registryValue("autoRestart", currentChannel):
             irc.reply("The hunt stops now!", prefixNick=False)
 
         # Showing scores
-        if self.scores.get(currentChannel):
+        if hunt.scores:
 
             # Getting winner
             winnernick, winnerscore = max(
-                iter(self.scores.get(currentChannel).items()),
+                iter(hunt.scores.items()),
                 key=lambda k_v12: (k_v12[1], k_v12[0]),
             )
             if self.registryValue("zombies", currentChannel):
@@ -1186,14 +1324,14 @@ class ZombieHunt(callbacks.Plugin):
                     % (winnernick, winnerscore, maxShoots, self.perfectbonus),
                     prefixNick=False,
                 )
-                self.scores[currentChannel][winnernick] += self.perfectbonus
+                hunt.scores[winnernick] += self.perfectbonus
             else:
                 # Showing scores
                 # irc.reply("Winner: %s with %i points" % (winnernick, winnerscore))
-                # irc.reply(self.scores.get(currentChannel))
+                # irc.reply(hunt.scores)
                 reply = []
                 for nick, score in sorted(
-                    iter(self.scores.get(currentChannel).items()),
+                    iter(hunt.scores.items()),
                     key=itemgetter(1),
                     reverse=True,
                 ):
@@ -1212,17 +1350,16 @@ class ZombieHunt(callbacks.Plugin):
             channelbestnick = None
             channelbesttime = None
             if self.channeltimes.get(currentChannel):
-                channelbestnick, channelbesttime = min(
-                    iter(self.channeltimes.get(currentChannel).items()),
-                    key=lambda k_v5: (k_v5[1], k_v5[0]),
-                )
+                [(channelbestnick, channelbesttime)] = self.channeltimes[
+                    currentChannel
+                ].top(1)
 
             # Showing best time
             recordmsg = ""
             try:
-                if self.toptimes.get(currentChannel):
+                if hunt.toptimes:
                     key, value = min(
-                        iter(self.toptimes.get(currentChannel).items()),
+                        iter(hunt.toptimes.items()),
                         key=lambda k_v6: (k_v6[1], k_v6[0]),
                     )
                 if channelbesttime and value < channelbesttime:
@@ -1256,17 +1393,16 @@ class ZombieHunt(callbacks.Plugin):
             channelworstnick = None
             channelworsttime = None
             if self.channelworsttimes.get(currentChannel):
-                channelworstnick, channelworsttime = max(
-                    iter(self.channelworsttimes.get(currentChannel).items()),
-                    key=lambda k_v7: (k_v7[1], k_v7[0]),
-                )
+                [(channelworstnick, channelworsttime)] = self.channelworsttimes[
+                    currentChannel
+                ].top(1)
 
             # Showing worst time
             recordmsg = ""
             try:
-                if self.worsttimes.get(currentChannel):
+                if hunt.worsttimes:
                     key, value = max(
-                        iter(self.worsttimes.get(currentChannel).items()),
+                        iter(hunt.worsttimes.items()),
                         key=lambda k_v8: (k_v8[1], k_v8[0]),
                     )
                 if channelworsttime and value > channelworsttime:
@@ -1304,97 +1440,76 @@ class ZombieHunt(callbacks.Plugin):
                 )
 
             # Showing average shooting time:
-            # if (self.shoots[currentChannel] > 1):
-            # irc.reply("Average shooting time: %.2f seconds" % ((self.averagetime[currentChannel] / self.shoots[currentChannel])))
+            # if (hunt.shoots > 1):
+            # irc.reply("Average shooting time: %.2f seconds" % ((hunt.averagetime / hunt.shoots)))
 
             # Write the scores and times to disk
-            self._calc_scores(currentChannel)
-            self._write_scores(currentChannel)
+            self._calc_scores(currentChannel, hunt)
+            self._record_hunt(currentChannel, hunt)
 
             # Did someone took the lead?
-            weekscores = {}
-            if self.channelweek.get(currentChannel):
-                if self.channelweek[currentChannel].get(self.woy):
-                    # for each day of week
-                    for i in (1, 2, 3, 4, 5, 6, 7):
-                        if self.channelweek[currentChannel][self.woy].get(i):
-                            # Getting all scores, to get the winner of the week
-                            for i, players in self.channelweek[currentChannel][
-                                self.woy
-                            ].items():
-                                for player, value in players.items():
-                                    weekscores.setdefault(player, 0)
-                                    weekscores[player] += value
-                            winnernick, winnerscore = max(
-                                iter(weekscores.items()),
-                                key=lambda k_v3: (k_v3[1], k_v3[0]),
-                            )
-                            if winnernick != self.leader[currentChannel]:
-                                if self.leader[currentChannel] != None:
-                                    irc.reply(
-                                        "%s took the lead for the week over %s with %i"
-                                        " points."
-                                        % (
-                                            winnernick,
-                                            self.leader[currentChannel],
-                                            winnerscore,
-                                        ),
-                                        prefixNick=False,
-                                    )
-                                else:
-                                    irc.reply(
-                                        "%s has the lead for the week with %i points."
-                                        % (winnernick, winnerscore),
-                                        prefixNick=False,
-                                    )
-                                self.leader[currentChannel] = winnernick
+            # The leader keeps the lead as long as nobody has more points
+            totals = self._week_totals(currentChannel, self.woy)
+            leader = self.leaders.get(currentChannel)
+            if totals and totals.rank(leader) != 1:
+                [(winnernick, winnerscore)] = totals.top(1)
+                if leader != None:
+                    irc.reply(
+                        "%s took the lead for the week over %s with %i points."
+                        % (winnernick, leader, winnerscore),
+                        prefixNick=False,
+                    )
+                else:
+                    irc.reply(
+                        "%s has the lead for the week with %i points."
+                        % (winnernick, winnerscore),
+                        prefixNick=False,
+                    )
+                self.leaders[currentChannel] = winnernick
         else:
             irc.reply("Not a single zombie was shot during this hunt!", prefixNick=False)
 
         # Reinit current hunt scores
-        if self.scores.get(currentChannel):
-            self.scores[currentChannel] = {}
+        if hunt.scores:
+            hunt.scores = {}
 
         # Reinit current hunt times
-        if self.toptimes.get(currentChannel):
-            self.toptimes[currentChannel] = {}
-        if self.worsttimes.get(currentChannel):
-            self.worsttimes[currentChannel] = {}
+        if hunt.toptimes:
+            hunt.toptimes = {}
+        if hunt.worsttimes:
+            hunt.worsttimes = {}
 
         # No zombie lauched
-        self.zombie[currentChannel] = False
+        hunt.zombie = False
 
         # Reinit number of shoots
-        self.shoots[currentChannel] = 0
+        hunt.shoots = 0
 
-    def _launch(self, irc, msg, args):
+    def _launch(self, irc, currentChannel):
         """
-        Launch a zombie
+        Launch a zombie on <currentChannel>
         """
-        currentChannel = msg.args[0]
         if irc.isChannel(currentChannel):
-            if self.started[currentChannel] == True:
-                if self.zombie[currentChannel] == False:
+            hunt = self._hunt(irc, currentChannel)
+            if hunt.started == True:
+                if hunt.zombie == False:
 
                     # Store the time when the zombie has been launched
-                    self.times[currentChannel] = time.time()
+                    hunt.times = time.time()
 
                     # Store the fact that there's a zombie now
-                    self.zombie[currentChannel] = True
+                    hunt.zombie = True
 
                     # Send message directly (instead of queuing it with irc.reply)
                     irc.sendMsg(ircmsgs.privmsg(currentChannel, "[O.o] *brains*"))
 
                     # Define a new throttle[currentChannel] for the next launch
-                    self.throttle[currentChannel] = random.randint(
-                        self.minthrottle[currentChannel],
-                        self.maxthrottle[currentChannel],
+                    hunt.throttle = random.randint(
+                        hunt.minthrottle,
+                        hunt.maxthrottle,
                     )
 
-                    try:
-                        self.shoots[currentChannel] += 1
-                    except:
-                        self.shoots[currentChannel] = 1
+                    hunt.shoots += 1
                 else:
 
                     irc.reply("Already a zombie")
@@ -0,0 +1,260 @@
+###
+# Copyright (c) 2025, PeGaSuS <https://github.com/TehPeGaSuS/supy-plugins>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+import os
+import pickle
+import re
+import sqlite3
+import threading
+
+
+class ScoreStore(object):
+    """
+    Scores and times of every channel, kept in a single SQLite database.
+
+    Each hunt is stored in one transaction: a row in hunts, one row per
+    player in hunt_results, and the player's updated totals (total score,
+    best and worst time) and score of the day. Either all of it is written
+    or none of it is, so a crash can't leave half a hunt behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self):
+        """
+        Connects, creating the tables if needed. Returns True if the store
+        is empty, e.g. because it was just created.
+        """
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS hunts (
+                id INTEGER PRIMARY KEY,
+                channel TEXT NOT NULL,
+                ended_at REAL NOT NULL,
+                year INTEGER NOT NULL,
+                week INTEGER NOT NULL,
+                day INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS hunts_channel ON hunts (channel, ended_at);
+            CREATE TABLE IF NOT EXISTS hunt_results (
+                hunt_id INTEGER NOT NULL REFERENCES hunts (id),
+                nick TEXT NOT NULL,
+                score INTEGER NOT NULL,
+                best_time REAL,
+                worst_time REAL,
+                PRIMARY KEY (hunt_id, nick)
+            );
+            CREATE TABLE IF NOT EXISTS totals (
+                channel TEXT NOT NULL,
+                nick TEXT NOT NULL,
+                score INTEGER,
+                best_time REAL,
+                worst_time REAL,
+                PRIMARY KEY (channel, nick)
+            );
+            CREATE TABLE IF NOT EXISTS week_scores (
+                channel TEXT NOT NULL,
+                year INTEGER NOT NULL,
+                week INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                nick TEXT NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (channel, year, week, day, nick)
+            );
+            """
+        )
+        return (
+            self._conn.execute("SELECT 1 FROM totals LIMIT 1").fetchone() is None
+            and self._conn.execute("SELECT 1 FROM week_scores LIMIT 1").fetchone()
+            is None
+        )
+
+    def load(self, channel, year):
+        """
+        Returns (scores, times, worsttimes, week) for channel, the first three
+        as {nick: value} and week as {week: {day: {nick: score}}} for year.
+        """
+        scores, times, worsttimes, week = {}, {}, {}, {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT nick, score, best_time, worst_time FROM totals"
+                " WHERE channel = ?",
+                (channel,),
+            ).fetchall()
+            weekrows = self._conn.execute(
+                "SELECT week, day, nick, score FROM week_scores"
+                " WHERE channel = ? AND year = ?",
+                (channel, int(year)),
+            ).fetchall()
+        for nick, score, best, worst in rows:
+            if score is not None:
+                scores[nick] = score
+            if best is not None:
+                times[nick] = best
+            if worst is not None:
+                worsttimes[nick] = worst
+        for woy, dow, nick, score in weekrows:
+            week.setdefault(woy, {}).setdefault(dow, {})[nick] = score
+        return scores, times, worsttimes, week
+
+    @staticmethod
+    def _insertTotals(conn, channel, totals):
+        conn.executemany(
+            "INSERT OR REPLACE INTO totals (channel, nick, score, best_time,"
+            " worst_time) VALUES (?, ?, ?, ?, ?)",
+            [(channel,) + tuple(row) for row in totals],
+        )
+
+    def recordHunt(self, channel, at, year, week, day, results, totals, dayscores):
+        """
+        Stores a hunt that ended at time at, in one transaction.
+
+        results is [(nick, score, best, worst)] for the hunt itself, totals is
+        [(nick, score, best, worst)] with the players' totals including this
+        hunt, and dayscores is {nick: score} with their scores for the day.
+        Times are None for players who shot no zombie.
+        """
+        with self._lock, self._conn:
+            hunt = self._conn.execute(
+                "INSERT INTO hunts (channel, ended_at, year, week, day)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (channel, at, int(year), week, day),
+            ).lastrowid
+            self._conn.executemany(
+                "INSERT INTO hunt_results (hunt_id, nick, score, best_time,"
+                " worst_time) VALUES (?, ?, ?, ?, ?)",
+                [(hunt,) + tuple(row) for row in results],
+            )
+            self._insertTotals(self._conn, channel, totals)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO week_scores (channel, year, week, day,"
+                " nick, score) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (channel, int(year), week, day, nick, score)
+                    for nick, score in dayscores.items()
+                ],
+            )
+
+    @staticmethod
+    def _replaceTotals(conn, channel, scores, times, worsttimes):
+        conn.execute("DELETE FROM totals WHERE channel = ?", (channel,))
+        conn.executemany(
+            "INSERT INTO totals (channel, nick, score, best_time, worst_time)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [
+                (channel, nick, scores.get(nick), times.get(nick), worsttimes.get(nick))
+                for nick in set(scores) | set(times) | set(worsttimes)
+            ],
+        )
+
+    @staticmethod
+    def _replaceWeek(conn, channel, year, week):
+        conn.execute(
+            "DELETE FROM week_scores WHERE channel = ? AND year = ?",
+            (channel, int(year)),
+        )
+        conn.executemany(
+            "INSERT INTO week_scores (channel, year, week, day, nick, score)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (channel, int(year), woy, dow, nick, score)
+                for woy, days in week.items()
+                for dow, players in days.items()
+                for nick, score in players.items()
+            ],
+        )
+
+    def save(self, channel, year, scores, times, worsttimes, week):
+        """
+        Replaces the totals of channel, and its week scores for year, with
+        the given ones. Used after scores are edited by hand (merges and
+        removals); hunts are stored with recordHunt.
+        """
+        with self._lock, self._conn:
+            self._replaceTotals(self._conn, channel, scores, times, worsttimes)
+            self._replaceWeek(self._conn, channel, year, week)
+
+    def importPickles(self, directory, prefix):
+        """
+        Imports the per-channel pickle files the plugin used to write
+        (<prefix><channel>.scores, .times, .worsttimes and
+        <prefix><channel><year>.weekscores) from directory, in one
+        transaction. The files are left in place.
+
+        Returns (imported, failed), the lists of file names that were
+        imported and of those that could not be read.
+        """
+        channels = {}
+        imported, failed = [], []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.startswith(prefix):
+                continue
+            name = filename[len(prefix) :]
+            match = re.match(r"(.+)(\d{4})\.weekscores$", name)
+            if match:
+                channel, kind = match.group(1), int(match.group(2))
+            else:
+                channel, dot, kind = name.rpartition(".")
+                if not dot or kind not in ("scores", "times", "worsttimes"):
+                    continue
+            try:
+                with open(os.path.join(directory, filename), "rb") as f:
+                    data = pickle.load(f)
+            except Exception:
+                failed.append(filename)
+                continue
+            channels.setdefault(channel, {})[kind] = data
+            imported.append(filename)
+
+        with self._lock, self._conn:
+            for channel, data in channels.items():
+                self._replaceTotals(
+                    self._conn,
+                    channel,
+                    data.get("scores", {}),
+                    data.get("times", {}),
+                    data.get("worsttimes", {}),
+                )
+                for year, week in data.items():
+                    if isinstance(year, int):
+                        self._replaceWeek(self._conn, channel, year, week)
+        return imported, failed
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
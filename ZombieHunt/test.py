@@ -27,21 +27,362 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+
+from supybot import schedule
 from supybot.test import *
 
+
 class ZombieHuntTestCase(ChannelPluginTestCase):
-    plugins = ('ZombieHunt',)
+    plugins = ("ZombieHunt",)
+    config = {
+        "supybot.plugins.ZombieHunt.kickMode": False,
+        "supybot.plugins.ZombieHunt.zombies": 2,
+    }
+
+    def _reply(self, query):
+        """
+        Returns every line the query got, joined with " | "
+        """
+        lines = [self.getMsg(query).args[1]]
+        m = self.irc.takeMsg()
+        while m:
+            lines.append(m.args[1])
+            m = self.irc.takeMsg()
+        return " | ".join(lines)
 
+    def _shoot(self):
+        cb = self.irc.getCallback("ZombieHunt")
+        hunt = cb._hunt(self.irc, self.channel)
+        hunt.missprobability = 0
+        hunt.reloading.clear()
+        cb.debug = 1
+        self.assertNotError("dbg")
+        self.assertRegexp("bang", "thud")
 
     def tests(self):
-	self.assertResponse("bang", "There is no hunt right now! You can start a hunt with the 'start' command")
-	self.assertResponse("stop", "Nothing to stop: there's no hunt right now.")
-	self.assertResponse("start", "The hunt starts now!")
-	self.assertResponse("start", "There is already a hunt right now!")
-	self.assertRegexp("bang", "^There was no zombie!")
-	self.assertResponse("stop", "The hunt stops now!")
-	self.assertNotError("listscores")
-	self.assertNotError("weekscores")
+        self.assertResponse(
+            "bang",
+            "There is no hunt right now! You can start a hunt with the"
+            " 'starthunt' command",
+        )
+        self.assertResponse("stophunt", "Nothing to stop: there's no hunt right now.")
+        self.assertResponse("starthunt", "The zombie hunt starts now!")
+        self.assertResponse("starthunt", "There is already a hunt right now!")
+        self.assertRegexp("bang", "^There was no zombie!")
+        self.assertResponse("stophunt", "The hunt stops now!")
+        self.assertNotError("listscores")
+        self.assertNotError("weekscores")
+
+    def testHuntStored(self):
+        cb = self.irc.getCallback("ZombieHunt")
+        self.assertNotError("starthunt")
+        self._shoot()
+        self._shoot()
+        while self.irc.takeMsg():
+            pass
+        # Both zombies shot: a perfect hunt
+        score = 2 + cb.perfectbonus
+        conn = sqlite3.connect(cb.store.path)
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM hunts").fetchone(), (1,))
+        self.assertEqual(
+            conn.execute("SELECT nick, score FROM hunt_results").fetchall(),
+            [(self.nick, score)],
+        )
+        self.assertEqual(conn.execute("SELECT score FROM totals").fetchone(), (score,))
+        # Read back from the store
+        cb.channelscores.clear()
+        cb.loaded.clear()
+        self.assertIn("x%sx: %d" % (self.nick, score), self._reply("listscores"))
+        self.assertNotError("rmscore %s" % self.nick)
+        self.assertEqual(conn.execute("SELECT score FROM totals").fetchone(), (None,))
+
+
+    def testScoresReadOnce(self):
+        cb = self.irc.getCallback("ZombieHunt")
+        loads = []
+        load = cb.store.load
+        cb.store.load = lambda *args: loads.append(args) or load(*args)
+        self.addCleanup(delattr, cb.store, "load")
+        # Nothing saved yet: every map stays empty
+        self.assertNotError("listscores")
+        self.assertNotError("listtimes")
+        self.assertNotError("weekscores")
+        self.assertEqual(loads, [(self.channel, cb.year)])
+
+    def testRank(self):
+        cb = self.irc.getCallback("ZombieHunt")
+        cb._read_scores(self.channel)
+        for i in range(50):
+            cb.channelscores[self.channel]["p%d" % i] = i
+            cb.channeltimes[self.channel]["p%d" % i] = 1.0 + i
+        self.assertIn(
+            "(xp49x: 49) (xp48x: 48) (xp47x: 47)", self._reply("listscores 3")
+        )
+        self.assertIn("(xp0x: 1.0) (xp1x: 2.0)", self._reply("listtimes 2"))
+        self.assertResponse(
+            "rank p40",
+            "xp40x on #test: score: 40 (#10 of 50) fastest time: 41.0 (#41 of 50)",
+        )
+        self.assertResponse("rank nobody", "There is no score for nobody on #test")
+
+
+class ZombieHuntLaunchTestCase(ChannelPluginTestCase):
+    plugins = ("ZombieHunt",)
+    config = {
+        "supybot.plugins.ZombieHunt.kickMode": False,
+        "supybot.plugins.ZombieHunt.autoFriday": False,
+        "supybot.plugins.ZombieHunt.minthrottle": 30,
+        "supybot.plugins.ZombieHunt.maxthrottle": 30,
+    }
+
+    def testLaunch(self):
+        cb = self.irc.getCallback("ZombieHunt")
+        hunt = cb._hunt(self.irc, self.channel)
+        self.assertNotError("starthunt")
+        self.assertEqual(
+            [key for (_, key) in cb.deadlines], [(self.irc.network, self.channel)]
+        )
+        self.assertIn("ZombieHunt_launcher", schedule.schedule.events)
+        timeFastForward(20)
+        schedule.run()
+        self.assertEqual(self.irc.takeMsg(), None)
+        timeFastForward(11)
+        schedule.run()
+        self.assertEqual(self.irc.takeMsg().args[1], "[O.o] *brains*")
+        self.assertNotIn("ZombieHunt_launcher", schedule.schedule.events)
+        hunt.reloading.clear()
+        hunt.missprobability = 0
+        self.assertRegexp("bang", "thud")
+        # The next one is throttle seconds after the shot
+        self.assertEqual(cb.armed, hunt.lastSpoke + 30)
+        self.assertNotError("stophunt")
+        while self.irc.takeMsg():
+            pass
+        timeFastForward(31)
+        schedule.run()
+        self.assertEqual(self.irc.takeMsg(), None)
+        self.assertEqual(cb.deadlines, [])
+        self.assertNotIn("ZombieHunt_launcher", schedule.schedule.events)
+
+    def testLaunchFails(self):
+        cb = self.irc.getCallback("ZombieHunt")
+        self.assertNotError("starthunt")
+        other = cb._hunt(self.irc, "#other")
+        other.started = True
+        other.lastSpoke = cb._hunt(self.irc, self.channel).lastSpoke
+        other.throttle = 60
+        cb._schedule_launch(self.irc, "#other", other)
+        launch = cb._launch
+
+        def _launch(irc, channel):
+            if channel == self.channel:
+                raise ValueError("no zombie for you")
+            return launch(irc, channel)
+
+        cb._launch = _launch
+        timeFastForward(31)
+        schedule.run()
+        self.assertFalse(cb._hunt(self.irc, self.channel).zombie)
+        # The failure didn't take the event of the other hunt with it
+        self.assertEqual(cb.armed, other.deadline)
+        self.assertIn("ZombieHunt_launcher", schedule.schedule.events)
+        timeFastForward(30)
+        schedule.run()
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args, ("#other", "[O.o] *brains*"))
+        self.assertTrue(other.zombie)
+
+
+    def testFridayModeInPrivate(self):
+        cb = self.irc.getCallback("ZombieHunt")
+        self.assertNotError("starthunt")
+        # In private, msg.args[0] is the bot's nick, not the channel
+        query = "fridaymode %s" % self.channel
+        self.irc.feedMsg(ircmsgs.privmsg(self.irc.nick, query, prefix=self.prefix))
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args[0], self.nick)
+        self.assertIn("Friday mode is now enabled", m.args[1])
+        self.assertEqual(
+            {key for (_, key) in cb.deadlines}, {(self.irc.network, self.channel)}
+        )
+        # Friday mode throttles are at most 60 seconds
+        timeFastForward(61)
+        schedule.run()
+        m = self.irc.takeMsg()
+        self.assertEqual(m.args, (self.channel, "[O.o] *brains*"))
+
+
+class ZombieHuntWeekTestCase(ChannelPluginTestCase):
+    plugins = ("ZombieHunt",)
+    config = {"supybot.plugins.ZombieHunt.kickMode": False}
+
+    def _hunt(self, scores):
+        """
+        Plays a hunt with the given scores and returns what the bot said
+        """
+        cb = self.irc.getCallback("ZombieHunt")
+        self.assertNotError("starthunt")
+        cb._hunt(self.irc, self.channel).scores = dict(scores)
+        return ZombieHuntTestCase._reply(self, "stophunt")
+
+    def testLeader(self):
+        cb = self.irc.getCallback("ZombieHunt")
+        out = self._hunt({"alice": 3, "bob": 1})
+        self.assertIn("alice has the lead for the week with 3 points.", out)
+        # Tied: alice keeps it
+        self.assertNotIn("lead", self._hunt({"bob": 2}))
+        out = self._hunt({"bob": 1})
+        self.assertIn("bob took the lead for the week over alice with 4 points.", out)
+        out = ZombieHuntTestCase._reply(self, "weekscores")
+        self.assertIn("Leader: xbobx with 4 points.", out)
+        out = ZombieHuntTestCase._reply(self, "weekscores bob")
+        self.assertIn("Total: 4 points.", out)
+        self.assertNotError("mergescores alice bob")
+        out = ZombieHuntTestCase._reply(self, "weekscores")
+        self.assertIn("Leader: xalicex with 7 points.", out)
+        self.assertEqual(dict(cb._week_totals(self.channel, cb.woy)), {"alice": 7})
+        # Added up again from the store
+        for scores in (cb.channelscores, cb.channeltimes, cb.channelworsttimes):
+            scores.clear()
+        cb.channelweek.clear()
+        cb.loaded.clear()
+        out = ZombieHuntTestCase._reply(self, "weekscores")
+        self.assertIn("Leader: xalicex with 7 points.", out)
+
+    def testLeaderOfChannel(self):
+        cb = self.irc.getCallback("ZombieHunt")
+        self.assertIn("alice has the lead", self._hunt({"alice": 3}))
+        # A hunt on a channel of the same name on another network adds to
+        # the same week totals, so alice's lead is no news there
+        cb.hunts.clear()
+        self.assertNotIn("lead", self._hunt({"bob": 1}))
+        self.assertIn(
+            "bob took the lead for the week over alice", self._hunt({"bob": 3})
+        )
+
+
+class HuntStateTestCase(SupyTestCase):
+    def testSlots(self):
+        from ZombieHunt.plugin import HuntState
+
+        hunt = HuntState()
+        self.assertRaises(AttributeError, setattr, hunt, "leader", "alice")
+        self.assertFalse(hasattr(hunt, "__dict__"))
+
+
+class LeaderboardTestCase(SupyTestCase):
+    def testOrder(self):
+        from ZombieHunt.leaderboard import Leaderboard
+
+        scores = Leaderboard({"a": 3, "b": 5, "c": 1}, reverse=True)
+        self.assertEqual(scores.top(2), [("b", 5), ("a", 3)])
+        self.assertEqual(scores.top(10), [("b", 5), ("a", 3), ("c", 1)])
+        self.assertEqual(scores.rank("a"), 2)
+        self.assertEqual(scores.rank("zz"), None)
+        times = Leaderboard({"a": 2.5, "b": 1.0})
+        self.assertEqual(times.top(5), [("b", 1.0), ("a", 2.5)])
+        self.assertEqual(times.rank("a"), 2)
+
+    def testTies(self):
+        from ZombieHunt.leaderboard import Leaderboard
+
+        scores = Leaderboard({"a": 5, "b": 5, "c": 1}, reverse=True)
+        self.assertEqual((scores.rank("a"), scores.rank("b")), (1, 1))
+        self.assertEqual(scores.rank("c"), 3)
+
+    def testUpdates(self):
+        from ZombieHunt.leaderboard import Leaderboard
+
+        scores = Leaderboard({"a": 3, "b": 5, "c": 1}, reverse=True)
+        scores["c"] += 10
+        self.assertEqual(scores.top(1), [("c", 11)])
+        self.assertEqual(scores.rank("a"), 3)
+        scores["a"] = 11
+        self.assertEqual((scores.rank("a"), scores.rank("c")), (1, 1))
+        del scores["c"]
+        self.assertEqual(scores.rank("a"), 1)
+        self.assertEqual(len(scores), 2)
+        self.assertEqual(dict(scores), {"a": 11, "b": 5})
+        self.assertRaises(KeyError, scores.__delitem__, "c")
+
+
+class ScoreStoreTestCase(SupyTestCase):
+    def setUp(self):
+        super().setUp()
+        from ZombieHunt.store import ScoreStore
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = ScoreStore(os.path.join(self.directory, "z.sqlite3"))
+        self.addCleanup(self.store.close)
+
+    def _dump(self, name, data):
+        with open(os.path.join(self.directory, name), "wb") as f:
+            pickle.dump(data, f)
+
+    def testSaveLoad(self):
+        self.assertTrue(self.store.open())
+        week = {12: {3: {"bob": 3, "amy": 1}, 4: {"bob": 2}}}
+        self.store.save(
+            "#a", 2025, {"bob": 5, "amy": 1}, {"bob": 1.5}, {"bob": 9.0}, week
+        )
+        self.assertEqual(
+            self.store.load("#a", 2025),
+            ({"bob": 5, "amy": 1}, {"bob": 1.5}, {"bob": 9.0}, week),
+        )
+        self.assertEqual(self.store.load("#a", 2024)[3], {})
+        self.assertEqual(self.store.load("#b", 2025), ({}, {}, {}, {}))
+        # Saving replaces, it doesn't merge
+        self.store.save("#a", 2025, {"amy": 2}, {}, {}, {})
+        self.assertEqual(self.store.load("#a", 2025), ({"amy": 2}, {}, {}, {}))
+        self.store.close()
+        self.assertFalse(self.store.open())
+
+    def testRecordHunt(self):
+        self.store.open()
+        self.store.recordHunt(
+            "#a",
+            100.0,
+            2025,
+            12,
+            3,
+            [("bob", 2, 1.5, 4.0), ("amy", 0, None, None)],
+            [("bob", 7, 1.2, 4.0), ("amy", 1, 3.0, 3.0)],
+            {"bob": 2},
+        )
+        self.assertEqual(
+            self.store.load("#a", 2025),
+            (
+                {"bob": 7, "amy": 1},
+                {"bob": 1.2, "amy": 3.0},
+                {"bob": 4.0, "amy": 3.0},
+                {12: {3: {"bob": 2}}},
+            ),
+        )
+
+    def testImportPickles(self):
+        self._dump("ZombieHunt_#a.scores", {"bob": 3})
+        self._dump("ZombieHunt_#a.times", {"bob": 1.5})
+        self._dump("ZombieHunt_#a.worsttimes", {"bob": 9.0})
+        self._dump("ZombieHunt_#a2025.weekscores", {12: {3: {"bob": 3}}})
+        self._dump("Other_#a.scores", {"eve": 1})
+        with open(os.path.join(self.directory, "ZombieHunt_#b.scores"), "wb") as f:
+            f.write(b"garbage")
+        self.assertTrue(self.store.open())
+        imported, failed = self.store.importPickles(self.directory, "ZombieHunt_")
+        self.assertEqual(len(imported), 4)
+        self.assertEqual(failed, ["ZombieHunt_#b.scores"])
+        self.assertEqual(
+            self.store.load("#a", 2025),
+            ({"bob": 3}, {"bob": 1.5}, {"bob": 9.0}, {12: {3: {"bob": 3}}}),
+        )
+        self.assertEqual(self.store.load("#b", 2025), ({}, {}, {}, {}))
 
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: